@@ -0,0 +1,351 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Columnar index of every annotation in a corpus. Built once from the .hea and .atr
+files (no signals are read) and saved as one .npz of numpy columns:
+
+    record     int32   id of the record (see BeatIndex.records)
+    sample     int64   position of the annotation at the record rate
+    symbol     int16   code of the annotation symbol (see BeatIndex.symbols)
+    in_bounds  bool    True when the beat window of the current config fits in the record
+
+Selecting beats by label set, record or lead availability is then a few vectorized
+comparisons, and the selected rows can be passed straight to BeatIndex.windows.
+'''
+import os
+import numpy as np
+
+import config
+import utils
+
+RECORD_EXTENSIONS = ['hea', 'atr']
+
+
+def bounds_settings():
+    '''
+    :return: dict of the config values the in_bounds column depends on
+    '''
+    return {
+        'slice_before': config.data['slice_before'],
+        'slice_after': config.data['slice_after'],
+        'kernal_size': config.data['kernal_size'],
+        'hz': config.data['hz'] if config.processing['resample'] else None,
+        'difference': config.processing['difference'],
+        'average_difference': config.processing['average_difference']
+    }
+
+
+def channel_length(length, settings):
+    '''
+    :param length: int array of signal lengths
+    :param settings: see bounds_settings
+    :return: The length of the shortest feature channel built from signals of those lengths
+        (see extract_features: difference is one shorter, average_difference kernal_size shorter)
+    '''
+    length = np.asarray(length, dtype=np.int64)
+    lengths = []
+    if settings['difference']:
+        lengths.append(length - 1)
+    if settings['average_difference']:
+        lengths.append(settings['kernal_size'] + np.maximum(0, length - 2 * settings['kernal_size']))
+    return np.min(lengths, axis=0) if lengths else length
+
+
+def indexed_records(directory):
+    '''
+    :param directory: the location of the records
+    :return: sorted names of the records with both a header (.hea) and an annotation (.atr) file
+    '''
+    files = set(os.listdir(directory))
+    return sorted(os.path.splitext(file)[0] for file in files
+                  if file.endswith(".hea") and os.path.splitext(file)[0] + ".atr" in files)
+
+
+def source_key(directory, filenames):
+    '''
+    :return: hash of the size and modification time of the header and annotation files of the records
+    '''
+    stats = []
+    for filename in filenames:
+        for extension in RECORD_EXTENSIONS:
+            path = "{}/{}.{}".format(directory, filename, extension)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                stats.append([filename, extension, stat.st_size, stat.st_mtime])
+    return utils.config_hash(stats)
+
+
+class BeatIndex:
+    '''
+    Every annotation of a corpus as numpy columns, with the records, symbols and leads they refer to
+    '''
+
+    def __init__(self, columns, records, symbols, leads, record_leads, record_fs, record_length, source=None,
+                 key=None, settings=None):
+        '''
+        :param columns: dict {record, sample, symbol, in_bounds} of equal length arrays
+        :param records: list of record names (indexed by the record column)
+        :param symbols: list of annotation symbols (indexed by the symbol column)
+        :param leads: list of every lead name in the corpus
+        :param record_leads: bool array (records, leads), True where a record holds a lead
+        :param record_fs: float array of the sampling rate of each record
+        :param record_length: int array of the number of samples of each record
+        :param source: The directory the index was built from
+        :param key: see source_key
+        :param settings: The bounds_settings the in_bounds column was computed with
+        '''
+        self.record = columns['record']
+        self.sample = columns['sample']
+        self.symbol = columns['symbol']
+        self.in_bounds = columns['in_bounds']
+        self.records = list(records)
+        self.symbols = list(symbols)
+        self.leads = list(leads)
+        self.record_leads = np.asarray(record_leads, dtype=bool)
+        self.record_fs = np.asarray(record_fs, dtype=float)
+        self.record_length = np.asarray(record_length, dtype=np.int64)
+        self.source = source
+        self.key = key
+        self.settings = settings
+        if settings != bounds_settings():
+            self.refresh_bounds()
+
+    def __len__(self):
+        return len(self.sample)
+
+    def refresh_bounds(self, settings=None):
+        '''
+        Recomputes the in_bounds column for the current config (or settings), e.g. after changing slice_before
+        :param settings: see bounds_settings (defaults to the current config)
+        '''
+        settings = bounds_settings() if settings is None else settings
+        samples, lengths = self.sample, self.record_length
+        if settings['hz'] is not None:
+            import resample_data
+
+            # Beats are sliced from records resampled to hz (see resample_data.resample_record),
+            # so samples are mapped the same way, one sampling rate at a time
+            samples, lengths = self.sample.copy(), self.record_length.copy()
+            for fs in np.unique(self.record_fs):
+                up, down = resample_data.resample_ratio(fs, settings['hz'])
+                at_rate = self.record_fs == fs
+                lengths[at_rate] = -(-self.record_length[at_rate] * up // down)
+                rows = at_rate[self.record]
+                samples[rows] = resample_data.resample_samples(self.sample[rows], fs, settings['hz'])
+            samples = np.minimum(samples, lengths[self.record] - 1)
+        limit = channel_length(lengths, settings)[self.record]
+        self.in_bounds = (samples - settings['slice_before'] >= 0) & (samples + settings['slice_after'] + 1 <= limit)
+        self.settings = settings
+
+    def symbol_codes(self, symbols):
+        '''
+        :param symbols: list of annotation symbols
+        :return: int array of their codes (-1 for symbols not in the corpus)
+        '''
+        return np.array([self.symbols.index(symbol) if symbol in self.symbols else -1 for symbol in symbols],
+                        dtype=np.int64)
+
+    def record_ids(self, records):
+        '''
+        :param records: list of record names
+        :return: int array of their ids (-1 for records not in the index)
+        '''
+        return np.array([self.records.index(record) if record in self.records else -1 for record in records],
+                        dtype=np.int64)
+
+    def select(self, labels=None, records=None, leads=None, in_bounds=True):
+        '''
+        Vectorized selection of rows
+        :param labels: Only annotations with these symbols, e.g. config.data['annotations']
+        :param records: Only annotations of these record names
+        :param leads: Only annotations of records holding every one of these leads
+        :param in_bounds: Only beats whose window fits in the record (see refresh_bounds), None for every row
+        :return: int array of the selected rows, in index order (record by record, then by sample)
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        if labels is not None:
+            mask &= np.isin(self.symbol, self.symbol_codes(labels))
+        if records is not None:
+            mask &= np.isin(self.record, self.record_ids(records))
+        if leads is not None:
+            missing = [lead for lead in leads if lead not in self.leads]
+            has_leads = np.zeros(len(self.records), dtype=bool) if missing else \
+                self.record_leads[:, [self.leads.index(lead) for lead in leads]].all(axis=1)
+            mask &= has_leads[self.record]
+        if in_bounds is not None:
+            mask &= self.in_bounds == in_bounds
+        return np.nonzero(mask)[0]
+
+    def labels(self, rows, annotations=config.data['annotations']):
+        '''
+        :param rows: int array of rows
+        :param annotations: The label symbols (defaults to config.data['annotations'])
+        :return: int array of the label index of each row (-1 where the symbol is not in annotations)
+        '''
+        lookup = np.full(len(self.symbols) + 1, -1, dtype=np.int64)
+        # Reversed so the first occurrence wins, the same as format_data.label_indexes
+        for label_index in reversed(range(len(annotations))):
+            code = self.symbol_codes([annotations[label_index]])[0]
+            if code >= 0:
+                lookup[code] = label_index
+        return lookup[self.symbol[rows]]
+
+    def label_counts(self, annotations=config.data['annotations'], rows=None):
+        '''
+        :param annotations: The label symbols (defaults to config.data['annotations'])
+        :param rows: The rows to count (defaults to the in bounds rows holding one of the labels)
+        :return: dict of symbol -> number of beats
+        '''
+        rows = self.select(annotations) if rows is None else rows
+        counts = np.bincount(self.labels(rows, annotations), minlength=len(annotations))
+        return dict(zip(annotations, counts.tolist()))
+
+    def beats(self, rows):
+        '''
+        :param rows: int array of rows
+        :return: (record names, samples) of the rows
+        '''
+        return np.asarray(self.records, dtype=object)[self.record[rows]], self.sample[rows]
+
+    def windows(self, rows, file_dicts, lead=config.data['lead'], out=None):
+        '''
+        Gathers the feature window of each row (see format_data.extract_windows)
+        :param rows: int array of in bounds rows (see select)
+        :param file_dicts: dictionary of record name -> data dictionary holding the feature channels
+            (see read_data.read_all_data and format_data.preprocess_record). Records read with several
+            leads are sliced on lead. Samples are mapped onto the rate of each data dictionary
+        :param lead: The lead to slice (defaults to config.data['lead'])
+        :param out: Optional array to write into, (len(rows), window, channels) or (len(rows), window)
+        :return: features in the order of rows
+        '''
+        from format_data import feature_channels, extract_windows
+        from read_data import select_lead
+
+        rows = np.asarray(rows, dtype=np.int64)
+        channels = feature_channels()
+        window = config.data['slice_before'] + config.data['slice_after'] + 1
+        if out is None:
+            shape = (len(rows), window) if len(channels) == 1 else (len(rows), window, len(channels))
+            out = np.empty(shape, dtype=float)
+        record_ids = self.record[rows]
+        # Rows are grouped by record so each record's channels are viewed once
+        order = np.argsort(record_ids, kind='mergesort')
+        starts = np.flatnonzero(np.r_[True, record_ids[order][1:] != record_ids[order][:-1]]) if len(rows) else []
+        for start, stop in zip(starts, list(starts[1:]) + [len(rows)]):
+            group = order[start:stop]
+            record_id = record_ids[group[0]]
+            file_data = select_lead(file_dicts[self.records[record_id]], lead)
+            if file_data is None:
+                raise KeyError("Record {} does not hold lead {}".format(self.records[record_id], lead))
+            samples = self.sample[rows[group]]
+            fs = file_data['fields']['fs']
+            if fs != self.record_fs[record_id]:
+                import resample_data
+
+                samples = resample_data.resample_samples(samples, self.record_fs[record_id], fs)
+            if len(channels) == 1:
+                block = np.empty((len(group), window), dtype=out.dtype)
+            else:
+                block = np.empty((len(group), window, len(channels)), dtype=out.dtype)
+            out[group] = extract_windows(file_data, samples, channels, block)
+        return out
+
+    def save(self, path=config.data['beat_index']):
+        '''
+        Writes the index to a single .npz file
+        '''
+        np.savez(path, record=self.record, sample=self.sample, symbol=self.symbol, in_bounds=self.in_bounds,
+                 records=np.asarray(self.records, dtype=str), symbols=np.asarray(self.symbols, dtype=str),
+                 leads=np.asarray(self.leads, dtype=str), record_leads=self.record_leads, record_fs=self.record_fs,
+                 record_length=self.record_length, source=str(self.source), key=str(self.key),
+                 settings=utils.config_hash(self.settings))
+
+
+@utils.timer()
+def build_beat_index(directory=config.data['mit-bih']):
+    '''
+    Reads the header and annotation file of every record (signals are not read)
+    :param directory: the location of the records. Defaults to configuration mit-bih
+    :return: BeatIndex of every annotation in the directory
+    '''
+    import wfdb
+
+    filenames = indexed_records(directory)
+    for file in sorted(os.listdir(directory)):
+        if file.endswith(".hea") and os.path.splitext(file)[0] not in filenames:
+            utils.w_log("No annotation file for {}".format(os.path.splitext(file)[0]))
+    records, leads, record_signals, record_fs, record_length = [], [], [], [], []
+    record_column, sample_column, symbol_column = [], [], []
+    symbol_codes = {}
+    for filename in filenames:
+        path = "{}/{}".format(directory, filename)
+        header = wfdb.rdheader(path)
+        annotation = wfdb.rdann(path, 'atr')
+        symbols = np.asarray(annotation.symbol, dtype=object)
+        for symbol in np.unique(symbols) if len(symbols) else []:
+            symbol_codes.setdefault(symbol, len(symbol_codes))
+        record_id = len(records)
+        records.append(filename)
+        record_signals.append(list(header.sig_name))
+        for lead in header.sig_name:
+            if lead not in leads:
+                leads.append(lead)
+        record_fs.append(header.fs)
+        record_length.append(header.sig_len)
+        record_column.append(np.full(len(symbols), record_id, dtype=np.int32))
+        sample_column.append(np.asarray(annotation.sample, dtype=np.int64))
+        symbol_column.append(np.array([symbol_codes[symbol] for symbol in symbols], dtype=np.int16))
+
+    record_leads = np.zeros((len(records), len(leads)), dtype=bool)
+    for record_id, names in enumerate(record_signals):
+        record_leads[record_id, [leads.index(lead) for lead in names]] = True
+    columns = {
+        'record': np.concatenate(record_column) if records else np.empty(0, dtype=np.int32),
+        'sample': np.concatenate(sample_column) if records else np.empty(0, dtype=np.int64),
+        'symbol': np.concatenate(symbol_column) if records else np.empty(0, dtype=np.int16)
+    }
+    columns['in_bounds'] = np.zeros(len(columns['sample']), dtype=bool)
+    symbols = sorted(symbol_codes, key=symbol_codes.get)
+    return BeatIndex(columns, records, symbols, leads, record_leads, record_fs, record_length, directory,
+                     source_key(directory, records))
+
+
+def load_beat_index(path=config.data['beat_index']):
+    '''
+    :param path: The .npz file written by BeatIndex.save (defaults to config.data['beat_index'])
+    :return: BeatIndex (in_bounds is recomputed if the config changed since it was saved)
+    '''
+    with np.load(path) as saved:
+        columns = {name: saved[name] for name in ['record', 'sample', 'symbol', 'in_bounds']}
+        index = BeatIndex(columns, saved['records'].tolist(), saved['symbols'].tolist(), saved['leads'].tolist(),
+                          saved['record_leads'], saved['record_fs'], saved['record_length'], str(saved['source']),
+                          str(saved['key']), bounds_settings() if str(saved['settings']) ==
+                          utils.config_hash(bounds_settings()) else None)
+    return index
+
+
+def get_beat_index(directory=config.data['mit-bih'], path=config.data['beat_index']):
+    '''
+    Loads the saved index, building (and saving) it again if the records of directory have changed
+    :param directory: the location of the records. Defaults to configuration mit-bih
+    :param path: The .npz file of the index (defaults to config.data['beat_index'])
+    :return: BeatIndex
+    '''
+    if os.path.exists(path):
+        index = load_beat_index(path)
+        if index.source == directory and index.key == source_key(directory, indexed_records(directory)):
+            return index
+        utils.v_log("Records in {} changed, rebuilding the beat index".format(directory))
+    index = build_beat_index(directory)
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    index.save(path)
+    return index
+
+
+if __name__ == "__main__":
+    index = get_beat_index()
+    utils.log("{} annotations in {} records".format(len(index), len(index.records)))
+    utils.log("Beats per label: {}".format(index.label_counts()))
@@ -0,0 +1,371 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Offline benchmark suite. Synthetic WFDB records (see generate_data) are written at
+multiples of the MIT-BIH size and every stage of the pipeline is timed on them.
+Results are written as json and can be compared against a saved baseline:
+
+    python benchmark.py --scales 1 10 --output bench.json --baseline baseline.json
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import numpy as np
+
+import config
+import utils
+import extract_features
+import generate_data
+from format_data import (slice_based_on_annotations, slice_signal, feature_channels, balanced_indices,
+                         setup_data, get_data)
+from read_data import Annotation, read_record
+
+
+def synthetic_records(count=48, length=650000, fs=360, seed=0):
+    '''
+    Creates in memory data dictionaries (see read_data.read_record) of the records generate_data
+    writes, holding the first lead
+    :param count: The number of records
+    :param length: The number of samples in each record
+    :param fs: The sampling rate
+    :param seed: The random seed
+    :return: dictionary of record name -> data dictionary
+    '''
+    records = {}
+    for name, signals, samples, symbols in generate_data.synthetic_leads(count, length, fs, seed):
+        record = {
+            'signal': signals[:, 0],
+            'annotation': Annotation(samples, symbols),
+            'fields': {'fs': fs, 'sig_name': [config.data['lead']], 'units': ['mV']}
+        }
+        records[name] = extract_features.add_derived_channels(record)
+    return records
+
+
+def slice_per_beat(file_dicts, annotations=config.data['annotations']):
+    '''
+    The previous implementation of slice_based_on_annotations (one slice_signal call per beat
+    and channel) kept as the reference for bench_slicing
+    '''
+    features, labels = [], []
+    for file_data in file_dicts.values():
+        if config.data['lead'] in file_data['fields']['sig_name']:
+            for sample, type in zip(file_data['annotation'].sample, file_data['annotation'].symbol):
+                label_index = utils.find_index(annotations, type)
+                if label_index is not False:
+                    try:
+                        feature = np.array([slice_signal(file_data[name], sample) for name in feature_channels()]).T
+                        features.append(np.squeeze(feature))
+                        labels.append(label_index)
+                    except IndexError:
+                        pass
+    return features, labels
+
+
+def bench_slicing(count=48, length=650000, repeat=3):
+    '''
+    Times slice_based_on_annotations against the per beat reference and checks both give the same output
+    :param count: The number of synthetic records
+    :param length: The number of samples in each record
+    :param repeat: The number of timed runs (the fastest is reported)
+    :return: dict {beats, per_beat_seconds, batched_seconds, speedup}
+    '''
+    records = synthetic_records(count, length)
+
+    def best(func):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = func(records)
+            times.append(time.perf_counter() - start)
+        return min(times), output
+
+    per_beat_seconds, (expected_X, expected_y) = best(slice_per_beat)
+    batched_seconds, (X, y) = best(slice_based_on_annotations)
+    assert np.array_equal(np.array(expected_X), X) and np.array_equal(expected_y, y)
+    return {
+        'beats': len(y),
+        'per_beat_seconds': per_beat_seconds,
+        'batched_seconds': batched_seconds,
+        'speedup': per_beat_seconds / batched_seconds
+    }
+
+
+class StageTimer:
+    '''
+    Times named stages of a benchmark run
+    '''
+
+    def __init__(self):
+        self.results = {}
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        output = func(*args, **kwargs)
+        self.results[stage] = time.perf_counter() - start
+        utils.log("{}: {:.3f} seconds".format(stage, self.results[stage]))
+        return output
+
+    def add(self, stage, func, *args, **kwargs):
+        '''
+        Adds the time of one call to the total of a stage, for stages timed piece by piece (see log)
+        '''
+        start = time.perf_counter()
+        output = func(*args, **kwargs)
+        self.results[stage] = self.results.get(stage, 0.0) + time.perf_counter() - start
+        return output
+
+    def log(self, *stages):
+        for stage in stages:
+            utils.log("{}: {:.3f} seconds".format(stage, self.results.get(stage, 0.0)))
+
+
+def model_forward(X, batch_size=config.train['eval_batch']):
+    '''
+    Runs the network_model graph (with freshly initialised weights) over X in batches
+    :return: The number of rows classified
+    '''
+    import tensorflow as tf
+    from network_model import instantiate_model
+
+    with tf.Graph().as_default():
+        X_placeholder, _, _, output_soft = instantiate_model()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for i in range(0, len(X), batch_size):
+                sess.run(output_soft, feed_dict={X_placeholder: np.asarray(X[i:i + batch_size])})
+    return len(X)
+
+
+def read_dataset(X, y, batch_size=config.train['eval_batch']):
+    '''
+    Reads every row of a dataset, batch_size rows at a time
+    :return: The number of bytes read
+    '''
+    from feed_data import chunks
+
+    return sum(X_chunk.nbytes for X_chunk, _ in chunks(X, y, size=batch_size))
+
+
+def bench_scale(scale, directory, records=generate_data.MIT_BIH_RECORDS, length=generate_data.MIT_BIH_LENGTH,
+                model=True):
+    '''
+    Times every pipeline stage on synthetic records totalling scale times the MIT-BIH size. Records are read,
+    transformed and sliced one at a time and the dataset is built out of core (see format_data.stream_data)
+    and read back in batches, so memory stays bounded by one record whatever the scale
+    :param scale: multiple of the MIT-BIH record count
+    :param directory: scratch directory for the records and dataset
+    :param records: the number of records at scale 1
+    :param length: the number of samples in each record
+    :param model: also time the model forward pass (needs tensorflow)
+    :return: dict of stage -> seconds
+    '''
+    source = os.path.join(directory, 'records')
+    timer = StageTimer()
+    timer.time('write_records', generate_data.write_records, source, records * scale, length)
+
+    # The derived channels are left to the feature_transforms stage
+    raw = dict(config.processing, difference=False, average_difference=False)
+    filenames = sorted(os.path.splitext(file)[0] for file in os.listdir(source) if file.endswith(".dat"))
+    labels = []
+    for filename in filenames:
+        data = timer.add('read_records', read_record, filename, source, processing=raw)
+        if data is None:
+            continue
+        timer.add('feature_transforms', extract_features.add_derived_channels, data)
+        _, y = timer.add('slice_based_on_annotations', slice_based_on_annotations, {filename: data})
+        labels.append(y)
+    timer.log('read_records', 'feature_transforms', 'slice_based_on_annotations')
+    timer.time('balanced_sampling', balanced_indices, np.concatenate(labels), seed=0)
+    del labels
+
+    timer.time('setup_data', setup_data, 'benchmark', directory, source=source, stream=True)
+    X, y = timer.time('get_data', get_data, 'benchmark', directory)
+    timer.time('read_dataset', read_dataset, X, y)
+    if model:
+        timer.time('model_forward', model_forward, X)
+    results = dict(timer.results)
+    results['beats'] = len(y)
+    return results
+
+
+def run_suite(scales=(1, 10, 100), records=generate_data.MIT_BIH_RECORDS, length=generate_data.MIT_BIH_LENGTH,
+              model=True, directory=None):
+    '''
+    :param scales: the multiples of the MIT-BIH size to run
+    :param records: the number of records at scale 1
+    :param length: the number of samples in each record
+    :param model: also time the model forward pass (needs tensorflow)
+    :param directory: scratch directory (defaults to a temporary directory, removed afterwards)
+    :return: dict {meta, scales: {scale: {stage: seconds}}}. The record cache is disabled so every run is cold
+    '''
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'records': records,
+            'length': length,
+            'config_hash': utils.config_hash(config.data, config.processing)
+        },
+        'scales': {}
+    }
+    cache = config.data['use_cache']
+    config.data['use_cache'] = False
+    try:
+        for scale in scales:
+            scratch = tempfile.mkdtemp(dir=directory)
+            try:
+                utils.log("Scale {}x ({} records of {} samples)".format(scale, records * scale, length))
+                results['scales'][str(scale)] = bench_scale(scale, scratch, records, length, model)
+            finally:
+                shutil.rmtree(scratch)
+    finally:
+        config.data['use_cache'] = cache
+    return results
+
+
+def train_steps(X, y, batch_size=config.train['batch'], model=True):
+    '''
+    Runs one epoch of training batches (see feed_data.BatchPrefetcher) through the network_model
+    graph with freshly initialised weights, or just the input pipeline when model is False
+    :return: The number of rows trained on
+    '''
+    from feed_data import BatchPrefetcher
+
+    prefetcher = BatchPrefetcher(X, y, batch_size, seed=0)
+    if not model:
+        for _ in prefetcher.epoch():
+            pass
+        return len(y)
+
+    import tensorflow as tf
+    from network_model import instantiate_model
+
+    with tf.Graph().as_default():
+        X_placeholder, y_placeholder, output, _ = instantiate_model()
+        loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(labels=y_placeholder, logits=output))
+        step = tf.train.GradientDescentOptimizer(config.train['learning_rate']).minimize(loss)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for X_batch, y_batch in prefetcher.epoch():
+                sess.run(step, feed_dict={X_placeholder: X_batch, y_placeholder: y_batch})
+    return len(y)
+
+
+def directory_bytes(directory):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(directory) for file in files)
+
+
+def bench_compact(records=generate_data.MIT_BIH_RECORDS, length=generate_data.MIT_BIH_LENGTH, model=True,
+                  directory=None):
+    '''
+    Builds the same dataset with and without config.data['compact'] and measures the time, peak traced
+    memory and disk size of setup_data, the size of the dataset get_data returns and the training throughput
+    :param records: the number of synthetic records
+    :param length: the number of samples in each record
+    :param model: time training steps of the network_model graph (needs tensorflow), else only the input pipeline
+    :param directory: scratch directory (defaults to a temporary directory, removed afterwards)
+    :return: dict of mode -> results, and the largest difference between the two datasets
+    '''
+    import tracemalloc
+
+    scratch = tempfile.mkdtemp(dir=directory)
+    compact, cache = config.data['compact'], config.data['use_cache']
+    results = {}
+    datasets = {}
+    try:
+        source = os.path.join(scratch, 'records')
+        generate_data.write_records(source, records, length)
+        for mode in ['float64', 'compact']:
+            config.data['compact'] = mode == 'compact'
+            config.data['use_cache'] = False
+            tracemalloc.start()
+            start = time.perf_counter()
+            setup_data(mode, scratch, balance=False, source=source)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            X, y = get_data(mode, scratch)
+            start = time.perf_counter()
+            rows = train_steps(X, y, model=model)
+            datasets[mode] = X
+            results[mode] = {
+                'setup_data_seconds': seconds,
+                'setup_data_peak_mb': peak / 1024.0 ** 2,
+                'dataset_disk_mb': directory_bytes(os.path.join(scratch, mode)) / 1024.0 ** 2,
+                'dataset_dtype': str(X.dtype),
+                'dataset_mb': X.dtype.itemsize * np.prod(X.shape) / 1024.0 ** 2,
+                'train_rows_per_second': rows / (time.perf_counter() - start)
+            }
+            utils.log("{}: {}".format(mode, results[mode]))
+        results['max_difference'] = float(np.abs(np.asarray(datasets['compact'], dtype=float) -
+                                                 np.asarray(datasets['float64'])).max())
+        results['scale'] = float(np.abs(np.asarray(datasets['float64'])).max())
+        return results
+    finally:
+        config.data['compact'], config.data['use_cache'] = compact, cache
+        datasets.clear()
+        shutil.rmtree(scratch)
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Compares results against a baseline run
+    :param results: output of run_suite
+    :param baseline: output of an earlier run_suite
+    :param tolerance: the fraction a stage can slow down by before it is reported
+    :return: list of dicts {scale, stage, baseline_seconds, seconds, change} of the stages that slowed down
+    '''
+    regressions = []
+    for scale, stages in results['scales'].items():
+        for stage, seconds in stages.items():
+            before = baseline.get('scales', {}).get(scale, {}).get(stage)
+            if stage == 'beats' or not before:
+                continue
+            change = (seconds - before) / before
+            if change > tolerance:
+                regressions.append({'scale': scale, 'stage': stage, 'baseline_seconds': before,
+                                    'seconds': seconds, 'change': change})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic MIT-BIH sized data")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--records', type=int, default=generate_data.MIT_BIH_RECORDS)
+    parser.add_argument('--length', type=int, default=generate_data.MIT_BIH_LENGTH)
+    parser.add_argument('--no-model', action='store_true', help="Skip the model forward pass")
+    parser.add_argument('--directory', default=None, help="Scratch directory for the synthetic data")
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None, help="An earlier output file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--slicing', action='store_true', help="Only run bench_slicing")
+    parser.add_argument('--compact', action='store_true', help="Only run bench_compact")
+    args = parser.parse_args(argv)
+
+    if args.slicing:
+        utils.log(bench_slicing())
+    elif args.compact:
+        utils.log(json.dumps(bench_compact(args.records, args.length, not args.no_model, args.directory), indent=2))
+    else:
+        results = run_suite(args.scales, args.records, args.length, not args.no_model, args.directory)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(results, json.load(f), args.tolerance)
+            for regression in regressions:
+                utils.w_log("{scale}x {stage}: {baseline_seconds:.3f} -> {seconds:.3f} seconds".format(**regression))
+            if regressions:
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+On disk cache of the per-record arrays produced by read_data.read_record.
+Each entry is keyed by the directory and size/mtime of the record files and a hash
+of the settings used to build it, so only changed records or settings are recomputed.
+The cache is used when config.data['use_cache'] is set.
+'''
+import json
+import os
+import time
+import numpy as np
+
+import config
+import utils
+from read_data import Annotation
+
+# Channels that are stored, in order, as the rows of one array per record
+CHANNELS = ['signal', 'difference', 'average_difference']
+RECORD_EXTENSIONS = ['dat', 'hea', 'atr']
+# The files of a cache entry, the signal file is only written for compact records
+ENTRY_FILES = ['.npy', '_annotation.npz', '_signal.npy']
+
+
+def cache_settings(lead=config.data['lead'], processing=config.processing, kernal_size=config.data['kernal_size'],
+                   hz=config.data['hz'], compact=config.data['compact']):
+    '''
+    :param lead: The lead, or list of leads read in one pass (see read_data.read_record)
+    :return: dict of the settings that change the cached arrays of a record
+    '''
+    return {
+        'lead': lead,
+        'kernal_size': kernal_size,
+        'difference': processing['difference'],
+        'average_difference': processing['average_difference'],
+        'hz': hz if processing['resample'] else None,
+        'compact': compact
+    }
+
+
+class RecordCache:
+    '''
+    LRU cache of preprocessed records. The channels of a record are stored as the
+    rows of a single .npy file so a warm read is one memory mapped load. Records read
+    with several leads store one row per channel and lead
+    '''
+
+    def __init__(self, directory=config.data['cache'], max_bytes=config.data['cache_size']):
+        '''
+        :param directory: The directory holding the cache (defaults to config.data['cache'])
+        :param max_bytes: The size cap of the cache, least recently used entries are removed first
+            (defaults to config.data['cache_size'])
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def key(self, filename, directory, settings):
+        '''
+        :param filename: name of the record. Should just be base name (no extention)
+        :param directory: the location of the record
+        :param settings: dict of the settings used to build the record (see cache_settings)
+        :return: The cache key of the record
+        '''
+        stats = []
+        for extension in RECORD_EXTENSIONS:
+            path = "{}/{}.{}".format(directory, filename, extension)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                stats.append([extension, stat.st_size, stat.st_mtime])
+        return "{}-{}".format(filename, utils.config_hash(os.path.abspath(directory), stats, settings))
+
+    def get(self, filename, directory, settings):
+        '''
+        :return: The cached record dictionary (see read_data.read_record) with memory mapped arrays,
+            or None if the record or settings have changed
+        '''
+        key = self.key(filename, directory, settings)
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        try:
+            channels = np.load(os.path.join(self.directory, key + '.npy'), mmap_mode='r')
+            annotation = np.load(os.path.join(self.directory, key + '_annotation.npz'))
+            signal = np.load(os.path.join(self.directory, key + '_signal.npy'), mmap_mode='r') \
+                if entry.get('signal_apart') else None
+            record = {
+                'annotation': Annotation(annotation['sample'], annotation['symbol']),
+                'fields': entry['fields']
+            }
+        except IOError:
+            utils.w_log("Cache entry {} could not be read".format(key))
+            self._remove(key)
+            return None
+        leads = entry.get('leads')
+        for row, (name, length) in enumerate(entry['channels']):
+            if leads is None:
+                record[name] = channels[row, :length]
+            else:
+                record[name] = channels[row * len(leads):(row + 1) * len(leads), :length]
+        if signal is not None:
+            record['signal'] = signal
+        if leads is not None:
+            record['leads'] = leads
+        if entry.get('lead') is not None:
+            record['lead'] = entry['lead']
+        entry['used'] = time.time()
+        return record
+
+    def put(self, filename, directory, settings, record):
+        '''
+        Stores a record dictionary (see read_data.read_record). Entries of the record with other settings are
+        kept (and left to the size cap), only entries of an older version of its files are replaced
+        '''
+        key = self.key(filename, directory, settings)
+        source = os.path.abspath(directory)
+        for old_key in [k for k, entry in self.index.items()
+                        if entry['record'] == filename and entry.get('directory') == source and
+                        entry.get('settings') == utils.config_hash(settings) and k != key]:
+            self._remove(old_key)
+
+        names = [name for name in CHANNELS if name in record]
+        derived = [name for name in names if name != 'signal']
+        # The int16 signal of a compact record is kept in its own file, stacking it with the float32
+        # derived channels would return it as float32
+        signal_apart = 'signal' in names and bool(derived) and \
+            np.asarray(record['signal']).dtype != np.result_type(*[record[name] for name in derived])
+        if signal_apart:
+            names = derived
+            np.save(os.path.join(self.directory, key + '_signal.npy'), np.asarray(record['signal']))
+        leads = record.get('leads')
+        rows = 1 if leads is None else len(leads)
+        width = max(np.shape(record[name])[-1] for name in names)
+        channels = np.zeros((len(names) * rows, width), dtype=np.result_type(*[record[name] for name in names]))
+        for row, name in enumerate(names):
+            channels[row * rows:(row + 1) * rows, :np.shape(record[name])[-1]] = record[name]
+        np.save(os.path.join(self.directory, key + '.npy'), channels)
+        np.savez(os.path.join(self.directory, key + '_annotation.npz'),
+                 sample=np.asarray(record['annotation'].sample),
+                 symbol=np.asarray(record['annotation'].symbol, dtype=str))
+
+        self.index[key] = {
+            'record': filename,
+            'directory': source,
+            'settings': utils.config_hash(settings),
+            'channels': [[name, np.shape(record[name])[-1]] for name in names],
+            'leads': leads,
+            'lead': record.get('lead'),
+            'signal_apart': signal_apart,
+            'fields': record['fields'],
+            'bytes': sum(os.path.getsize(os.path.join(self.directory, key + suffix))
+                         for suffix in ENTRY_FILES if os.path.exists(os.path.join(self.directory, key + suffix))),
+            'used': time.time()
+        }
+        self._evict()
+
+    def save(self):
+        '''
+        Writes the cache index (entry sizes and last use times) to disk
+        '''
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f)
+
+    def size(self):
+        '''
+        :return: The total size of the cached files in bytes
+        '''
+        return sum(entry['bytes'] for entry in self.index.values())
+
+    def _evict(self):
+        for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+            if self.size() <= self.max_bytes:
+                break
+            utils.v_log("Evicting {} from the record cache".format(key))
+            self._remove(key)
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        for suffix in ENTRY_FILES:
+            path = os.path.join(self.directory, key + suffix)
+            if os.path.exists(path):
+                os.remove(path)
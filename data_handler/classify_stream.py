@@ -0,0 +1,323 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+'''
+import time
+from collections import deque
+import numpy as np
+
+import config
+import utils
+from extract_features import moving_average
+
+
+class RingBuffer:
+    '''
+    Fixed size buffer addressed by the global index of each element.
+    Only the last `capacity` elements written are kept.
+    '''
+
+    def __init__(self, capacity, dtype=float):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.count = 0
+
+    def extend(self, values):
+        '''
+        Writes values to the end of the buffer (at most two slice copies)
+        :param values: 1D array, must not be larger than the capacity
+        '''
+        n = len(values)
+        if n > self.capacity:
+            raise ValueError("Cannot write {} values to a ring buffer of size {}".format(n, self.capacity))
+        start = self.count % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = values[:first]
+        self.buffer[:n - first] = values[first:]
+        self.count += n
+
+    def extend_last(self, values):
+        '''
+        Writes values of any length to the end of the buffer. Only the last capacity values of a
+        larger array are written, the ones before them are counted but never held
+        :param values: 1D array
+        '''
+        skipped = max(0, len(values) - self.capacity)
+        self.count += skipped
+        self.extend(values[skipped:])
+
+    def oldest(self):
+        '''
+        :return: The global index of the oldest element still held
+        '''
+        return max(0, self.count - self.capacity)
+
+    def take(self, index, length, out):
+        '''
+        Copies buffer[index:index + length] (global indexes) into out
+        :param index: global index of the first element
+        :param length: number of elements to copy
+        :param out: array to copy into
+        :return: out
+        '''
+        if index < self.oldest() or index + length > self.count:
+            raise IndexError("Elements {} to {} are not held in the ring buffer".format(index, index + length))
+        start = index % self.capacity
+        first = min(length, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:length] = self.buffer[:length - first]
+        return out
+
+
+def session_classifier(sess, X_placeholder, output_softmax):
+    '''
+    Wraps a tensorflow session so it can be used as the classify function of a StreamingClassifier
+    :param sess: session holding the network_model graph (see network_model.restore_model)
+    :param X_placeholder: the X placeholder returned by network_model.instantiate_model
+    :param output_softmax: the softmax output returned by network_model.instantiate_model
+    :return: function mapping windows (n, feature_size, 2) to probabilities (n, labels)
+    '''
+    def classify(windows):
+        return sess.run(output_softmax, feed_dict={X_placeholder: windows})
+    return classify
+
+
+class StreamingClassifier:
+    '''
+    Incrementally computes the difference and average_difference channels of a
+    stream of samples and classifies the beat windows as soon as they are complete.
+    The channels are computed in the same float type as the offline features (float32 for compact
+    datasets, see read_data.read_data), so the windows are identical to the ones
+    slice_based_on_annotations builds offline (cast to the float32 the model takes).
+    Every buffer is allocated up front, pushing a chunk only writes into them
+    '''
+
+    def __init__(self, classify, before=config.data['slice_before'], after=config.data['slice_after'],
+                 kernal_size=config.data['kernal_size'], hz=config.data['hz'], block_size=1024, max_batch=256,
+                 detector=None, dtype=None):
+        '''
+        :param classify: function mapping windows (n, before + after + 1, 2) to probabilities (n, labels),
+            or None to collect the complete windows with extract and classify them elsewhere
+        :param before: How many elements before the beat to slice (defaults to config.data['slice_before'])
+        :param after: How many elements after the beat to slice (defaults to config.data['slice_after'])
+        :param kernal_size: the averaging window size (defaults to config.data['kernal_size'])
+        :param hz: the sampling rate of the stream, used to report latency (defaults to config.data['hz'])
+        :param block_size: the largest number of samples processed at once. Chunks are split into blocks
+        :param max_batch: the largest number of windows sent to classify at once
+        :param detector: optional beat detector (see detect_peaks.OnlinePeakDetector). When given, the beats
+            it finds in each chunk are registered automatically instead of using add_beats
+        :param dtype: The float type the channels are computed in. Defaults to float32 when
+            config.data['compact'] is set, else float64, matching the offline features
+        '''
+        self.classify = classify
+        self.detector = detector
+        self.before = before
+        self.after = after
+        self.kernal_size = kernal_size
+        self.hz = hz
+        self.block_size = block_size
+        self.window = before + after + 1
+        if dtype is None:
+            dtype = np.float32 if config.data['compact'] else float
+        self.dtype = np.dtype(dtype)
+
+        # A beat is emitted at the latest at the end of the block in which it became complete,
+        # so the channels only need to hold one window plus one block (plus the averaging delay)
+        capacity = self.window + block_size + kernal_size
+        self.difference = RingBuffer(capacity, self.dtype)
+        self.average_difference = RingBuffer(capacity, self.dtype)
+        # average_signal starts with kernal_size + 1 zeros, so average_difference starts with kernal_size zeros
+        self.average_difference.extend(np.zeros(kernal_size, dtype=self.dtype))
+        self.last_average = self.dtype.type(0)
+
+        # Raw history needed to continue the difference and moving average over block boundaries
+        self.history = 2 * kernal_size
+        self.scratch = np.zeros(self.history + block_size, dtype=self.dtype)
+        self.samples = 0
+        # Outputs of one block, before they are copied into the ring buffers
+        self.block_differences = np.zeros(block_size, dtype=self.dtype)
+        self.block_averages = np.zeros(block_size, dtype=self.dtype)
+        self.block_average_differences = np.zeros(block_size, dtype=self.dtype)
+
+        self.pending = deque()
+        self.batch = np.zeros((max_batch, self.window, 2), dtype=np.float32)
+        self.batch_samples = np.zeros(max_batch, dtype=np.int64)
+        self.batch_arrivals = np.zeros(max_batch)
+        self.batch_size = 0
+        self.results = []
+        self.ready = []
+
+        self.latency_max = 0.0
+        self.latency_total = 0.0
+        self.classified = 0
+        # Windows handed out by extract without being classified here
+        self.extracted = 0
+        self.dropped = 0
+
+    @property
+    def lookahead(self):
+        '''
+        :return: The number of samples that must arrive after a beat (inclusive) before it can be classified
+        '''
+        return self.after + self.kernal_size + 1
+
+    def add_beats(self, samples):
+        '''
+        Registers beat positions (global sample indexes, ascending) to be sliced and classified
+        :param samples: iterable of beat sample indexes
+        '''
+        self.pending.extend(int(s) for s in samples)
+
+    def push(self, chunk):
+        '''
+        Adds a chunk of samples of any size to the stream. Every registered beat that is
+        complete after this chunk is classified before returning.
+        :param chunk: 1D array of samples, converted to dtype as each block is copied into the stream
+        :return: list of (sample, label_index, probabilities, latency_seconds) tuples
+        '''
+        arrival = time.perf_counter()
+        chunk = np.asarray(chunk)
+        self.results = []
+        if self.detector is not None:
+            self.add_beats(self.detector.update(chunk))
+        for i in range(0, len(chunk), self.block_size):
+            self._ingest(chunk[i:i + self.block_size])
+            self._collect(arrival)
+        self._flush()
+        return self.results
+
+    def extract(self, chunk):
+        '''
+        Adds a chunk of samples like push, but returns the complete beat windows instead of
+        classifying them (the classifier must be created with classify=None)
+        :param chunk: 1D array of samples
+        :return: (int array of beat samples, float32 array of windows (n, before + after + 1, 2))
+        '''
+        self.push(chunk)
+        ready, self.ready = self.ready, []
+        if not ready:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.window, 2), dtype=np.float32)
+        return np.concatenate([samples for samples, _ in ready]), np.concatenate([windows for _, windows in ready])
+
+    def _ingest(self, block):
+        '''
+        Extends the difference and average_difference channels with a block of samples
+        :param block: 1D array no larger than block_size
+        '''
+        n0 = self.samples
+        n1 = n0 + len(block)
+        # scratch holds the raw samples from global index base to n1
+        kept = min(n0, self.history)
+        base = n0 - kept
+        self.scratch[kept:kept + len(block)] = block
+        raw = self.scratch[:kept + len(block)]
+
+        # difference[j] = x[j + 1] - x[j]
+        if n1 > 1:
+            start = max(0, n0 - 1)
+            differences = self.block_differences[:n1 - 1 - start]
+            np.subtract(raw[start + 1 - base:], raw[start - base:-1], out=differences)
+            self.difference.extend(differences)
+
+        # average[g + 1] = mean(x[g:g + k]) for g >= k, once x[g + k] has arrived
+        k = self.kernal_size
+        low = max(k, n0 - k)
+        high = n1 - k
+        if high > low:
+            averages = moving_average(raw[low - base:high + k - 1 - base], k, self.dtype,
+                                      self.block_averages[:high - low])
+            differences = self.block_average_differences[:high - low]
+            differences[0] = averages[0] - self.last_average
+            np.subtract(averages[1:], averages[:-1], out=differences[1:])
+            self.average_difference.extend(differences)
+            self.last_average = averages[-1]
+
+        # Keep the last samples at the front of scratch for the next block
+        keep = min(n1, self.history)
+        self.scratch[:keep] = raw[len(raw) - keep:]
+        self.samples = n1
+
+    def _collect(self, arrival):
+        '''
+        Moves every complete pending beat into the classification batch
+        :param arrival: time at which the chunk completing these beats arrived
+        '''
+        while self.pending:
+            sample = self.pending[0]
+            start = sample - self.before
+            end = sample + self.after + 1
+            if end > self.difference.count or end > self.average_difference.count:
+                break
+            self.pending.popleft()
+            if start < 0:
+                utils.w_log("Beat at index {} has a window outside of signal range".format(sample))
+                self.dropped += 1
+                continue
+            if start < self.difference.oldest() or start < self.average_difference.oldest():
+                utils.w_log("Beat at index {} is no longer held in the stream buffers".format(sample))
+                self.dropped += 1
+                continue
+            row = self.batch[self.batch_size]
+            self.difference.take(start, self.window, row[:, 0])
+            self.average_difference.take(start, self.window, row[:, 1])
+            self.batch_samples[self.batch_size] = sample
+            self.batch_arrivals[self.batch_size] = arrival
+            self.batch_size += 1
+            if self.batch_size == len(self.batch):
+                self._flush()
+
+    def _flush(self):
+        '''
+        Classifies the windows waiting in the batch and records their latency
+        '''
+        if self.batch_size == 0:
+            return
+        if self.classify is None:
+            self.ready.append((self.batch_samples[:self.batch_size].copy(), self.batch[:self.batch_size].copy()))
+            self.extracted += self.batch_size
+            self.batch_size = 0
+            return
+        probabilities = np.asarray(self.classify(self.batch[:self.batch_size]))
+        labels = np.argmax(probabilities, axis=1)
+        done = time.perf_counter()
+        for i in range(self.batch_size):
+            latency = done - self.batch_arrivals[i]
+            self.latency_max = max(self.latency_max, latency)
+            self.latency_total += latency
+            self.results.append((int(self.batch_samples[i]), int(labels[i]), probabilities[i], latency))
+        self.classified += self.batch_size
+        self.batch_size = 0
+
+    def latency_report(self):
+        '''
+        :return: dict with the latency from the final sample of a beat to its label, over the beats classified
+            by this stream (extracted counts the windows returned by extract instead).
+            lookahead_samples/lookahead_seconds: the fixed delay from the beat to its final sample
+            max_seconds/mean_seconds: the processing delay measured from the arrival of the final sample
+        '''
+        return {
+            'beats': self.classified,
+            'extracted': self.extracted,
+            'dropped': self.dropped,
+            'lookahead_samples': self.lookahead,
+            'lookahead_seconds': self.lookahead / self.hz,
+            'max_seconds': self.latency_max,
+            'mean_seconds': self.latency_total / self.classified if self.classified else 0.0
+        }
+
+
+if __name__ == "__main__":
+    import tensorflow as tf
+    import read_data
+    from network_model import instantiate_model, restore_model
+
+    data = read_data.read_data("100")
+    X_placeholder, y_placeholder, output, output_soft = instantiate_model()
+    with tf.Session() as sess:
+        restore_model(sess)
+        stream = StreamingClassifier(session_classifier(sess, X_placeholder, output_soft), hz=data['fields']['fs'])
+        stream.add_beats(data['annotation'].sample)
+        for i in range(0, len(data['signal']), 360):
+            for sample, label, probabilities, latency in stream.push(data['signal'][i:i + 360]):
+                utils.log("Beat {} classified as {}".format(sample, config.data['annotations'][label]))
+        utils.log(stream.latency_report())
@@ -0,0 +1,216 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Single entry point for the project. Each subcommand imports only the modules it needs,
+so tensorflow, matplotlib, sklearn and wfdb are loaded by the commands that use them:
+
+    python cli.py build-dataset [--stream] [--compact] [--cache] [--leads MLII V1 [--combine]]
+    python cli.py train [--epochs 10]
+    python cli.py cross-validate --folds 5 [--workers 5]
+    python cli.py score --source /data/holter [--weights ../data/model.npz]
+    python cli.py plot --index 1500
+    python cli.py view --record 100 [--scores ../data/scores]
+    python cli.py replay --records 100 --speed 1 10 0 [--weights ../data/model.npz]
+    python cli.py multiplex --patients 32 --speed 1 [--weights ../data/model.npz]
+    python cli.py bench --scales 1 --no-model
+    python cli.py beat-index --labels N V
+    python cli.py check-imports
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+import config
+import utils
+
+# Statements that must stay light, and the packages each of them must not import
+IMPORT_BUDGET = [
+    ("from format_data import get_data", ['tensorflow', 'matplotlib']),
+    ("import cli", ['tensorflow', 'matplotlib', 'sklearn', 'wfdb', 'scipy'])
+]
+
+IMPORT_PROBE = '''
+import sys, time
+sys.path.insert(0, {directory!r})
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start)
+print(' '.join(sys.modules))
+'''
+
+
+def build_dataset(argv):
+    parser = argparse.ArgumentParser(prog='cli.py build-dataset', description="Build the training dataset")
+    parser.add_argument('--name', default=config.data['npy_name'])
+    parser.add_argument('--directory', default=config.data['npy_loc'])
+    parser.add_argument('--source', default=config.data['mit-bih'], help="The directory of the records")
+    parser.add_argument('--no-balance', action='store_true', help="Save every beat instead of a balanced sample")
+    parser.add_argument('--stream', action='store_true', help="Build out of core, one record at a time")
+    parser.add_argument('--leads', nargs='+', default=None, help="Build a dataset for each of these leads")
+    parser.add_argument('--combine', action='store_true', help="With --leads, build one multi lead dataset")
+    parser.add_argument('--compact', action='store_true', help="Read int16 samples and store float32 features")
+    parser.add_argument('--cache', action='store_true', help="Keep the preprocessed records in the record cache")
+    args = parser.parse_args(argv)
+
+    import format_data
+
+    if args.compact:
+        config.data['compact'] = True
+    if args.cache:
+        config.data['use_cache'] = True
+
+    balance = not args.no_balance
+    if args.leads:
+        datasets = format_data.setup_lead_data(args.name, args.directory, args.leads, args.combine, balance,
+                                               args.source)
+        for name, (X, y) in datasets.items():
+            utils.log("{}: {} beats".format(name, len(y)))
+    else:
+        X, y = format_data.setup_data(args.name, args.directory, balance, args.source,
+                                      args.stream or config.data['stream'])
+        utils.log("{}: {} beats".format(args.name, len(y)))
+
+
+def train(argv):
+    parser = argparse.ArgumentParser(prog='cli.py train', description="Train the network on the dataset")
+    parser.add_argument('--epochs', type=int, default=config.train['epochs'])
+    parser.add_argument('--learning-rate', type=float, default=config.train['learning_rate'])
+    parser.add_argument('--batch', type=int, default=config.train['batch'])
+    args = parser.parse_args(argv)
+
+    import train_network
+
+    train_network.train(args.epochs, args.learning_rate, args.batch)
+
+
+def cross_validate(argv):
+    import cross_validate as cv_module
+
+    cv_module.main(argv)
+
+
+def score(argv):
+    import score_records
+
+    score_records.main(argv)
+
+
+def replay(argv):
+    import replay_stream
+
+    replay_stream.main(argv)
+
+
+def multiplex(argv):
+    import multiplex_streams
+
+    multiplex_streams.main(argv)
+
+
+def plot(argv):
+    parser = argparse.ArgumentParser(prog='cli.py plot', description="Plot one beat of the dataset")
+    parser.add_argument('--index', type=int, default=0)
+    parser.add_argument('--name', default=config.data['npy_name'])
+    parser.add_argument('--directory', default=config.data['npy_loc'])
+    args = parser.parse_args(argv)
+
+    from format_data import get_data
+    from display_data import plot_feature
+
+    X, y = get_data(args.name, args.directory)
+    plot_feature(X[args.index], y[args.index])
+
+
+def view(argv):
+    parser = argparse.ArgumentParser(prog='cli.py view', description="Scroll through a whole record")
+    parser.add_argument('--record', required=True)
+    parser.add_argument('--source', default=config.data['mit-bih'], help="The directory of the records")
+    parser.add_argument('--lead', default=config.data['lead'])
+    parser.add_argument('--scores', default=None, help="Overlay the predictions saved by the score command")
+    parser.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    from read_data import read_record
+    from display_data import RecordViewer
+
+    predictions = None
+    if args.scores is not None:
+        from score_records import load_scores
+
+        predictions = load_scores(args.record, args.scores)
+    data = read_record(args.record, args.source, args.lead)
+    RecordViewer(data, predictions=predictions, lead=args.lead, seconds=args.seconds).show()
+
+
+def bench(argv):
+    import benchmark
+
+    benchmark.main(argv)
+
+
+def beat_index(argv):
+    parser = argparse.ArgumentParser(prog='cli.py beat-index', description="Build or load the beat index")
+    parser.add_argument('--source', default=config.data['mit-bih'], help="The directory of the records")
+    parser.add_argument('--path', default=config.data['beat_index'])
+    parser.add_argument('--labels', nargs='+', default=config.data['annotations'])
+    args = parser.parse_args(argv)
+
+    import beat_index as index_module
+
+    index = index_module.get_beat_index(args.source, args.path)
+    utils.log("{} annotations in {} records".format(len(index), len(index.records)))
+    utils.log("Beats per label: {}".format(index.label_counts(args.labels)))
+
+
+def import_budget(budget=IMPORT_BUDGET):
+    '''
+    Runs each statement of the budget in a fresh interpreter and finds which forbidden packages it imported
+    :param budget: list of (statement, list of packages it must not import)
+    :return: dict of statement -> (import seconds, sorted list of the forbidden packages it pulled in)
+    '''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for statement, forbidden in budget:
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE.format(
+            directory=directory, statement=statement)], cwd=directory).decode('utf-8').splitlines()
+        modules = output[-1].split()
+        pulled = sorted(package for package in forbidden
+                        if any(module == package or module.startswith(package + '.') for module in modules))
+        results[statement] = (float(output[-2]), pulled)
+    return results
+
+
+def check_imports(argv):
+    for statement, (seconds, pulled) in import_budget().items():
+        utils.log("{}: {:.3f} seconds".format(statement, seconds))
+        if pulled:
+            utils.w_log("'{}' imports {}".format(statement, ', '.join(pulled)))
+
+
+COMMANDS = {
+    'build-dataset': build_dataset,
+    'train': train,
+    'cross-validate': cross_validate,
+    'score': score,
+    'replay': replay,
+    'multiplex': multiplex,
+    'plot': plot,
+    'view': view,
+    'bench': bench,
+    'beat-index': beat_index,
+    'check-imports': check_imports
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ECG abnormal beat detection")
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('args', nargs=argparse.REMAINDER, help="Arguments of the command (see cli.py COMMAND -h)")
+    args = parser.parse_args(argv)
+    COMMANDS[args.command](args.args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,9 @@ code = {
     'timer': True,
     'verbose': False,
     'testing': False,
-    'warnings': True
+    'warnings': True,
+    'profile': True,
+    'profile_output': None
 }
 
 train = {
@@ -16,7 +18,12 @@ train = {
     'batch': 32,
     'learning_rate': 0.01,
     'dropout': 0.9,
-    'tensorboard': "../data/tensorboard"
+    'tensorboard': "../data/tensorboard",
+    'checkpoint': "../data/checkpoints",
+    'seed': None,
+    'prefetch': 4,
+    'eval_batch': 1024,
+    'balance_each_epoch': False
 }
 
 data = {
@@ -27,9 +34,21 @@ data = {
     'slice_before': 500,
     'slice_after': 200,
     'lead': 'MLII',
+    'leads': ['MLII', 'V1', 'V5'],
     'annotations': ['N', 'A'],
     'test_size': 0.1,
-    'kernal_size': 5
+    'kernal_size': 5,
+    'detect_beats': False,
+    'workers': 1,
+    'use_cache': False,
+    'cache': '../data/cache',
+    'beat_index': '../data/beat_index.npz',
+    'cache_size': 4 * 1024 ** 3,
+    'shard_size': 4096,
+    'balance': True,
+    'stream': False,
+    'compact': False,
+    'seed': None
 }
 
 processing = {
@@ -41,6 +60,42 @@ processing = {
     'average_difference': True
 }
 
+serve = {
+    'host': '127.0.0.1',
+    'port': 8500,
+    'max_batch': 128,
+    'max_wait': 0.005
+}
+
+score = {
+    'output': '../data/scores',
+    'chunk_seconds': 600,
+    'batch': 4096,
+    'workers': None
+}
+
+replay = {
+    'output': '../data/replay',
+    'speed': 1.0,
+    'chunk_seconds': 0.1,
+    'budget': 1.0,
+    'bins': 50
+}
+
+multiplex = {
+    'patients': 32,
+    'chunk_seconds': 0.1,
+    'inbox': 16,
+    'max_pending': 256
+}
+
+cv = {
+    'folds': 5,
+    'workers': None,
+    'threads': None,
+    'output': '../data/cross_validation.json'
+}
+
 network = {
     'feature_size': data['slice_before'] + data['slice_after'] + 1,
     'feature_channels': 2,
@@ -0,0 +1,218 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Patient wise k-fold cross validation. The rows of the dataset are split into folds by record
+(see format_data.get_record_folds), so no patient has beats on both sides of a fold, and every
+fold is trained in its own worker process. The workers open the same memory mapped dataset
+(see store_data.open_dataset), so the features are read from disk once and shared through the
+page cache instead of being copied into each process. Tensorflow in each worker is limited to
+its share of the cores, so the folds run side by side instead of fighting over every core.
+The workers are spawned (not forked) with the thread limits in their environment, so numpy
+and the libraries tensorflow links against read them when they are first imported:
+
+    python cross_validate.py --folds 5 --workers 1 --output sequential.json
+    python cross_validate.py --folds 5 --workers 5 --baseline sequential.json
+
+The report holds the metrics and seconds of every fold, the mean and spread of their accuracy,
+the confusion matrix summed over the folds and the wall time of the whole run, and the speedup
+over a baseline run (e.g. the same folds one after another with --workers 1) when one is given.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import config
+import utils
+from format_data import get_record_folds
+from store_data import open_dataset, dataset_exists
+
+# Thread pools of numpy and the libraries tensorflow links against, read when they are first imported
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+def fold_threads(workers, threads=None):
+    '''
+    :param workers: The number of folds trained at the same time
+    :param threads: The threads of each fold. Defaults to an equal share of the cores
+    :return: the number of threads each fold may use
+    '''
+    if threads is not None:
+        return threads
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def set_thread_environment(threads):
+    '''
+    Sets the thread limits in the environment of this process, and so of the processes it starts
+    :param threads: The number of threads, or the dict returned by an earlier call to restore those values
+    :return: dict of variable -> previous value (None when unset)
+    '''
+    previous = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+    for variable in THREAD_VARIABLES:
+        value = threads.get(variable) if isinstance(threads, dict) else threads
+        if value is None:
+            os.environ.pop(variable, None)
+        else:
+            os.environ[variable] = str(value)
+    return previous
+
+
+def train_fold(fold, train_indices, test_indices, name, directory, epochs, lr, batch, threads, run_name, seed):
+    '''
+    Trains and evaluates one fold, limiting tensorflow to threads. Run in a worker process started with
+    the thread limits in its environment (see cross_validate)
+    :param fold: The number of the fold
+    :param train_indices: The rows to train on
+    :param test_indices: The rows to evaluate on
+    :param name: The name of the dataset
+    :param directory: The directory holding the dataset
+    :param threads: The threads tensorflow may use for each op
+    :param run_name: The name of the fold's checkpoints and summaries
+    :return: the metrics of train_network.fit with the fold, its rows and seconds
+    '''
+    import tensorflow as tf
+    import train_network
+    from format_data import get_data
+
+    X_data, y_data = get_data(name, directory)
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                    inter_op_parallelism_threads=min(2, threads))
+    start = time.perf_counter()
+    metrics = train_network.fit(X_data, y_data, train_indices, test_indices, epochs, lr, batch, run_name,
+                                session_config, seed)
+    metrics.update({
+        'fold': fold,
+        'train_rows': len(train_indices),
+        'test_rows': len(test_indices),
+        'threads': threads,
+        'seconds': time.perf_counter() - start
+    })
+    utils.log("Fold {} accuracy {:.4f} in {:.1f} seconds".format(fold, metrics['accuracy'], metrics['seconds']))
+    return metrics
+
+
+def fold_records(folds, records, names):
+    '''
+    :param folds: list of (train_indices, test_indices) (see format_data.get_record_folds)
+    :param records: array of the record id of every row
+    :param names: list of record names by id
+    :return: list of the names of the test records of each fold
+    '''
+    return [[names[record] for record in np.unique(records[test])] for _, test in folds]
+
+
+def summarise(results, wall_seconds, baseline_seconds=None):
+    '''
+    :param results: list of the metrics of every fold (see train_fold)
+    :param wall_seconds: The seconds the whole run took
+    :param baseline_seconds: Optional wall seconds of a baseline run of the same folds (e.g. with --workers 1)
+    :return: dict report
+    '''
+    accuracy = np.array([result['accuracy'] for result in results], dtype=float)
+    confusion = np.sum([result['confusion'] for result in results], axis=0)
+    totals = confusion.sum(axis=1)
+    return {
+        'folds': results,
+        'accuracy_mean': float(accuracy.mean()),
+        'accuracy_std': float(accuracy.std()),
+        'confusion': confusion.tolist(),
+        # Of the beats of each label, the fraction predicted as that label
+        'recall': (np.diag(confusion) / np.maximum(totals, 1)).tolist(),
+        'labels': config.data['annotations'],
+        'wall_seconds': wall_seconds,
+        'baseline_seconds': baseline_seconds,
+        'speedup': baseline_seconds / wall_seconds if baseline_seconds and wall_seconds else None
+    }
+
+
+def cross_validate(name=config.data['npy_name'], directory=config.data['npy_loc'], folds=config.cv['folds'],
+                   workers=config.cv['workers'], threads=config.cv['threads'], epochs=config.train['epochs'],
+                   lr=config.train['learning_rate'], batch=config.train['batch'], seed=config.data['seed'],
+                   output=config.cv['output'], baseline=None):
+    '''
+    Trains and evaluates the network on every patient wise fold of a dataset saved by format_data.setup_data
+    :param name: The name of the dataset
+    :param directory: The directory holding the dataset
+    :param folds: The number of folds (defaults to config.cv['folds'])
+    :param workers: The number of folds trained at the same time. Defaults to one per fold, at most one per core
+    :param threads: The threads of each fold (see fold_threads)
+    :param seed: The seed of the folds and of training
+    :param output: The json file the report is written to (None to not write it)
+    :param baseline: Optional report of an earlier run of the same folds (e.g. with workers=1)
+        to measure the speedup against
+    :return: dict report (see summarise)
+    '''
+    if not dataset_exists(name, directory):
+        raise ValueError("Dataset {} has no record of each row, rebuild it with format_data.setup_data".format(name))
+    _, _, provenance, manifest = open_dataset(name, directory)
+    records = np.asarray(provenance[:, 0])
+    splits = get_record_folds(records, folds, seed)
+    tested = fold_records(splits, records, [record['name'] for record in manifest['records']])
+    workers = workers or min(folds, os.cpu_count() or 1)
+    threads = fold_threads(workers, threads)
+    utils.log("Cross validating {} folds of {} records, {} at a time with {} threads each".format(
+        folds, len(np.unique(records)), workers, threads))
+
+    jobs = [(fold, train_indices, test_indices, name, directory, epochs, lr, batch, threads,
+             "{}/fold_{}".format(config.train['name'], fold), seed)
+            for fold, (train_indices, test_indices) in enumerate(splits)]
+    baseline_seconds = None
+    if baseline is not None:
+        with open(baseline) as f:
+            baseline_seconds = json.load(f)['wall_seconds']
+
+    start = time.perf_counter()
+    # Spawned workers read the limits when they import numpy and tensorflow. In this process numpy
+    # is already loaded, so a single worker is only limited by the tensorflow session
+    previous = set_thread_environment(threads)
+    try:
+        if workers <= 1:
+            results = [train_fold(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results = list(executor.map(train_fold, *zip(*jobs)))
+    finally:
+        set_thread_environment(previous)
+    for result, records_tested in zip(results, tested):
+        result['test_records'] = records_tested
+    report = summarise(results, time.perf_counter() - start, baseline_seconds)
+    utils.log("Accuracy {accuracy_mean:.4f} +/- {accuracy_std:.4f} in {wall_seconds:.1f} seconds".format(**report))
+    if report['speedup'] is not None:
+        utils.log("{speedup:.2f}x faster than the baseline ({baseline_seconds:.1f} seconds)".format(**report))
+
+    if output is not None:
+        if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Patient wise cross validation, one worker process per fold")
+    parser.add_argument('--name', default=config.data['npy_name'])
+    parser.add_argument('--directory', default=config.data['npy_loc'])
+    parser.add_argument('--folds', type=int, default=config.cv['folds'])
+    parser.add_argument('--workers', type=int, default=config.cv['workers'],
+                        help="Folds trained at the same time, 1 to train them one after another")
+    parser.add_argument('--threads', type=int, default=config.cv['threads'], help="Tensorflow threads of each fold")
+    parser.add_argument('--epochs', type=int, default=config.train['epochs'])
+    parser.add_argument('--learning-rate', type=float, default=config.train['learning_rate'])
+    parser.add_argument('--batch', type=int, default=config.train['batch'])
+    parser.add_argument('--seed', type=int, default=config.data['seed'])
+    parser.add_argument('--output', default=config.cv['output'])
+    parser.add_argument('--baseline', default=None,
+                        help="The report of an earlier run (e.g. --workers 1) to measure the speedup against")
+    args = parser.parse_args(argv)
+
+    return cross_validate(args.name, args.directory, args.folds, args.workers, args.threads, args.epochs,
+                          args.learning_rate, args.batch, args.seed, args.output, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
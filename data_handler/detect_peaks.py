@@ -0,0 +1,275 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Online R-peak detector based on Pan & Tompkins (1985): band pass, derivative,
+squaring and moving window integration followed by adaptive thresholds.
+Every stage keeps a constant amount of state, so samples can be pushed in
+chunks of any size and beat indexes come out as soon as they are confirmed.
+'''
+import time
+import numpy as np
+from scipy import signal as sp_signal
+
+import config
+import utils
+from classify_stream import RingBuffer
+from read_data import Annotation
+
+# Annotation symbols that mark a beat (https://www.physionet.org/physiobank/annotations.shtml)
+BEAT_SYMBOLS = ['N', 'L', 'R', 'B', 'A', 'a', 'J', 'S', 'V', 'r', 'F', 'e', 'j', 'n', 'E', '/', 'f', 'Q', '?']
+
+
+class OnlinePeakDetector:
+    '''
+    Streaming QRS detector. Push samples with update and receive the global
+    indexes of the R-peaks confirmed by that chunk.
+    '''
+
+    def __init__(self, fs=360, block_size=1024, learning_time=2.0, refractory_time=0.2,
+                 integration_time=0.15, search_time=0.25):
+        '''
+        :param fs: The sampling rate of the signal
+        :param block_size: the largest number of samples processed at once. Chunks are split into blocks
+        :param learning_time: seconds of signal used to initialise the thresholds
+        :param refractory_time: minimum seconds between two beats
+        :param integration_time: seconds covered by the moving window integrator
+        :param search_time: seconds before the integrator peak searched for the R-peak
+        '''
+        self.fs = fs
+        self.block_size = block_size
+        self.learning = int(learning_time * fs)
+        self.refractory = int(refractory_time * fs)
+        self.search = int(search_time * fs)
+
+        nyquist = fs / 2.0
+        self.bandpass = sp_signal.butter(1, [5 / nyquist, 15 / nyquist], btype='band')
+        self.bandpass_state = np.zeros(2)
+        self.derivative = np.array([1, 2, 0, -2, -1]) * (fs / 8.0)
+        self.derivative_state = np.zeros(4)
+        integration = max(1, int(integration_time * fs))
+        self.integrator = np.ones(integration) / integration
+        self.integrator_state = np.zeros(integration - 1)
+
+        # Last two integrated values, to find local maxima across block boundaries
+        self.previous = np.zeros(2)
+        self.raw = RingBuffer(self.search + block_size + 2)
+        self.samples = 0
+
+        self.learning_max = 0.0
+        self.learning_total = 0.0
+        self.learning_candidates = []
+        self.signal_peak = 0.0
+        self.noise_peak = 0.0
+        self.threshold = None
+
+        # Best candidate (integrator index, value, R-peak index) waiting out the refractory period
+        self.candidate = None
+        self.found = []
+
+    def update(self, chunk):
+        '''
+        Adds a chunk of samples to the detector
+        :param chunk: 1D array of samples
+        :return: numpy array of the R-peak indexes confirmed by this chunk
+        '''
+        chunk = np.asarray(chunk, dtype=float)
+        self.found = []
+        for i in range(0, len(chunk), self.block_size):
+            self._process(chunk[i:i + self.block_size])
+        return np.array(self.found, dtype=np.int64)
+
+    def flush(self):
+        '''
+        Confirms the beat still waiting out the refractory period (use at the end of a record)
+        :return: numpy array of the remaining R-peak index
+        '''
+        self.found = []
+        if self.candidate is not None:
+            self.found.append(self.candidate[2])
+            self.candidate = None
+        return np.array(self.found, dtype=np.int64)
+
+    def _process(self, block):
+        start = self.samples
+        self.raw.extend(block)
+        self.samples += len(block)
+
+        filtered, self.bandpass_state = sp_signal.lfilter(*self.bandpass, block, zi=self.bandpass_state)
+        derived, self.derivative_state = sp_signal.lfilter(self.derivative, 1, filtered, zi=self.derivative_state)
+        integrated, self.integrator_state = sp_signal.lfilter(self.integrator, 1, derived ** 2,
+                                                              zi=self.integrator_state)
+
+        # Local maxima of the integrated signal, one sample late because the next value is needed
+        extended = np.concatenate((self.previous, integrated))
+        centre = extended[1:-1]
+        peaks = np.nonzero((centre > extended[:-2]) & (centre >= extended[2:]))[0]
+        for index in peaks:
+            index = int(index)
+            position = start - 1 + index
+            if position > 0:
+                self._add_candidate(position, centre[index])
+        self.previous = extended[-2:]
+
+        if self.threshold is None:
+            learned = integrated[:max(0, self.learning - start)]
+            if len(learned):
+                self.learning_max = max(self.learning_max, learned.max())
+                self.learning_total += learned.sum()
+            if self.samples >= self.learning:
+                self._finish_learning()
+
+        if self.candidate is not None and self.samples - 1 >= self.candidate[0] + self.refractory:
+            self.found.append(self.candidate[2])
+            self.candidate = None
+
+    def _locate_r_peak(self, position):
+        '''
+        :param position: index of an integrated signal peak
+        :return: The index of the largest deflection of the raw signal in the search window before position
+        '''
+        start = max(position - self.search, self.raw.oldest())
+        length = position + 1 - start
+        window = self.raw.take(start, length, np.empty(length))
+        return start + int(np.argmax(np.abs(window - window.mean())))
+
+    def _add_candidate(self, position, value):
+        candidate = (position, value, self._locate_r_peak(position))
+        if self.threshold is None:
+            self.learning_candidates.append(candidate)
+        else:
+            self._classify_candidate(candidate)
+
+    def _finish_learning(self):
+        self.signal_peak = 0.25 * self.learning_max
+        self.noise_peak = 0.5 * self.learning_total / max(1, self.learning)
+        self._update_threshold()
+        candidates, self.learning_candidates = self.learning_candidates, []
+        for candidate in candidates:
+            self._classify_candidate(candidate)
+
+    def _update_threshold(self):
+        self.threshold = self.noise_peak + 0.25 * (self.signal_peak - self.noise_peak)
+
+    def _classify_candidate(self, candidate):
+        position, value, r_peak = candidate
+        if value > self.threshold:
+            if self.candidate is not None and position - self.candidate[0] < self.refractory:
+                if value > self.candidate[1]:
+                    self.candidate = candidate
+            else:
+                if self.candidate is not None:
+                    self.found.append(self.candidate[2])
+                self.candidate = candidate
+            self.signal_peak = 0.125 * value + 0.875 * self.signal_peak
+        else:
+            self.noise_peak = 0.125 * value + 0.875 * self.noise_peak
+        self._update_threshold()
+
+
+def detect_peaks(signal, fs=360, chunk_size=4096):
+    '''
+    Runs the online detector over a whole signal
+    :param signal: 1D array of samples
+    :param fs: The sampling rate of the signal
+    :param chunk_size: the number of samples pushed at a time
+    :return: numpy array of R-peak indexes
+    '''
+    detector = OnlinePeakDetector(fs)
+    peaks = [detector.update(signal[i:i + chunk_size]) for i in range(0, len(signal), chunk_size)]
+    peaks.append(detector.flush())
+    return np.concatenate(peaks)
+
+
+def match_peaks(detected, reference, tolerance):
+    '''
+    Pairs detected beats with the nearest reference beat
+    :param detected: sorted array of detected beat indexes
+    :param reference: sorted array of reference beat indexes
+    :param tolerance: the largest distance (in samples) counted as a match
+    :return: array of the matched reference index for each detected beat (-1 if no match)
+    '''
+    detected = np.asarray(detected, dtype=np.int64)
+    reference = np.asarray(reference, dtype=np.int64)
+    matches = np.full(len(detected), -1, dtype=np.int64)
+    if len(reference) == 0 or len(detected) == 0:
+        return matches
+    right = np.clip(np.searchsorted(reference, detected), 0, len(reference) - 1)
+    left = np.clip(right - 1, 0, len(reference) - 1)
+    nearest = np.where(np.abs(reference[left] - detected) <= np.abs(reference[right] - detected), left, right)
+    within = np.abs(reference[nearest] - detected) <= tolerance
+    matches[within] = nearest[within]
+    return matches
+
+
+def detected_annotation(data, fs=360, tolerance=0.15):
+    '''
+    Builds an annotation from detected R-peaks so it can be passed to the same slicing code
+    as the reference annotations (see format_data.slice_based_on_annotations).
+    Detected beats take the symbol of the matching reference beat when the data has one,
+    otherwise they are labelled 'Q' (unclassifiable)
+    :param data: dictionary object from read_data
+    :param fs: The sampling rate of the signal
+    :param tolerance: the largest distance (in seconds) between a detected and reference beat
+    :return: Annotation(sample, symbol)
+    '''
+    peaks = detect_peaks(data['signal'], fs)
+    symbols = np.full(len(peaks), 'Q', dtype=object)
+    if data.get('annotation') is not None:
+        reference, reference_symbols = beat_annotations(data['annotation'])
+        matches = match_peaks(peaks, reference, int(tolerance * fs))
+        symbols[matches >= 0] = reference_symbols[matches[matches >= 0]]
+    return Annotation(peaks, list(symbols))
+
+
+def beat_annotations(annotation):
+    '''
+    :param annotation: wfdb annotation (or read_data.Annotation)
+    :return: (sample, symbol) arrays of just the beat annotations
+    '''
+    symbols = np.asarray(annotation.symbol, dtype=object)
+    beats = np.isin(symbols, BEAT_SYMBOLS)
+    return np.asarray(annotation.sample)[beats], symbols[beats]
+
+
+@utils.timer()
+def benchmark(directory=config.data['mit-bih'], chunk_size=360, tolerance=0.15):
+    '''
+    Measures detector throughput (samples/sec) and agreement with the MIT-BIH reference annotations
+    :param directory: the location of the data. Defaults to configuration mit-bih
+    :param chunk_size: the number of samples pushed at a time
+    :param tolerance: the largest distance (in seconds) counted as a match
+    :return: dict of totals {samples, seconds, samples_per_second, sensitivity, positive_predictivity}
+    '''
+    from read_data import read_all_data
+
+    samples, seconds, true_positive, detected_total, reference_total = 0, 0.0, 0, 0, 0
+    for name, data in sorted(read_all_data(directory).items()):
+        fs = data['fields']['fs']
+        start = time.perf_counter()
+        peaks = detect_peaks(data['signal'], fs, chunk_size)
+        elapsed = time.perf_counter() - start
+
+        reference, _ = beat_annotations(data['annotation'])
+        matches = match_peaks(peaks, reference, int(tolerance * fs))
+        matched = len(np.unique(matches[matches >= 0]))
+        utils.log("Record {}: {} detected, {} reference, {} matched, {:.0f} samples/sec".format(
+            name, len(peaks), len(reference), matched, len(data['signal']) / elapsed))
+
+        samples += len(data['signal'])
+        seconds += elapsed
+        true_positive += matched
+        detected_total += len(peaks)
+        reference_total += len(reference)
+
+    return {
+        'samples': samples,
+        'seconds': seconds,
+        'samples_per_second': samples / seconds if seconds else 0.0,
+        'sensitivity': true_positive / reference_total if reference_total else 0.0,
+        'positive_predictivity': true_positive / detected_total if detected_total else 0.0
+    }
+
+
+if __name__ == "__main__":
+    utils.log(benchmark())
@@ -2,23 +2,425 @@
 ecg_realtime_abnormal_detection
 Created 1/08/18 by Matthew Lee
 '''
+import time
+from collections import deque
 from format_data import get_data
 import config
-import matplotlib.pyplot as plt
 import numpy as np
-from time import sleep
+
+# Colours of the annotation and prediction markers, by label index (other symbols are drawn in grey)
+LABEL_COLOURS = ['tab:green', 'tab:red', 'tab:orange', 'tab:purple', 'tab:brown']
 
 
 def plot_feature(X, y):
+    import matplotlib.pyplot as plt
+
     label = config.data['annotations'][np.argmax(y)]
-    plt.plot([x[0] for x in X], label="Difference")
-    plt.plot([x[1] for x in X], label="Average Difference")
+    X = np.asarray(X)
+    plt.plot(X[:, 0], label="Difference")
+    plt.plot(X[:, 1], label="Average Difference")
     plt.title(label)
     plt.legend(bbox_to_anchor=(1, 1),
                bbox_transform=plt.gcf().transFigure)
     plt.show()
 
 
+class MinMaxPyramid:
+    '''
+    Min/max decimation of a signal at every power of factor. A view of any range is read from the
+    coarsest level that still has at least `points` buckets in it, so the number of points drawn stays
+    between points and factor * points at any zoom while every peak of the signal stays visible.
+    '''
+
+    def __init__(self, signal, factor=4, points=600):
+        '''
+        :param signal: 1D array
+        :param factor: The number of buckets of a level merged into one bucket of the next level
+        :param points: The smallest number of buckets a view is drawn with
+        '''
+        self.signal = np.asarray(signal)
+        self.factor = factor
+        self.points = points
+        # Level 0 is the signal itself, level i holds the min and max of every factor ** i samples
+        self.levels = [(self.signal, self.signal)]
+        mins, maxs = self.signal, self.signal
+        while len(mins) > points:
+            full = len(mins) // factor * factor
+            next_mins = mins[:full].reshape(-1, factor).min(axis=1)
+            next_maxs = maxs[:full].reshape(-1, factor).max(axis=1)
+            if full < len(mins):
+                next_mins = np.append(next_mins, mins[full:].min())
+                next_maxs = np.append(next_maxs, maxs[full:].max())
+            mins, maxs = next_mins, next_maxs
+            self.levels.append((mins, maxs))
+
+    def __len__(self):
+        return len(self.signal)
+
+    def limits(self):
+        '''
+        :return: (min, max) of the whole signal
+        '''
+        mins, maxs = self.levels[-1]
+        return (float(mins.min()), float(maxs.max())) if len(mins) else (0.0, 1.0)
+
+    def level(self, start, stop):
+        '''
+        :return: The coarsest level with at least `points` buckets between start and stop
+        '''
+        span = max(1, stop - start)
+        level = 0
+        while level + 1 < len(self.levels) and self.factor ** (level + 1) * self.points <= span:
+            level += 1
+        return level
+
+    def view(self, start, stop):
+        '''
+        :param start: first sample of the range
+        :param stop: end of the range (exclusive)
+        :return: (x, y) sample positions and values to draw. Decimated ranges alternate the min and max
+            of each bucket, both at its centre
+        '''
+        start, stop = max(0, int(start)), min(len(self.signal), int(stop))
+        level = self.level(start, stop)
+        if level == 0:
+            return np.arange(start, stop), self.signal[start:stop]
+        bucket = self.factor ** level
+        first, last = start // bucket, -(-stop // bucket)
+        mins, maxs = self.levels[level]
+        mins, maxs = mins[first:last], maxs[first:last]
+        x = np.repeat(np.arange(first, first + len(mins)) * bucket + (bucket - 1) / 2.0, 2)
+        y = np.empty(2 * len(mins), dtype=np.result_type(mins.dtype, maxs.dtype))
+        y[0::2] = mins
+        y[1::2] = maxs
+        return x, y
+
+
+class RecordViewer:
+    '''
+    Scrollable view of a whole record: one row per channel, the annotation symbols and the model
+    predictions as markers. The x axis shows seconds from the start of the view, so scrolling only
+    changes animated artists and is redrawn by blitting them over a cached background.
+
+        left/right  scroll by half a view       up/down  zoom in/out
+        home/end    first/last view             mouse wheel  zoom
+    '''
+
+    def __init__(self, data, channels=('signal', 'difference', 'average_difference'), predictions=None,
+                 lead=config.data['lead'], seconds=10.0, points=600, annotations=config.data['annotations']):
+        '''
+        :param data: data dictionary (see read_data.read_record and format_data.preprocess_record)
+        :param channels: The channels of data to draw, one row each (missing channels are skipped)
+        :param predictions: Optional dict with 'sample' and 'label' arrays (see score_records.load_scores),
+            and 'fs' if the predictions were made at another sampling rate than data
+        :param lead: The lead to draw of a record read with several leads
+        :param seconds: The length of the first view
+        :param points: The smallest number of points drawn per channel (see MinMaxPyramid)
+        :param annotations: The label symbols, used to colour annotations and predictions
+        '''
+        import matplotlib.pyplot as plt
+        from read_data import select_lead
+
+        data = select_lead(data, lead)
+        if data is None:
+            raise KeyError("Record does not hold lead {}".format(lead))
+        self.fs = float(data['fields']['fs'])
+        self.channels = [name for name in channels if name in data]
+        self.pyramids = [MinMaxPyramid(data[name], points=points) for name in self.channels]
+        self.length = max(len(pyramid) for pyramid in self.pyramids)
+        self.annotations = annotations
+        self.span = int(seconds * self.fs)
+        self.start = 0
+        self.redraws = []
+
+        annotation = data.get('annotation')
+        self.beat_samples = np.asarray(annotation.sample, dtype=np.int64) if annotation is not None else \
+            np.empty(0, dtype=np.int64)
+        self.beat_symbols = np.asarray(annotation.symbol) if annotation is not None else np.empty(0, dtype=str)
+        if predictions is not None:
+            samples = np.asarray(predictions['sample'], dtype=np.int64)
+            fs = float(predictions.get('fs', self.fs))
+            if fs != self.fs:
+                import resample_data
+
+                samples = resample_data.resample_samples(samples, fs, self.fs, self.length)
+            self.predicted_samples, self.predicted_labels = samples, np.asarray(predictions['label'])
+        else:
+            self.predicted_samples, self.predicted_labels = None, None
+
+        self.figure, axes = plt.subplots(len(self.channels), 1, sharex=True, squeeze=False,
+                                         figsize=(14, 2.5 * len(self.channels)))
+        self.axes = axes[:, 0]
+        self.lines = []
+        for ax, name, pyramid in zip(self.axes, self.channels, self.pyramids):
+            low, high = pyramid.limits()
+            margin = 0.05 * (high - low) or 1.0
+            ax.set_ylim(low - margin, high + margin)
+            ax.set_ylabel(name)
+            line, = ax.plot([], [], linewidth=0.7, animated=True)
+            self.lines.append(line)
+        top = self.axes[0]
+        low, high = top.get_ylim()
+        self.marker_y = (high, high - 0.08 * (high - low))
+        self.markers = [top.plot([], [], linestyle='', marker='v', markersize=5, color=colour, animated=True,
+                                 label=symbol)[0]
+                        for symbol, colour in zip(annotations + ['other'],
+                                                  LABEL_COLOURS[:len(annotations)] + ['tab:grey'])]
+        self.prediction_markers = [top.plot([], [], linestyle='', marker='^', markersize=5, color=colour,
+                                            animated=True, label="predicted " + symbol)[0]
+                                   for symbol, colour in zip(annotations, LABEL_COLOURS)] \
+            if self.predicted_samples is not None else []
+        self.title = top.text(0.0, 1.02, '', transform=top.transAxes, animated=True)
+        top.legend(loc='upper right', fontsize='small', ncol=2)
+        self.axes[-1].set_xlabel("seconds from view start")
+        self.background = None
+        self._set_span(self.span)
+
+        canvas = self.figure.canvas
+        canvas.mpl_connect('draw_event', self._on_draw)
+        canvas.mpl_connect('key_press_event', self._on_key)
+        canvas.mpl_connect('scroll_event', self._on_scroll)
+
+    def artists(self):
+        return self.lines + self.markers + self.prediction_markers + [self.title]
+
+    def _set_span(self, span):
+        self.span = int(min(max(span, 2 * self.fs / 10.0), self.length))
+        self.axes[0].set_xlim(0, self.span / self.fs)
+        self.background = None
+
+    def _update(self):
+        '''
+        Sets the data of every animated artist for the current view
+        '''
+        self.start = int(min(max(0, self.start), max(0, self.length - self.span)))
+        stop = self.start + self.span
+        for line, pyramid in zip(self.lines, self.pyramids):
+            x, y = pyramid.view(self.start, stop)
+            line.set_data((x - self.start) / self.fs, y)
+
+        first, last = np.searchsorted(self.beat_samples, [self.start, stop])
+        samples, symbols = self.beat_samples[first:last], self.beat_symbols[first:last]
+        other = np.ones(len(samples), dtype=bool)
+        for marker, symbol in zip(self.markers, self.annotations):
+            shown = symbols == symbol
+            other &= ~shown
+            marker.set_data((samples[shown] - self.start) / self.fs, np.full(shown.sum(), self.marker_y[0]))
+        self.markers[-1].set_data((samples[other] - self.start) / self.fs, np.full(other.sum(), self.marker_y[0]))
+
+        if self.predicted_samples is not None:
+            first, last = np.searchsorted(self.predicted_samples, [self.start, stop])
+            samples, labels = self.predicted_samples[first:last], self.predicted_labels[first:last]
+            for label, marker in enumerate(self.prediction_markers):
+                shown = labels == label
+                marker.set_data((samples[shown] - self.start) / self.fs, np.full(shown.sum(), self.marker_y[1]))
+        self.title.set_text("{:.1f}s to {:.1f}s of {:.1f}s".format(self.start / self.fs, stop / self.fs,
+                                                                 self.length / self.fs))
+
+    def _on_draw(self, event):
+        # Full redraws (first show, resize, zoom) refresh the background the animated artists are blitted on
+        self.background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+        self._blit()
+
+    def _blit(self):
+        canvas = self.figure.canvas
+        start = time.perf_counter()
+        canvas.restore_region(self.background)
+        self._update()
+        for artist in self.artists():
+            artist.axes.draw_artist(artist)
+        canvas.blit(self.figure.bbox)
+        self.redraws.append(time.perf_counter() - start)
+
+    def refresh(self):
+        '''
+        Redraws the animated artists, or the whole figure if the background is out of date
+        '''
+        if self.background is None:
+            self.figure.canvas.draw()
+        else:
+            self._blit()
+
+    def scroll(self, seconds):
+        self.start += int(seconds * self.fs)
+        self.refresh()
+
+    def zoom(self, factor):
+        '''
+        :param factor: The view length is multiplied by factor, about the centre of the view
+        '''
+        centre = self.start + self.span // 2
+        self._set_span(self.span * factor)
+        self.start = centre - self.span // 2
+        self.refresh()
+
+    def _on_key(self, event):
+        half = self.span / self.fs / 2.0
+        actions = {
+            'right': lambda: self.scroll(half),
+            'left': lambda: self.scroll(-half),
+            'up': lambda: self.zoom(0.5),
+            'down': lambda: self.zoom(2.0),
+            'home': lambda: self.scroll(-self.length / self.fs),
+            'end': lambda: self.scroll(self.length / self.fs)
+        }
+        if event.key in actions:
+            actions[event.key]()
+
+    def _on_scroll(self, event):
+        self.zoom(0.8 if event.button == 'up' else 1.25)
+
+    def show(self):
+        import matplotlib.pyplot as plt
+
+        plt.show()
+
+    def report(self):
+        '''
+        :return: dict with the number and the mean and max seconds of the blitted redraws
+        '''
+        redraws = np.asarray(self.redraws)
+        return {
+            'redraws': len(redraws),
+            'mean_seconds': float(redraws.mean()) if len(redraws) else 0.0,
+            'max_seconds': float(redraws.max()) if len(redraws) else 0.0
+        }
+
+
+class LiveMonitor:
+    '''
+    Sweeping display of a live stream. Incoming chunks only write to ring buffers, and each animation
+    frame draws the last `seconds` of the stream decimated to a fixed number of points, so the cost
+    of a frame does not depend on how many samples arrived since the previous one. Frames that start
+    late are counted, samples are never dropped.
+    '''
+
+    def __init__(self, hz=config.data['hz'], seconds=10.0, points=1000, fps=25, classifier=None,
+                 annotations=config.data['annotations']):
+        '''
+        :param hz: The sampling rate of the stream
+        :param seconds: The length of stream on screen
+        :param points: The number of min/max buckets drawn
+        :param fps: The frame rate of the animation
+        :param classifier: Optional classify_stream.StreamingClassifier. Chunks are pushed to it and its
+            labels drawn as markers
+        :param annotations: The label symbols of the classifier
+        '''
+        from classify_stream import RingBuffer
+
+        self.hz = hz
+        self.span = int(seconds * hz)
+        self.points = min(points, self.span)
+        self.interval = 1.0 / fps
+        self.classifier = classifier
+        self.annotations = annotations
+        self.buffer = RingBuffer(self.span)
+        self.window = np.zeros(self.span)
+        self.beats = deque()
+        self.frames = 0
+        self.late_frames = 0
+        self.last_frame = None
+        self.figure = None
+
+    def push(self, chunk):
+        '''
+        Adds a chunk of samples to the stream (and classifies it when a classifier is set)
+        :param chunk: 1D array of samples, any size
+        '''
+        chunk = np.asarray(chunk, dtype=float)
+        # Only the last span samples of a large chunk fit the buffer, the ones before it are skipped over
+        self.buffer.extend_last(chunk)
+        if self.classifier is not None:
+            for sample, label, _, _ in self.classifier.push(chunk):
+                self.beats.append((sample, label))
+        while self.beats and self.beats[0][0] < self.buffer.count - self.span:
+            self.beats.popleft()
+
+    def frame(self):
+        '''
+        :return: (x, y) of the decimated stream on screen, in seconds from the left of the screen
+        '''
+        held = min(self.buffer.count, self.span)
+        self.buffer.take(self.buffer.count - held, held, self.window[self.span - held:])
+        self.window[:self.span - held] = 0
+        bucket = self.span // self.points
+        used = bucket * self.points
+        buckets = self.window[self.span - used:].reshape(self.points, bucket)
+        x = np.repeat((np.arange(self.points) * bucket + (bucket - 1) / 2.0 + self.span - used) / self.hz, 2)
+        y = np.empty(2 * self.points)
+        y[0::2] = buckets.min(axis=1)
+        y[1::2] = buckets.max(axis=1)
+        return x, y
+
+    def _draw(self, _):
+        now = time.perf_counter()
+        if self.last_frame is not None and now - self.last_frame > 1.5 * self.interval:
+            self.late_frames += 1
+        self.last_frame = now
+        if self.source is not None:
+            # Everything that should have arrived by now is pushed, however late the frame is
+            due = int((now - self.started) * self.hz * self.speed)
+            while self.pushed < due:
+                chunk = next(self.source, None)
+                if chunk is None:
+                    self.source = None
+                    break
+                self.push(chunk)
+                self.pushed += len(chunk)
+        x, y = self.frame()
+        self.line.set_data(x, y)
+        if len(y):
+            low, high = self.ax.get_ylim()
+            if y.min() < low or y.max() > high:
+                self.ax.set_ylim(min(low, y.min()), max(high, y.max()))
+                self.figure.canvas.draw_idle()
+        left = self.buffer.count - self.span
+        for label, marker in enumerate(self.markers):
+            samples = np.array([sample for sample, beat_label in self.beats if beat_label == label], dtype=float)
+            marker.set_data((samples - left) / self.hz, np.full(len(samples), self.ax.get_ylim()[1]))
+        self.frames += 1
+        return [self.line] + self.markers
+
+    def run(self, source=None, speed=1.0, frames=None):
+        '''
+        Animates the stream with blitting
+        :param source: Optional iterator of chunks played in real time (e.g. feed a record chunk by chunk),
+            otherwise call push from another thread
+        :param speed: Playback speed of source
+        :param frames: Stop after this many frames (None runs until the window is closed)
+        :return: report
+        '''
+        import matplotlib.pyplot as plt
+        from matplotlib.animation import FuncAnimation
+
+        self.figure, self.ax = plt.subplots(figsize=(14, 3))
+        self.ax.set_xlim(0, self.span / float(self.hz))
+        self.ax.set_ylim(-1, 1)
+        self.ax.set_xlabel("seconds")
+        self.line, = self.ax.plot([], [], linewidth=0.7, animated=True)
+        self.markers = [self.ax.plot([], [], linestyle='', marker='v', color=colour, animated=True, label=symbol)[0]
+                        for symbol, colour in zip(self.annotations, LABEL_COLOURS)] if self.classifier else []
+        self.source = iter(source) if source is not None else None
+        self.speed = speed
+        self.pushed = 0
+        self.started = time.perf_counter()
+        self.animation = FuncAnimation(self.figure, self._draw, frames=frames, interval=1000 * self.interval,
+                                       blit=True, repeat=False)
+        plt.show()
+        return self.report()
+
+    def report(self):
+        return {'frames': self.frames, 'late_frames': self.late_frames, 'samples': self.buffer.count}
+
+
+def record_chunks(signal, hz=config.data['hz'], seconds=0.04):
+    '''
+    :return: generator of consecutive chunks of seconds of signal, to feed LiveMonitor.run
+    '''
+    size = max(1, int(hz * seconds))
+    for i in range(0, len(signal), size):
+        yield signal[i:i + size]
+
 
 if __name__ == "__main__":
     index = 1500
@@ -0,0 +1,114 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Vectorized versions of the feature transforms found in process_data.
+Every function works on the last axis, so a single signal (n,) or a stack
+of signals (..., n) can be passed in. The outputs match process_data
+exactly (including the kernal_size + 1 zero padding of average_signal).
+'''
+import numpy as np
+
+import config
+import utils
+
+
+@utils.timer(verbose_only=True)
+def difference_signal(signal, dtype=float):
+    '''
+    Vectorized process_data.difference_signal
+    :param signal: array of shape (..., n)
+    :param dtype: The float type the channel is computed in
+    :return: float array of shape (..., n - 1) where out[i] = signal[i + 1] - signal[i]
+    '''
+    signal = np.asarray(signal, dtype=dtype)
+    return signal[..., 1:] - signal[..., :-1]
+
+
+def moving_average(signal, kernal_size=config.data['kernal_size'], dtype=float, out=None):
+    '''
+    Mean of every complete window signal[i:i + kernal_size] along the last axis.
+    The window sum is accumulated one shifted slice at a time, left to right, which
+    is the same order that the builtin sum uses. That costs O(n * kernal_size), but keeps
+    the result bit-for-bit equal to process_data.average_signal. A running sum (cumsum)
+    would be O(n) but rounds differently, so its windows would not match
+    :param signal: array of shape (..., n)
+    :param kernal_size: the size of each window
+    :param dtype: The float type the averages are computed in
+    :param out: Optional array of dtype and the shape of the result to write the averages to
+    :return: float array of shape (..., max(0, n - kernal_size + 1))
+    '''
+    signal = np.asarray(signal, dtype=dtype)
+    count = max(0, signal.shape[-1] - kernal_size + 1)
+    if out is None:
+        out = np.zeros(signal.shape[:-1] + (count,), dtype=signal.dtype)
+    else:
+        out[...] = 0
+    for k in range(kernal_size):
+        out += signal[..., k:k + count]
+    out /= kernal_size
+    return out
+
+
+@utils.timer(verbose_only=True)
+def average_signal(signal, kernal_size=config.data['kernal_size'], dtype=float):
+    '''
+    Vectorized process_data.average_signal
+    The output starts with kernal_size + 1 zeros and then holds the mean of
+    signal[i + kernal_size:i + 2 * kernal_size] for every i where i + 2 * kernal_size < n
+    :param signal: array of shape (..., n)
+    :param kernal_size: the size of the averaging window (defaults to config.data['kernal_size'])
+    :param dtype: The float type the averages are computed in
+    :return: float array of shape (..., kernal_size + 1 + max(0, n - 2 * kernal_size))
+    '''
+    signal = np.asarray(signal, dtype=dtype)
+    averages = moving_average(signal[..., kernal_size:-1], kernal_size, dtype)
+    padding = np.zeros(signal.shape[:-1] + (kernal_size + 1,), dtype=signal.dtype)
+    return np.concatenate((padding, averages), axis=-1)
+
+
+def average_difference_signal(signal, kernal_size=config.data['kernal_size'], dtype=float):
+    '''
+    The average_difference channel used by setup_data
+    :param signal: array of shape (..., n)
+    :param kernal_size: the size of the averaging window (defaults to config.data['kernal_size'])
+    :param dtype: The float type the channel is computed in
+    :return: difference_signal(average_signal(signal))
+    '''
+    return difference_signal(average_signal(signal, kernal_size, dtype), dtype)
+
+
+def physical_signal(data, dtype=float):
+    '''
+    :param data: data dictionary (see read_data). The signal of a compact record holds the digital
+        samples, converted here with the adc_gain and baseline of its fields
+    :param dtype: The float type of the result
+    :return: float array the shape of data['signal'] in physical units
+    '''
+    fields = data.get('fields', {})
+    if 'adc_gain' not in fields:
+        return np.asarray(data['signal'], dtype=dtype)
+    signal = np.asarray(data['signal'])
+    # One gain and baseline per lead, along the lead axis of a (leads, samples) stack
+    gain = np.asarray(fields['adc_gain'], dtype=dtype).reshape(np.shape(fields['adc_gain']) + (1,) * (signal.ndim - 1))
+    baseline = np.asarray(fields['baseline'], dtype=dtype).reshape(np.shape(gain))
+    return (signal.astype(dtype) - baseline) / gain
+
+
+def add_derived_channels(data, processing=config.processing, kernal_size=config.data['kernal_size']):
+    '''
+    Adds the derived channels enabled in the processing config to a data dictionary (see read_data).
+    The channels of a compact record (digital samples, see read_data.read_data) are computed in float32
+    :param data: dictionary object with a 'signal' element
+    :param processing: the processing flags (defaults to config.processing)
+    :param kernal_size: the size of the averaging window (defaults to config.data['kernal_size'])
+    :return: the same dictionary object with 'difference' and/or 'average_difference' added
+    '''
+    dtype = np.float32 if 'adc_gain' in data.get('fields', {}) else float
+    signal = physical_signal(data, dtype)
+    if processing['difference']:
+        data['difference'] = difference_signal(signal, dtype)
+    if processing['average_difference']:
+        data['average_difference'] = average_difference_signal(signal, kernal_size, dtype)
+    return data
+
@@ -0,0 +1,127 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+'''
+import threading
+import time
+from queue import Queue, Empty, Full
+import numpy as np
+
+import config
+
+
+class BatchPrefetcher:
+    '''
+    Assembles training batches in a background thread so the next batches are
+    ready while the current one is being trained on. X can be a numpy array or
+    a memory mapped dataset (see store_data.ShardedArray)
+    '''
+
+    def __init__(self, X, y, batch_size=config.train['batch'], indices=None, shuffle=True,
+                 seed=config.train['seed'], prefetch=config.train['prefetch']):
+        '''
+        :param X: The features
+        :param y: The labels
+        :param batch_size: The number of rows in each batch (defaults to config.train['batch'])
+        :param indices: The rows of X/y to draw batches from. Defaults to every row
+        :param shuffle: Shuffle the rows at the start of each epoch
+        :param seed: The seed of the shuffle (defaults to config.train['seed'])
+        :param prefetch: The largest number of batches waiting to be used (defaults to config.train['prefetch'])
+        '''
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.indices = np.arange(len(y)) if indices is None else np.asarray(indices)
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+        self.prefetch = prefetch
+        self.steps = 0
+        self.wait_seconds = 0.0
+        self.epoch_seconds = 0.0
+
+    def epoch(self, indices=None):
+        '''
+        Yields the batches of one epoch. The rows are shuffled each epoch
+        :param indices: The rows to use for this epoch only (e.g. a new balanced draw)
+        :yield: X_batch, y_batch
+        '''
+        indices = self.indices if indices is None else np.asarray(indices)
+        if self.shuffle:
+            indices = self.random_state.permutation(indices)
+        batches = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(indices, batches, stop), daemon=True)
+
+        self.steps = 0
+        self.wait_seconds = 0.0
+        start = time.perf_counter()
+        worker.start()
+        try:
+            while True:
+                wait = time.perf_counter()
+                batch = batches.get()
+                self.wait_seconds += time.perf_counter() - wait
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                self.steps += 1
+                yield batch
+        finally:
+            stop.set()
+            # Unblock the producer if it is waiting on a full queue
+            try:
+                batches.get_nowait()
+            except Empty:
+                pass
+            worker.join()
+            self.epoch_seconds = time.perf_counter() - start
+
+    def report(self):
+        '''
+        :return: dict of the last epoch {steps, seconds, steps_per_second, input_wait_seconds}
+        '''
+        return {
+            'steps': self.steps,
+            'seconds': self.epoch_seconds,
+            'steps_per_second': self.steps / self.epoch_seconds if self.epoch_seconds else 0.0,
+            'input_wait_seconds': self.wait_seconds
+        }
+
+    def _produce(self, indices, batches, stop):
+        try:
+            for i in range(0, len(indices), self.batch_size):
+                # Sorted rows read memory mapped shards in order
+                rows = np.sort(indices[i:i + self.batch_size])
+                batch = (np.asarray(self.X[rows]), np.asarray(self.y[rows]))
+                if not self._put(batches, batch, stop):
+                    return
+        except Exception as e:
+            self._put(batches, e, stop)
+            return
+        self._put(batches, None, stop)
+
+    @staticmethod
+    def _put(batches, item, stop):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+
+def chunks(X, y, indices=None, size=config.train['eval_batch']):
+    '''
+    Splits rows into fixed size chunks, e.g. to evaluate a test set without feeding it all at once
+    :param X: The features
+    :param y: The labels
+    :param indices: The rows to use. Defaults to every row
+    :param size: The number of rows in each chunk (defaults to config.train['eval_batch'])
+    :yield: X_chunk, y_chunk
+    '''
+    indices = np.arange(len(y)) if indices is None else np.sort(indices)
+    for i in range(0, len(indices), size):
+        rows = indices[i:i + size]
+        yield np.asarray(X[rows]), np.asarray(y[rows])
@@ -2,14 +2,16 @@
 ecg_realtime_abnormal_detection
 Created 17/07/18 by Matthew Lee
 '''
-import os
 import random
+import shutil
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from operator import itemgetter
-from sklearn.model_selection import train_test_split
 
-from read_data import read_all_data
-import process_data
+# read_data/cache_data (wfdb), resample_data/detect_peaks (scipy) and sklearn are imported by the functions
+# that need them, so opening a dataset (get_data) stays light
+from store_data import ShardWriter, dataset_exists, dataset_path, open_dataset
+import extract_features
 import config
 import utils
 
@@ -31,46 +33,125 @@ def slice_signal(signal, index, before=config.data['slice_before'], after=config
     return signal[index-before:index+after+1]
 
 
+def feature_channels(processing=config.processing):
+    '''
+    :param processing: the processing flags (defaults to config.processing)
+    :return: The names of the data dictionary channels that make up a feature, in channel order
+    '''
+    channels = [name for name in ['difference', 'average_difference'] if processing[name]]
+    return channels if channels else ['signal']
+
+
+def label_indexes(symbols, annotations=config.data['annotations']):
+    '''
+    Vectorized utils.find_index of every symbol in the annotations list
+    :param symbols: array of annotation symbols
+    :param annotations: A list of characters related to the annotations that will be used (the labels)
+    :return: int array of the label index of each symbol, -1 where the symbol is not in annotations
+    '''
+    symbols = np.asarray(symbols)
+    labels = np.full(len(symbols), -1, dtype=np.int64)
+    # Reversed so the first occurrence wins, the same as list.index
+    for label_index in reversed(range(len(annotations))):
+        labels[symbols == annotations[label_index]] = label_index
+    return labels
+
+
+def in_signal_range(file_data, samples, channels, before=config.data['slice_before'], after=config.data['slice_after']):
+    '''
+    :param file_data: data dictionary (see read_data)
+    :param samples: int array of beat indexes
+    :param channels: the channels that will be sliced (see feature_channels)
+    :return: bool array, True where slice_signal would succeed on every channel
+    '''
+    mask = samples - before >= 0
+    for name in channels:
+        mask &= samples + after + 1 <= len(file_data[name])
+    return mask
+
+
+def extract_windows(file_data, samples, channels, out, before=config.data['slice_before'], after=config.data['slice_after']):
+    '''
+    Gathers the window around every sample from a strided view of each channel
+    (one row per possible window start), so no index array is built per element.
+    Every sample must be in range (see in_signal_range)
+    :param file_data: data dictionary (see read_data)
+    :param samples: int array of beat indexes
+    :param channels: the channels to slice (see feature_channels)
+    :param out: array to write into, (len(samples), window, len(channels)) or (len(samples), window) for one channel
+    :return: out
+    '''
+    if len(samples) == 0:
+        return out
+    window = before + after + 1
+    starts = samples - before
+    for c, name in enumerate(channels):
+        signal = np.asarray(file_data[name])
+        windows = as_strided(signal, shape=(len(signal) - window + 1, window),
+                             strides=(signal.strides[0], signal.strides[0]), writeable=False)
+        if out.ndim == 2:
+            np.take(windows, starts, axis=0, out=out)
+        else:
+            out[:, :, c] = windows[starts]
+    return out
+
+
 @utils.timer()
-def slice_based_on_annotations(file_dicts, annotations=config.data['annotations']):
+def slice_based_on_annotations(file_dicts, annotations=config.data['annotations'], provenance=False,
+                               lead=config.data['lead']):
     '''
     Loads in a dictionary object that contains MIT-BIH dictionary data (use read_all_data in read_data.py to obtain)
-    if the annotation type is in the annotations list, slice the data using the slice_signal function
+    if the annotation type is in the annotations list, slice the data around the annotation (see slice_signal)
 
     Use this to create a feature list and a label list and return both as numpy arrays.
+    The accepted beats of each record are found with one vectorized step and every window is
+    gathered into a single preallocated array
 
     :param file_dicts: A dictionary of dictionarys referencing the MIT-BIH data. (use read_all_data in read_data.py to obtain)
     :param annotations: A list of characters related to the annotations that will be used (the labels) https://www.physionet.org/physiobank/annotations.shtml
-    :return: (numpy) features, (numpy) labels
+    :param provenance: Also return where each beat came from
+    :param lead: The lead to slice (defaults to config.data['lead']). Records read with several
+        leads (see read_data.read_record) are sliced on just this lead
+    :return: (numpy) features (beats, window, channels) or (beats, window) for one channel, (numpy) labels
+        and if provenance is True, (numpy) record names and (numpy) sample indexes of each beat
     '''
-    features, labels = [], []
+    from read_data import select_lead
+
+    channels = feature_channels()
+    window = config.data['slice_before'] + config.data['slice_after'] + 1
+    selected = []
     key_values = file_dicts.keys()
     # Key references a filename found in the dictionary
     for key in key_values:
-        file_data = file_dicts[key]
-        # Confirm that the desired lead (found in config) is present in this file
-        if config.data['lead'] in file_data['fields']['sig_name']:
-            lead_index = file_data['fields']['sig_name'].index(config.data['lead'])
-            # Loop through the annotation samples and corresponding types
-            for sample, type in zip(file_data['annotation'].sample, file_data['annotation'].symbol):
-                # Label index is the index related to the annotations
-                label_index = utils.find_index(annotations, type)
-                if label_index is not False:
-                    try:
-                        if config.processing['difference'] and config.processing['average_difference']:
-                            difference = np.array(slice_signal(file_data['difference'], sample))
-                            average_difference = np.array(slice_signal(file_data['average_difference'], sample))
-                            feature = np.reshape(np.concatenate((difference, average_difference), axis=0), (2, difference.shape[0])).T
-                        elif config.processing['difference']:
-                            feature = np.array(slice_signal(file_data['difference'], sample))
-                        elif config.processing['average_difference']:
-                            feature = np.array(slice_signal(file_data['average_difference'], sample))
-                        else:
-                            feature = slice_signal(file_data['signal'], sample)
-                        features.append(feature)
-                        labels.append(label_index)
-                    except IndexError:
-                        utils.w_log("Annotation {} has an index {} outside of signal range".format(type, sample))
+        file_data = select_lead(file_dicts[key], lead)
+        # Confirm that the desired lead is present in this file
+        if file_data is not None and lead in file_data['fields']['sig_name']:
+            samples = np.asarray(file_data['annotation'].sample, dtype=np.int64)
+            symbols = np.asarray(file_data['annotation'].symbol)
+            labels = label_indexes(symbols, annotations)
+            accepted = labels >= 0
+            in_range = in_signal_range(file_data, samples, channels)
+            for sample, type in zip(samples[accepted & ~in_range], symbols[accepted & ~in_range]):
+                utils.w_log("Annotation {} has an index {} outside of signal range".format(type, sample))
+            accepted &= in_range
+            selected.append((key, file_data, samples[accepted], labels[accepted]))
+
+    total = sum(len(samples) for _, _, samples, _ in selected)
+    shape = (total, window) if len(channels) == 1 else (total, window, len(channels))
+    dtype = np.result_type(*[np.asarray(file_data[name]).dtype
+                             for _, file_data, _, _ in selected for name in channels]) if selected else float
+    features = np.empty(shape, dtype=dtype)
+    labels = np.empty(total, dtype=np.int64)
+    offset = 0
+    for _, file_data, samples, record_labels in selected:
+        extract_windows(file_data, samples, channels, features[offset:offset + len(samples)])
+        labels[offset:offset + len(samples)] = record_labels
+        offset += len(samples)
+    if provenance:
+        records = np.concatenate([np.full(len(samples), key, dtype=object) for key, _, samples, _ in selected]) \
+            if selected else np.empty(0, dtype=object)
+        samples = np.concatenate([samples for _, _, samples, _ in selected]) if selected else np.empty(0, dtype=np.int64)
+        return features, labels, records, samples
     return features, labels
 
 
@@ -87,20 +168,66 @@ def stratify_data(X, y):
     :return: feature_list (2D list [unique_labels, features])
              label_list (2D list [unique_labels, labels])
     '''
-    unique_labels = list(set(y))
-    feature_list = []
-    label_list = []
+    _, strata = stratify_indices(y)
+    feature_list = [[X[i] for i in stratum] for stratum in strata]
+    label_list = [[y[i] for i in stratum] for stratum in strata]
+    return feature_list, label_list
 
-    # Create subgroups
-    for _ in unique_labels:
-        label_list.append([])
-        feature_list.append([])
-    for i, feature in enumerate(X):
-        index = unique_labels.index(y[i])
-        label_list[index].append(y[i])
-        feature_list[index].append(feature)
 
-    return feature_list, label_list
+def stratify_indices(y):
+    '''
+    Groups row indexes by label without touching the features (see stratify_data)
+    :param y: array of label indexes
+    :return: unique labels (sorted), list of int arrays holding the rows of each label in their original order
+    '''
+    labels, inverse = np.unique(np.asarray(y), return_inverse=True)
+    order = np.argsort(inverse, kind='mergesort')
+    counts = np.bincount(inverse, minlength=len(labels))
+    return labels, np.split(order, np.cumsum(counts)[:-1])
+
+
+def balanced_indices(y, total=None, seed=None, random_state=None):
+    '''
+    Balances labels based on the smallest category without copying any features (see random_sample)
+    :param y: array of label indexes
+    :param total: the number taken from each label. Defaults to smallest category
+    :param seed: the seed of the draw, for a reproducible sample
+    :param random_state: numpy RandomState to draw from instead of seed
+    :return: shuffled int array of the selected rows of y
+    '''
+    if random_state is None:
+        random_state = np.random.RandomState(seed)
+    _, strata = stratify_indices(y)
+    smallest = min(len(stratum) for stratum in strata)
+    total = smallest if total is None else min(total, smallest)
+    indexes = np.concatenate([random_state.permutation(stratum)[:total] for stratum in strata])
+    return random_state.permutation(indexes)
+
+
+class BalancedSampler:
+    '''
+    Draws a new balanced set of rows each time sample is called, e.g. once per epoch
+    '''
+
+    def __init__(self, y, indices=None, total=None, seed=None):
+        '''
+        :param y: array of label indexes (or one hot labels)
+        :param indices: the rows to sample from. Defaults to every row
+        :param total: the number taken from each label. Defaults to smallest category
+        :param seed: the seed of the draws, for reproducible samples
+        '''
+        y = np.asarray(y)
+        labels = np.argmax(y, axis=1) if y.ndim == 2 else y
+        self.indices = np.arange(len(labels)) if indices is None else np.asarray(indices)
+        self.labels = labels[self.indices]
+        self.total = total
+        self.random_state = np.random.RandomState(seed)
+
+    def sample(self):
+        '''
+        :return: int array of balanced rows (indexes into the full y)
+        '''
+        return self.indices[balanced_indices(self.labels, self.total, random_state=self.random_state)]
 
 
 @utils.timer()
@@ -150,45 +277,195 @@ def one_hot_encode(x):
     return np.eye(n_values)[x]
 
 
+def preprocess_record(data):
+    '''
+    Resamples (when config.processing['resample'] is set and the record is not at config.data['hz'] yet)
+    and adds the derived channels to a record, unless its worker already did (see read_data.read_record),
+    and replaces the annotation with detected beats when config.data['detect_beats'] is set
+    :param data: data dictionary (see read_data)
+    :return: the same data dictionary
+    '''
+    import resample_data
+    import detect_peaks
+    from read_data import select_lead
+
+    # read_record has already resampled the record (fields['fs'] is the new rate) and remapped its annotation
+    if config.processing['resample'] and data['fields']['fs'] != config.data['hz']:
+        # Resampled before the derived channels, the annotation is remapped to the new rate
+        resample_data.resample_record(data, config.data['hz'])
+    if 'difference' not in data and 'average_difference' not in data:
+        extract_features.add_derived_channels(data)
+    if config.data['detect_beats']:
+        # Slice at detected R-peaks (labelled from the nearest reference annotation).
+        # Every lead of a multi lead record shares the beats detected on its first lead
+        first = select_lead(data, data['leads'][0]) if 'leads' in data else data
+        data['annotation'] = detect_peaks.detected_annotation(first, first['fields']['fs'])
+    return data
+
+
 @utils.timer()
-def setup_data(name=config.data['npy_name'], directory=config.data['npy_loc']):
+def setup_data(name=config.data['npy_name'], directory=config.data['npy_loc'], balance=config.data['balance'],
+               source=config.data['mit-bih'], stream=config.data['stream']):
     '''
-    Loads data and saves it as two numpy arrays X and y
-    :param name: The numpy arrays are saved as {name}_X and {name}_y
+    Loads data, balances it and saves it as a sharded dataset (see store_data)
+    :param name: The dataset is saved in the directory {directory}/{name}
     :param directory: The directory to save the data
-    :return: X, y
+    :param balance: Only save a balanced sample of the beats (defaults to config.data['balance']).
+        When False every beat is saved and can be balanced per epoch (see BalancedSampler)
+    :param source: The directory of the records to read (defaults to config.data['mit-bih'])
+    :param stream: Build the dataset one record at a time (see stream_data) instead of holding
+        every record in memory (defaults to config.data['stream'])
+    :return: X, y (see get_data)
     '''
-    data_dicts = read_all_data()
+    from read_data import read_all_data
+    from cache_data import RecordCache
+
+    if stream:
+        return stream_data(name, directory, balance, source)
+    cache = RecordCache() if config.data['use_cache'] else None
+    data_dicts = read_all_data(source, cache=cache)
     key_values = data_dicts.keys()
     # Key references a filename found in the dictionary
     for key in key_values:
-        signal = data_dicts[key]['signal']
-        if config.processing['difference']:
-            data_dicts[key]['difference'] = process_data.difference_signal(signal)
-        if config.processing['average_difference']:
-            data_dicts[key]['average_difference'] = process_data.difference_signal(
-                process_data.average_signal(signal)
-            )
-
-    X, y = slice_based_on_annotations(data_dicts)
-    X, y = stratify_data(X, y)
-    X, y = random_sample(X, y)
+        preprocess_record(data_dicts[key])
+
+    X, y, records, samples = slice_based_on_annotations(data_dicts, provenance=True)
+    write_dataset(name, directory, X, y, records, samples, balance)
+    return get_data(name, directory)
+
+
+@utils.timer()
+def stream_data(name=config.data['npy_name'], directory=config.data['npy_loc'], balance=config.data['balance'],
+                source=config.data['mit-bih']):
+    '''
+    Out of core setup_data. Records are read, preprocessed and sliced one at a time (see read_data.iter_records)
+    and their beats are streamed to disk (see store_data.ShardWriter), so memory is bounded by the records
+    being read plus one shard, whatever the size of the corpus. When balancing, every beat is first written
+    to a temporary dataset and the balanced rows are then copied out of it by index, shard by shard.
+    Balanced rows are kept in record order (training shuffles every epoch, see feed_data.BatchPrefetcher)
+    :param name: The dataset is saved in the directory {directory}/{name}
+    :param directory: The directory to save the data
+    :param balance: Only save a balanced sample of the beats (defaults to config.data['balance'])
+    :param source: The directory of the records to read (defaults to config.data['mit-bih'])
+    :return: X, y (see get_data)
+    '''
+    from read_data import iter_records
+    from cache_data import RecordCache
+
+    annotations = config.data['annotations']
+    one_hot = np.eye(len(annotations))
+    counts = np.zeros(len(annotations), dtype=np.int64)
+    target = name + '.stream' if balance else name
+    writer = ShardWriter(target, directory)
+    cache = RecordCache() if config.data['use_cache'] else None
+    for key, record in iter_records(source, cache=cache):
+        X, y, records, samples = slice_based_on_annotations({key: preprocess_record(record)}, provenance=True)
+        counts += np.bincount(y, minlength=len(annotations))
+        if len(y):
+            writer.append(X, y if balance else one_hot[y], records, samples)
+    writer.close()
+    utils.log("Beats per label: {}".format(dict(zip(annotations, counts.tolist()))))
+    if not balance:
+        return get_data(name, directory)
+
+    X, y, provenance, manifest = open_dataset(target, directory)
+    record_names = np.array([record['name'] for record in manifest['records']], dtype=object)
+    # Copied one source shard at a time, each shard is unmapped once its rows have been taken
+    indexes = np.sort(balanced_indices(np.asarray(y), seed=config.data['seed']))
+    boundaries = np.searchsorted(indexes, np.arange(0, len(X) + X.shard_size, X.shard_size))
+    writer = ShardWriter(name, directory)
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        rows = indexes[start:stop]
+        if len(rows):
+            writer.append(X.take(rows), one_hot[y[rows]], record_names[provenance[rows, 0]], provenance[rows, 1])
+            X.release()
+    writer.close()
+    shutil.rmtree(dataset_path(target, directory))
+    return get_data(name, directory)
+
+
+@utils.timer()
+def setup_lead_data(name=config.data['npy_name'], directory=config.data['npy_loc'], leads=config.data['leads'],
+                    combine=False, balance=config.data['balance'], source=config.data['mit-bih']):
+    '''
+    Reads every record once with all of the leads (see read_data.read_all_data) and builds
+    the datasets of each lead from that single pass
+    :param name: The datasets are saved in the directories {directory}/{name}_{lead},
+        or {directory}/{name} when combine is True
+    :param directory: The directory to save the data
+    :param leads: The leads to build datasets for (defaults to config.data['leads'])
+    :param combine: Save one multi lead dataset instead. The feature channels of each lead are placed
+        side by side, lead by lead, so there are len(leads) times as many channels
+        (network feature_channels must match). Only records holding every lead are used
+    :param balance: Only save a balanced sample of the beats (defaults to config.data['balance'])
+    :param source: The directory of the records to read (defaults to config.data['mit-bih'])
+    :return: dict of dataset name -> (X, y) (see get_data)
+    '''
+    from read_data import read_all_data
+    from cache_data import RecordCache
+
+    cache = RecordCache() if config.data['use_cache'] else None
+    data_dicts = read_all_data(source, cache=cache, leads=leads)
+    for key in data_dicts:
+        preprocess_record(data_dicts[key])
+
+    if not combine:
+        datasets = {}
+        for lead in leads:
+            lead_name = "{}_{}".format(name, lead)
+            X, y, records, samples = slice_based_on_annotations(data_dicts, provenance=True, lead=lead)
+            if len(y) == 0:
+                utils.w_log("No beats found for lead {}".format(lead))
+                continue
+            write_dataset(lead_name, directory, X, y, records, samples, balance, leads=[lead])
+            datasets[lead_name] = get_data(lead_name, directory)
+        return datasets
+
+    complete = {key: data for key, data in data_dicts.items() if all(lead in data['leads'] for lead in leads)}
+    utils.v_log("{} of {} records hold every lead".format(len(complete), len(data_dicts)))
+    parts = []
+    for lead in leads:
+        X, y, records, samples = slice_based_on_annotations(complete, provenance=True, lead=lead)
+        # Leads of a record share the annotation and length, so the same beats are taken from each
+        parts.append(X if X.ndim == 3 else X[:, :, np.newaxis])
+    X = np.concatenate(parts, axis=2)
+    del parts
+    write_dataset(name, directory, X, y, records, samples, balance, leads=leads)
+    return {name: get_data(name, directory)}
+
+
+def write_dataset(name, directory, X, y, records, samples, balance=config.data['balance'], leads=None):
+    '''
+    Balances (optionally) and one hot encodes sliced beats and writes them as a sharded dataset
+    :param X: features (see slice_based_on_annotations)
+    :param y: label indexes
+    :param records: the record name of each beat
+    :param samples: the sample index of each beat
+    :param balance: Only save a balanced sample of the beats (defaults to config.data['balance'])
+    :param leads: The leads of the features, when not config.data['lead'] (see store_data.ShardWriter)
+    '''
+    indexes = balanced_indices(y, seed=config.data['seed']) if balance else np.arange(len(y))
     y = one_hot_encode(y)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    np.save("{}/{}_X.npy".format(directory, name), X)
-    np.save("{}/{}_y.npy".format(directory, name), y)
-    return X, y
+
+    writer = ShardWriter(name, directory, leads=leads)
+    for i in range(0, len(indexes), writer.shard_size):
+        rows = indexes[i:i + writer.shard_size]
+        writer.append(X[rows], y[rows], records[rows], samples[rows])
+    writer.close()
 
 
 @utils.timer(verbose_only=True)
 def get_data(name=config.data['npy_name'], directory=config.data['npy_loc']):
     '''
-    Loads the numpy arrays saved
-    :param name: The numpy arrays are saved as {name}_X and {name}_y
+    Opens a dataset saved by setup_data. The features are memory mapped and only read when indexed
+    (see store_data.ShardedArray). Datasets saved as a {name}_X.npy/{name}_y.npy pair are still loaded
+    :param name: The name of the dataset
     :param directory: The directory to load the data from
     :return: X, y
     '''
+    if dataset_exists(name, directory):
+        X, y, _, _ = open_dataset(name, directory)
+        return X, y
     X = np.load("{}/{}_X.npy".format(directory, name))
     y = np.load("{}/{}_y.npy".format(directory, name))
     return X, y
@@ -202,9 +479,53 @@ def get_train_test(X, y, test_size=config.data['test_size']):
     :param test_size: the float value of the test size between 0 and 1 (default config file)
     :return: (X_train, X_test, y_train, y_test)
     '''
+    from sklearn.model_selection import train_test_split
+
     return train_test_split(X, y, test_size=test_size, stratify=y)
 
 
+def get_train_test_indices(y, test_size=config.data['test_size']):
+    '''
+    Splits rows into train and testing indexes based on test_size config, without reading any features
+    :param y: The label data (label indexes or one hot)
+    :param test_size: the float value of the test size between 0 and 1 (default config file)
+    :return: (train_indices, test_indices)
+    '''
+    from sklearn.model_selection import train_test_split
+
+    y = np.asarray(y)
+    labels = np.argmax(y, axis=1) if y.ndim == 2 else y
+    return train_test_split(np.arange(len(labels)), test_size=test_size, stratify=labels)
+
+
+def get_record_folds(records, folds=config.cv['folds'], seed=config.data['seed']):
+    '''
+    Splits rows into folds by record (patient), so the beats of a record are never in both
+    the train and test rows of a fold. Records are dealt largest first to the fold with the fewest
+    rows, so the folds hold about the same number of beats
+    :param records: array of the record (name or id) of every row, e.g. the first column of the
+        provenance returned by store_data.open_dataset
+    :param folds: The number of folds (defaults to config.cv['folds'])
+    :param seed: The seed used to order records of the same size
+    :return: list of (train_indices, test_indices), one per fold
+    '''
+    records = np.asarray(records)
+    names, inverse = np.unique(records, return_inverse=True)
+    if len(names) < folds:
+        raise ValueError("Cannot split {} records into {} folds".format(len(names), folds))
+    counts = np.bincount(inverse, minlength=len(names))
+    order = np.random.RandomState(seed).permutation(len(names))
+    order = order[np.argsort(-counts[order], kind='mergesort')]
+    fold_of_record = np.empty(len(names), dtype=np.int64)
+    fold_rows = np.zeros(folds, dtype=np.int64)
+    for record in order:
+        fold = int(np.argmin(fold_rows))
+        fold_of_record[record] = fold
+        fold_rows[fold] += counts[record]
+    fold_of_row = fold_of_record[inverse]
+    return [(np.flatnonzero(fold_of_row != fold), np.flatnonzero(fold_of_row == fold)) for fold in range(folds)]
+
+
 if __name__ == "__main__":
     setup_data()
     X, y = get_data()
@@ -0,0 +1,91 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Writes synthetic WFDB records (.dat/.hea/.atr) shaped like MIT-BIH so the
+pipeline can be run and benchmarked without the real database.
+'''
+import os
+import numpy as np
+import wfdb
+
+import config
+import utils
+
+MIT_BIH_RECORDS = 48
+MIT_BIH_LENGTH = 650000
+MIT_BIH_HZ = 360
+
+
+def synthetic_signal(length, fs=MIT_BIH_HZ, premature=0.1, random_state=np.random):
+    '''
+    Creates a noisy ECG like signal with gaussian shaped QRS complexes and T waves
+    :param length: The number of samples
+    :param fs: The sampling rate
+    :param premature: The fraction of beats that arrive early and are annotated 'A'
+    :param random_state: numpy RandomState to draw from
+    :return: signal (length,), beat samples, beat symbols
+    '''
+    intervals = random_state.uniform(0.7, 1.0, size=int(length / (0.55 * fs)) + 2) * fs
+    early = random_state.rand(len(intervals)) < premature
+    intervals[early] *= 0.65
+    samples = np.cumsum(intervals).astype(np.int64)
+    samples = samples[samples < length - fs // 2]
+    symbols = np.where(early[:len(samples)], 'A', 'N')
+
+    t = np.arange(length)
+    signal = 0.1 * np.sin(2 * np.pi * 0.25 * t / fs) + random_state.normal(0, 0.02, length)
+    width = int(0.4 * fs)
+    offsets = np.arange(-width // 4, width)
+    qrs = 1.2 * np.exp(-0.5 * (offsets / (0.012 * fs)) ** 2) - 0.25 * np.exp(-0.5 * ((offsets - 0.03 * fs) / (0.01 * fs)) ** 2)
+    t_wave = 0.3 * np.exp(-0.5 * ((offsets - 0.25 * fs) / (0.04 * fs)) ** 2)
+    beat = qrs + t_wave
+    for sample in samples:
+        indexes = sample + offsets
+        valid = (indexes >= 0) & (indexes < length)
+        signal[indexes[valid]] += beat[valid]
+    return signal, samples, symbols
+
+
+def synthetic_leads(count=MIT_BIH_RECORDS, length=MIT_BIH_LENGTH, fs=MIT_BIH_HZ, seed=0,
+                    leads=(config.data['lead'], 'V1')):
+    '''
+    Creates the records written by write_records without writing them
+    :param leads: The lead names. The first lead holds the ECG, the others a scaled copy
+    :return: generator of (record name, signals (length, leads), beat samples, beat symbols)
+    '''
+    random_state = np.random.RandomState(seed)
+    for i in range(count):
+        signal, samples, symbols = synthetic_signal(length, fs, random_state=random_state)
+        signals = np.stack([signal] + [0.5 * signal for _ in leads[1:]], axis=1)
+        yield str(100 + i), signals, samples, symbols
+
+
+@utils.timer()
+def write_records(directory, count=MIT_BIH_RECORDS, length=MIT_BIH_LENGTH, fs=MIT_BIH_HZ, seed=0,
+                  leads=(config.data['lead'], 'V1')):
+    '''
+    Writes count synthetic records to directory in WFDB format (212 format signals and an atr annotation file)
+    :param directory: The directory to write to
+    :param count: The number of records
+    :param length: The number of samples in each record
+    :param fs: The sampling rate
+    :param seed: The random seed, the same seed always writes the same records
+    :param leads: The lead names. The first lead holds the ECG, the others a scaled copy
+    :return: list of record names
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    names = []
+    for name, signals, samples, symbols in synthetic_leads(count, length, fs, seed, leads):
+        wfdb.wrsamp(name, fs, ['mV'] * len(leads), list(leads), p_signal=signals, fmt=['212'] * len(leads),
+                    write_dir=directory)
+        wfdb.wrann(name, 'atr', samples, list(symbols), write_dir=directory)
+        names.append(name)
+    return names
+
+
+if __name__ == "__main__":
+    import sys
+
+    write_records(sys.argv[1] if len(sys.argv) > 1 else '../data/synthetic')
@@ -0,0 +1,84 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Load generator for serve_model. Runs a number of concurrent clients against the
+server for a fixed time at each concurrency level and reports throughput against
+tail latency:
+
+    python generate_load.py --concurrency 1 4 16 64 --duration 10 --beats 1
+'''
+import argparse
+import json
+import threading
+import time
+from urllib.request import Request, urlopen
+import numpy as np
+
+import config
+import utils
+from profiler import SpanStats
+
+
+def client(url, body, stop, stats, errors, lock):
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            with urlopen(Request(url, data=body, headers={'Content-Type': 'application/json'})) as response:
+                response.read()
+        except OSError:
+            with lock:
+                errors[0] += 1
+            continue
+        with lock:
+            stats.add(time.perf_counter() - start)
+
+
+def run_level(url, concurrency, duration, beats):
+    '''
+    Runs concurrency clients sending beats windows per request for duration seconds
+    :return: dict {concurrency, requests, errors, beats_per_second, p50_seconds, p95_seconds, p99_seconds, max_seconds}
+    '''
+    windows = np.random.normal(0, 0.1, (beats, config.network['feature_size'], config.network['feature_channels']))
+    body = json.dumps({'windows': windows.tolist()}).encode('utf-8')
+    stats, errors, lock, stop = SpanStats(), [0], threading.Lock(), threading.Event()
+    clients = [threading.Thread(target=client, args=(url, body, stop, stats, errors, lock))
+               for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in clients:
+        thread.join()
+    return {
+        'concurrency': concurrency,
+        'requests': stats.calls,
+        'errors': errors[0],
+        'beats_per_second': stats.calls * beats / duration,
+        'p50_seconds': stats.percentile(50),
+        'p95_seconds': stats.percentile(95),
+        'p99_seconds': stats.percentile(99),
+        'max_seconds': stats.max
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure serve_model throughput against tail latency")
+    parser.add_argument('--url', default="http://{}:{}".format(config.serve['host'], config.serve['port']))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--beats', type=int, default=1, help="Beat windows per request")
+    parser.add_argument('--output', default=None, help="Write the results to this json file")
+    args = parser.parse_args()
+
+    results = []
+    for concurrency in args.concurrency:
+        result = run_level(args.url + '/predict', concurrency, args.duration, args.beats)
+        utils.log("{concurrency} clients: {beats_per_second:.0f} beats/sec, p50 {p50_seconds:.4f}s, "
+                  "p99 {p99_seconds:.4f}s".format(**result))
+        results.append(result)
+    with urlopen(args.url + '/metrics') as response:
+        utils.log("Server metrics: {}".format(response.read().decode('utf-8')))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
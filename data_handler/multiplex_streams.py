@@ -0,0 +1,453 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Asyncio front end for many concurrent patient streams. Each patient keeps its own beat
+window state (see classify_stream.StreamingClassifier.extract) and the complete windows
+of every patient are gathered into shared model batches, bounded by a maximum batch size
+and a maximum wait, so a beat is never run through the model on its own while others are
+waiting. The model runs in an executor thread and its results are routed back to each
+patient in beat order. Every patient inbox and the shared queue of ready windows are
+bounded, so a slow model pushes back on the feeders instead of buffering without limit.
+
+Streams can be fed from async iterators (feed_patient) or from local sockets (serve_streams):
+a client sends one json line {"patient": name, "fs": 360, "beats": [...]} followed by float32
+samples, and receives one json line {"sample", "label", "probabilities"} per classified beat.
+
+    python multiplex_streams.py --patients 32 --speed 1 --seconds 60 --weights ../data/model.npz
+'''
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+import numpy as np
+
+import config
+import utils
+from profiler import SpanStats
+
+
+class PatientStream:
+    '''
+    State and metrics of one patient: the beat windows in progress, the inbox of chunks waiting to
+    be processed and the queue of results waiting to be read
+    '''
+
+    def __init__(self, name, hz, beats=None, detect=False, inbox=config.multiplex['inbox']):
+        '''
+        :param name: The patient name
+        :param hz: The sampling rate of the stream
+        :param beats: Optional beat sample indexes known in advance (e.g. from an annotation)
+        :param detect: Find the beats with detect_peaks.OnlinePeakDetector
+        :param inbox: The largest number of chunks waiting to be processed (defaults to config.multiplex['inbox'])
+        '''
+        from classify_stream import StreamingClassifier
+
+        detector = None
+        if detect:
+            import detect_peaks
+
+            detector = detect_peaks.OnlinePeakDetector(hz)
+        self.name = name
+        self.hz = hz
+        self.stream = StreamingClassifier(None, hz=hz, detector=detector)
+        if beats is not None:
+            self.stream.add_beats(beats)
+        self.inbox = asyncio.Queue(maxsize=inbox)
+        self.results = asyncio.Queue()
+        self.ended = False
+        self.chunks = 0
+        self.beats = 0
+        self.max_backlog = 0
+        # Seconds from the arrival of the chunk completing a beat to its result
+        self.lag = SpanStats()
+
+    def metrics(self):
+        return {
+            'chunks': self.chunks,
+            'samples': self.stream.samples,
+            'beats': self.beats,
+            'dropped': self.stream.dropped,
+            'backlog_chunks': self.inbox.qsize(),
+            'max_backlog_chunks': self.max_backlog,
+            'unread_results': self.results.qsize(),
+            'lag_seconds': {
+                'mean': self.lag.total / self.lag.calls if self.lag.calls else 0.0,
+                'p99': self.lag.percentile(99),
+                'max': self.lag.max
+            }
+        }
+
+
+class StreamMultiplexer:
+    '''
+    Gathers the beat windows of many PatientStreams into shared batches for one predict function.
+    Create it, and the patients, inside the running event loop
+    '''
+
+    def __init__(self, predict, max_batch=config.serve['max_batch'], max_wait=config.serve['max_wait'],
+                 max_pending=config.multiplex['max_pending']):
+        '''
+        :param predict: function mapping windows (n, feature_size, channels) to probabilities (n, labels)
+        :param max_batch: The largest number of windows in one batch (defaults to config.serve['max_batch'])
+        :param max_wait: The longest time in seconds the first windows of a batch wait for others
+            (defaults to config.serve['max_wait'])
+        :param max_pending: The largest number of window groups waiting for the model
+            (defaults to config.multiplex['max_pending'])
+        '''
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.patients = {}
+        # (patient, samples, windows, arrival) of the windows each chunk completed, in arrival order
+        self.ready = asyncio.Queue(maxsize=max_pending)
+        self.carry = None
+        self.batch_sizes = Counter()
+        self.model_seconds = 0.0
+        self.tasks = []
+        self.batcher = asyncio.ensure_future(self._batch_loop())
+
+    def add_patient(self, name, hz, beats=None, detect=False):
+        '''
+        Registers a patient stream and starts processing its inbox
+        :return: PatientStream
+        '''
+        if name in self.patients:
+            raise ValueError("Patient {} is already streaming".format(name))
+        patient = PatientStream(name, hz, beats, detect)
+        self.patients[name] = patient
+        self.tasks.append(asyncio.ensure_future(self._ingest(patient)))
+        return patient
+
+    async def feed(self, name, chunk, arrival=None):
+        '''
+        Queues a chunk of samples of a patient, waiting while its inbox is full
+        :param name: The patient name
+        :param chunk: 1D array of samples
+        :param arrival: The time the chunk arrived at (defaults to now). Lag is measured from it
+        '''
+        patient = self.patients[name]
+        await patient.inbox.put((np.asarray(chunk, dtype=float), time.perf_counter() if arrival is None else arrival))
+        patient.max_backlog = max(patient.max_backlog, patient.inbox.qsize())
+
+    async def end(self, name):
+        '''
+        Marks the end of a patient stream, once every beat it completed has been classified
+        a None result is queued for it
+        '''
+        patient = self.patients[name]
+        if not patient.ended:
+            patient.ended = True
+            await patient.inbox.put(None)
+
+    async def close(self):
+        '''
+        Ends every stream, waits for their beats to be classified and stops the batcher
+        '''
+        for name in self.patients:
+            await self.end(name)
+        await asyncio.gather(*self.tasks)
+        await self.ready.put(None)
+        await self.batcher
+
+    async def _ingest(self, patient):
+        while True:
+            item = await patient.inbox.get()
+            if item is None:
+                await self.ready.put((patient, None, None, None))
+                return
+            chunk, arrival = item
+            samples, windows = patient.stream.extract(chunk)
+            patient.chunks += 1
+            if len(samples):
+                await self.ready.put((patient, samples, windows, arrival))
+
+    async def _next(self, timeout=None):
+        if self.carry is not None:
+            item, self.carry = self.carry, None
+            return item
+        if timeout is None:
+            return await self.ready.get()
+        return await asyncio.wait_for(self.ready.get(), timeout)
+
+    async def _batch_loop(self):
+        loop = asyncio.get_event_loop()
+        closing = False
+        while not closing:
+            first = await self._next()
+            if first is None:
+                return
+            batch, rows = [], 0
+            deadline = time.perf_counter() + self.max_wait
+            item = first
+            while True:
+                if item is None:
+                    closing = True
+                    break
+                if item[1] is None:
+                    # End of a stream, its place in the queue keeps it after every beat of the patient
+                    batch.append(item)
+                elif rows + len(item[1]) > self.max_batch and rows:
+                    self.carry = item
+                    break
+                else:
+                    batch.append(item)
+                    rows += len(item[1])
+                remaining = deadline - time.perf_counter()
+                if rows >= self.max_batch or remaining <= 0:
+                    break
+                try:
+                    item = await self._next(remaining)
+                except asyncio.TimeoutError:
+                    break
+            probabilities = None
+            if rows:
+                windows = np.concatenate([item[2] for item in batch if item[1] is not None])
+                start = time.perf_counter()
+                # The event loop keeps ingesting chunks while the model runs in the executor.
+                # A single chunk completing more than max_batch beats is split over several calls
+                parts = []
+                for offset in range(0, rows, self.max_batch):
+                    part = windows[offset:offset + self.max_batch]
+                    parts.append(np.asarray(await loop.run_in_executor(None, self.predict, part)))
+                    self.batch_sizes[len(part)] += 1
+                probabilities = np.concatenate(parts)
+                self.model_seconds += time.perf_counter() - start
+            self._route(batch, probabilities)
+
+    def _route(self, batch, probabilities):
+        done = time.perf_counter()
+        labels = np.argmax(probabilities, axis=1) if probabilities is not None else None
+        offset = 0
+        for patient, samples, windows, arrival in batch:
+            if samples is None:
+                patient.results.put_nowait(None)
+                continue
+            for i, sample in enumerate(samples):
+                patient.results.put_nowait((int(sample), int(labels[offset + i]), probabilities[offset + i]))
+            offset += len(samples)
+            patient.beats += len(samples)
+            for _ in samples:
+                patient.lag.add(done - arrival)
+
+    def metrics(self):
+        '''
+        :return: dict {batches, mean_batch, batch_sizes, model_seconds, pending, patients: {name: metrics}}
+        '''
+        batches = sum(self.batch_sizes.values())
+        return {
+            'batches': batches,
+            'mean_batch': sum(size * count for size, count in self.batch_sizes.items()) / batches if batches else 0.0,
+            'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            'model_seconds': self.model_seconds,
+            'pending': self.ready.qsize(),
+            'patients': {name: patient.metrics() for name, patient in self.patients.items()}
+        }
+
+
+async def feed_patient(multiplexer, name, chunks, hz=None, speed=None):
+    '''
+    Feeds an iterator (or async iterator) of chunks to a patient, then ends its stream
+    :param chunks: iterable or async iterable of 1D sample arrays
+    :param hz: The sampling rate, needed when pacing with speed
+    :param speed: Release the chunks at speed times real time (None feeds them as fast as they are accepted)
+    '''
+    start = time.perf_counter()
+    position = 0
+
+    async def send(chunk):
+        nonlocal position
+        position += len(chunk)
+        arrival = None
+        if speed:
+            # A chunk is due once its last sample would have been recorded
+            arrival = start + position / float(hz * speed)
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await multiplexer.feed(name, chunk, arrival)
+
+    if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+            await send(chunk)
+    else:
+        for chunk in chunks:
+            await send(chunk)
+    await multiplexer.end(name)
+
+
+def chunks(signal, size):
+    '''
+    :return: generator of consecutive chunks of size samples of signal
+    '''
+    for i in range(0, len(signal), size):
+        yield signal[i:i + size]
+
+
+async def read_results(patient):
+    '''
+    :return: list of (sample, label, probabilities) of every beat of a patient, until its stream ends
+    '''
+    results = []
+    while True:
+        result = await patient.results.get()
+        if result is None:
+            return results
+        results.append(result)
+
+
+async def serve_streams(multiplexer, host=config.serve['host'], port=config.serve['port'] + 1):
+    '''
+    Accepts patient streams over tcp (see the module docstring for the protocol)
+    :return: the asyncio server
+    '''
+    async def handle(reader, writer):
+        header = json.loads((await reader.readline()).decode('utf-8'))
+        patient = multiplexer.add_patient(header['patient'], header['fs'], header.get('beats'),
+                                          header.get('detect', False))
+
+        async def send_results():
+            while True:
+                result = await patient.results.get()
+                if result is None:
+                    break
+                sample, label, probabilities = result
+                writer.write((json.dumps({'sample': sample, 'label': label,
+                                          'probabilities': probabilities.tolist()}) + '\n').encode('utf-8'))
+                await writer.drain()
+            writer.close()
+
+        sender = asyncio.ensure_future(send_results())
+        remainder = b''
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            data = remainder + data
+            usable = len(data) // 4 * 4
+            remainder = data[usable:]
+            if usable:
+                await multiplexer.feed(patient.name, np.frombuffer(data[:usable], dtype='<f4'))
+        await multiplexer.end(patient.name)
+        await sender
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def load_test(predict, directory=config.data['mit-bih'], patients=config.multiplex['patients'], speed=1.0,
+                    seconds=None, chunk_seconds=config.multiplex['chunk_seconds'], max_batch=config.serve['max_batch'],
+                    max_wait=config.serve['max_wait']):
+    '''
+    Streams records to the multiplexer as N concurrent patients (records are reused when there are
+    more patients than records) and classifies the annotated beats
+    :param predict: function mapping windows (n, feature_size, channels) to probabilities (n, labels)
+    :param directory: the location of the records. Defaults to configuration mit-bih
+    :param patients: The number of concurrent patients
+    :param speed: Multiple of real time each patient streams at (0 streams as fast as accepted)
+    :param seconds: Only stream the first seconds of each record
+    :return: dict of metrics (see StreamMultiplexer.metrics) with beats_per_second and lag over every patient
+    '''
+    import os
+    import detect_peaks
+    from extract_features import physical_signal
+    from read_data import read_record
+
+    names = sorted(os.path.splitext(file)[0] for file in os.listdir(directory) if file.endswith(".dat"))
+    records = {}
+    for name in names[:patients]:
+        record = read_record(name, directory)
+        if record is not None:
+            records[name] = record
+    if not records:
+        raise ValueError("No records with lead {} in {}".format(config.data['lead'], directory))
+    multiplexer = StreamMultiplexer(predict, max_batch, max_wait)
+    feeders, readers = [], []
+    for i in range(patients):
+        record = records[sorted(records)[i % len(records)]]
+        fs = record['fields']['fs']
+        # Compact records hold digital samples, the patients send physical ones
+        signal = physical_signal(record, np.float32 if config.data['compact'] else float)
+        signal = signal if seconds is None else signal[:int(seconds * fs)]
+        patient = multiplexer.add_patient("patient_{}".format(i), fs, detect_peaks.beat_annotations(
+            record['annotation'])[0])
+        feeders.append(feed_patient(multiplexer, patient.name, chunks(signal, max(1, int(chunk_seconds * fs))), fs,
+                                    speed))
+        readers.append(read_results(patient))
+    start = time.perf_counter()
+    results = await asyncio.gather(*(feeders + readers))
+    wall = time.perf_counter() - start
+    await multiplexer.close()
+
+    metrics = multiplexer.metrics()
+    lag = SpanStats()
+    for patient in multiplexer.patients.values():
+        for bucket, count in enumerate(patient.lag.histogram):
+            lag.histogram[bucket] += count
+        lag.calls += patient.lag.calls
+        lag.total += patient.lag.total
+        lag.max = max(lag.max, patient.lag.max)
+    beats = sum(len(result) for result in results[len(feeders):])
+    metrics.update({
+        'patients_count': patients,
+        'speed': speed,
+        'wall_seconds': wall,
+        'beats': beats,
+        'beats_per_second': beats / wall if wall else 0.0,
+        'lag_seconds': {'mean': lag.total / lag.calls if lag.calls else 0.0, 'p99': lag.percentile(99),
+                        'max': lag.max}
+    })
+    return metrics
+
+
+def run(coroutine):
+    '''
+    Runs a coroutine on a new event loop
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the multi patient stream multiplexer")
+    parser.add_argument('--source', default=config.data['mit-bih'], help="The directory of the records")
+    parser.add_argument('--patients', type=int, default=config.multiplex['patients'])
+    parser.add_argument('--speed', type=float, default=1.0, help="Multiple of real time, 0 for as fast as possible")
+    parser.add_argument('--seconds', type=float, default=None, help="Only stream the start of each record")
+    parser.add_argument('--max-batch', type=int, default=config.serve['max_batch'])
+    parser.add_argument('--max-wait', type=float, default=config.serve['max_wait'])
+    parser.add_argument('--output', default=None, help="Write the metrics to this json file")
+    parser.add_argument('--weights', default=None, help="Classify with weights exported by numpy_model (no tensorflow)")
+    args = parser.parse_args(argv)
+
+    def test(predict):
+        metrics = run(load_test(predict, args.source, args.patients, args.speed, args.seconds,
+                                max_batch=args.max_batch, max_wait=args.max_wait))
+        utils.log("{patients_count} patients: {beats_per_second:.0f} beats/sec, mean batch {mean_batch:.1f}, "
+                  "lag p99 {p99:.4f}s max {max:.4f}s".format(**dict(metrics, **metrics['lag_seconds'])))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(metrics, f, indent=2)
+        return metrics
+
+    if args.weights is not None:
+        from numpy_model import NumpyModel
+
+        return test(NumpyModel(args.weights).predict)
+
+    import tensorflow as tf
+    from network_model import instantiate_model, restore_model
+    from classify_stream import session_classifier
+
+    X_placeholder, _, _, output_soft = instantiate_model()
+    with tf.Session() as sess:
+        utils.log("Restored {}".format(restore_model(sess)))
+        return test(session_classifier(sess, X_placeholder, output_soft))
+
+
+if __name__ == "__main__":
+    main()
@@ -49,3 +49,18 @@ def instantiate_model():
         output_softmax = tf.nn.softmax(output_layer)
 
     return X, y, output_layer, output_softmax
+
+
+def restore_model(sess, directory=config.train['checkpoint'], name=config.train['name']):
+    '''
+    Restores the latest checkpoint saved by train_network into the current graph
+    :param sess: The session to restore the variables into
+    :param directory: The checkpoint directory (defaults to config.train['checkpoint'])
+    :param name: The name of the training run (defaults to config.train['name'])
+    :return: The path of the restored checkpoint
+    '''
+    checkpoint = tf.train.latest_checkpoint("{}/{}".format(directory, name))
+    if checkpoint is None:
+        raise IOError("No checkpoint found for {} in {}".format(name, directory))
+    tf.train.Saver().restore(sess, checkpoint)
+    return checkpoint
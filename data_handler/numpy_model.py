@@ -0,0 +1,300 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+TensorFlow free forward pass of the network_model graph. export_weights writes the
+trained conv1d and dense weights of a session to a small .npz file and NumpyModel
+runs the same two branch network on them with numpy alone (conv1d as im2col on a
+strided view followed by one matrix product), so processes that only predict do not
+import tensorflow. Weights can be stored as int8 with one scale per output channel, which makes
+the file about 4x smaller. They are dequantized once when loaded, so the forward pass still
+runs in float32 and is no faster than with float32 weights:
+
+    python numpy_model.py export ../data/model.npz [--int8]
+    python numpy_model.py check
+    python numpy_model.py bench ../data/model.npz
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+import config
+import utils
+
+# The trainable layers of network_model.instantiate_model, in the order tensorflow creates their variables
+LAYERS = ['dif_conv_1', 'dif_conv_2', 'avg_conv_1', 'avg_conv_2', 'dense_1', 'output']
+POOL_SIZE = 2
+
+
+def export_weights(sess, path, quantize=False):
+    '''
+    Writes the weights of the network_model graph held by a session
+    :param sess: session holding the network_model graph (see network_model.restore_model)
+    :param path: The .npz file to write
+    :param quantize: Store the kernels as int8 with a float32 scale per output channel (about 4x smaller)
+    :return: dict of the arrays written
+    '''
+    import tensorflow as tf
+
+    variables = tf.trainable_variables()
+    if len(variables) != 2 * len(LAYERS):
+        raise ValueError("Expected the {} kernels and biases of network_model, found {} variables".format(
+            len(LAYERS), len(variables)))
+    values = sess.run(variables)
+    weights = {}
+    for layer, kernel, bias in zip(LAYERS, values[0::2], values[1::2]):
+        if quantize:
+            weights[layer + '/kernel'], weights[layer + '/scale'] = quantize_kernel(kernel)
+        else:
+            weights[layer + '/kernel'] = kernel.astype(np.float32)
+        weights[layer + '/bias'] = bias.astype(np.float32)
+    np.savez(path, **weights)
+    return weights
+
+
+def quantize_kernel(kernel):
+    '''
+    Symmetric int8 quantization with one scale per output channel (the last axis)
+    :param kernel: float array (..., outputs)
+    :return: int8 array the shape of kernel, float32 scales (outputs,)
+    '''
+    kernel = np.asarray(kernel, dtype=np.float32)
+    scale = np.abs(kernel.reshape(-1, kernel.shape[-1])).max(axis=0) / 127.0
+    scale[scale == 0] = 1.0
+    return np.round(kernel / scale).astype(np.int8), scale.astype(np.float32)
+
+
+def conv1d(x, kernel, bias):
+    '''
+    Valid, stride 1 convolution (tf.layers.conv1d) as im2col and a matrix product
+    :param x: float array (n, length, in_channels)
+    :param kernel: float array (width, in_channels, filters)
+    :param bias: float array (filters,)
+    :return: float array (n, length - width + 1, filters)
+    '''
+    n, length, channels = x.shape
+    width, _, filters = kernel.shape
+    x = np.ascontiguousarray(x)
+    steps = length - width + 1
+    columns = as_strided(x, shape=(n, steps, width, channels),
+                         strides=(x.strides[0], x.strides[1], x.strides[1], x.strides[2]), writeable=False)
+    out = np.dot(columns.reshape(n * steps, width * channels), kernel.reshape(width * channels, filters))
+    out += bias
+    return out.reshape(n, steps, filters)
+
+
+def max_pool1d(x, pool_size=POOL_SIZE):
+    '''
+    Valid max pooling with strides equal to pool_size (tf.layers.max_pooling1d)
+    :param x: float array (n, length, channels)
+    :return: float array (n, length // pool_size, channels)
+    '''
+    steps = x.shape[1] // pool_size
+    # An elementwise maximum of the pool_size strided views is much faster than a max over a small axis
+    out = x[:, 0:steps * pool_size:pool_size].copy()
+    for offset in range(1, pool_size):
+        np.maximum(out, x[:, offset:steps * pool_size:pool_size], out=out)
+    return out
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class NumpyModel:
+    '''
+    Forward pass of network_model with numpy. Dropout is the identity at inference, as in the tensorflow graph
+    '''
+
+    def __init__(self, path, dtype=np.float32, batch=64):
+        '''
+        :param path: The .npz file written by export_weights
+        :param dtype: The type the forward pass is computed in. int8 weights are dequantized to it once
+        :param batch: The number of windows run at a time, which bounds the size of the im2col arrays
+        '''
+        self.dtype = np.dtype(dtype)
+        self.batch = batch
+        self.weights = {}
+        with np.load(path) as saved:
+            # Only the storage is int8, the forward pass runs in dtype either way
+            self.quantized = any(name.endswith('/scale') for name in saved.files)
+            for layer in LAYERS:
+                kernel = saved[layer + '/kernel']
+                if layer + '/scale' in saved.files:
+                    kernel = kernel.astype(self.dtype) * saved[layer + '/scale'].astype(self.dtype)
+                self.weights[layer] = (kernel.astype(self.dtype), saved[layer + '/bias'].astype(self.dtype))
+
+    def branch(self, x, prefix):
+        conv_1 = max_pool1d(conv1d(x, *self.weights[prefix + '_conv_1']))
+        conv_2 = max_pool1d(conv1d(conv_1, *self.weights[prefix + '_conv_2']))
+        return conv_2.reshape(len(conv_2), -1)
+
+    def logits(self, X):
+        '''
+        :param X: windows (n, feature_size, 2) of the difference and average_difference channels
+        :return: the output layer (n, labels) before the softmax
+        '''
+        X = np.asarray(X, dtype=self.dtype)
+        outputs = []
+        for i in range(0, len(X), self.batch):
+            part = X[i:i + self.batch]
+            merged = np.concatenate((self.branch(part[:, :, 0:1], 'dif'), self.branch(part[:, :, 1:2], 'avg')),
+                                    axis=1)
+            kernel, bias = self.weights['dense_1']
+            layer_1 = np.dot(merged, kernel) + bias
+            kernel, bias = self.weights['output']
+            outputs.append(np.dot(layer_1, kernel) + bias)
+        return np.concatenate(outputs) if outputs else np.empty((0, config.network['labels']), dtype=self.dtype)
+
+    def predict(self, X):
+        '''
+        :param X: windows (n, feature_size, 2)
+        :return: probabilities (n, labels), the output_softmax of network_model
+        '''
+        return softmax(self.logits(X))
+
+
+def parity_errors(windows=64, seed=0, path=None):
+    '''
+    Builds the network_model graph with freshly initialised weights, exports them and compares
+    NumpyModel against the tensorflow outputs, in float32 and with int8 weights
+    :param windows: The number of random windows compared
+    :param path: The directory the weights are exported to. Defaults to a temporary directory removed afterwards
+    :return: dict {float32, int8} of the largest absolute probability difference
+    '''
+    import tempfile
+    import tensorflow as tf
+    from network_model import instantiate_model
+
+    if path is None:
+        with tempfile.TemporaryDirectory() as directory:
+            return parity_errors(windows, seed, directory)
+    X = np.random.RandomState(seed).normal(0, 0.1, (windows, config.network['feature_size'],
+                                                    config.network['feature_channels'])).astype(np.float32)
+    with tf.Graph().as_default():
+        tf.set_random_seed(seed)
+        X_placeholder, _, _, output_soft = instantiate_model()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            expected = sess.run(output_soft, feed_dict={X_placeholder: X})
+            export_weights(sess, os.path.join(path, 'float32.npz'))
+            export_weights(sess, os.path.join(path, 'int8.npz'), quantize=True)
+    errors = {
+        'float32': float(np.abs(NumpyModel(os.path.join(path, 'float32.npz')).predict(X) - expected).max()),
+        'int8': float(np.abs(NumpyModel(os.path.join(path, 'int8.npz')).predict(X) - expected).max())
+    }
+    return errors
+
+
+COLD_START = '''
+import resource, sys, time
+start = time.perf_counter()
+import numpy as np
+{setup}
+X = np.random.normal(0, 0.1, (1, {feature_size}, {channels})).astype(np.float32)
+predict(X)
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+NUMPY_SETUP = '''
+sys.path.insert(0, {directory!r})
+from numpy_model import NumpyModel
+predict = NumpyModel({path!r}).predict
+'''
+
+TENSORFLOW_SETUP = '''
+sys.path.insert(0, {directory!r})
+import tensorflow as tf
+from network_model import instantiate_model, restore_model
+X_placeholder, _, _, output_soft = instantiate_model()
+sess = tf.Session()
+restore_model(sess)
+predict = lambda X: sess.run(output_soft, feed_dict={{X_placeholder: X}})
+'''
+
+
+def cold_start(setup):
+    '''
+    Times a fresh python process from start up to its first prediction
+    :return: dict {seconds, max_rss_mb}
+    '''
+    code = COLD_START.format(setup=setup, feature_size=config.network['feature_size'],
+                             channels=config.network['feature_channels'])
+    seconds, rss = subprocess.check_output([sys.executable, '-c', code]).decode('utf-8').split()
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    return {'seconds': float(seconds), 'max_rss_mb': int(rss) / (1024.0 if sys.platform != 'darwin' else 1024.0 ** 2)}
+
+
+def benchmark(path, beats=20000, tensorflow=False):
+    '''
+    Measures cold start time, memory and throughput of NumpyModel (and the tensorflow graph if asked).
+    The throughput is timed in this process with the model already loaded, the cold start in a fresh process
+    :param path: The .npz file written by export_weights
+    :param beats: The number of windows classified for the throughput
+    :param tensorflow: Also measure the tensorflow graph restored from the latest checkpoint
+    :return: dict of engine -> {seconds, max_rss_mb, beats_per_second}. The numpy results also give
+        int8_weights (the file stores int8 kernels) and compute_dtype (the type the forward pass ran in)
+    '''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    X = np.random.normal(0, 0.1, (beats, config.network['feature_size'],
+                                  config.network['feature_channels'])).astype(np.float32)
+    model = NumpyModel(path)
+    start = time.perf_counter()
+    model.predict(X)
+    seconds = time.perf_counter() - start
+    results = {
+        'numpy': dict(cold_start(NUMPY_SETUP.format(directory=directory, path=path)),
+                      beats_per_second=beats / seconds, int8_weights=model.quantized,
+                      compute_dtype=model.dtype.name)
+    }
+    if tensorflow:
+        import tensorflow as tf
+        from network_model import instantiate_model, restore_model
+
+        with tf.Graph().as_default():
+            X_placeholder, _, _, output_soft = instantiate_model()
+            with tf.Session() as sess:
+                restore_model(sess)
+                start = time.perf_counter()
+                for i in range(0, beats, 256):
+                    sess.run(output_soft, feed_dict={X_placeholder: X[i:i + 256]})
+                seconds = time.perf_counter() - start
+        results['tensorflow'] = dict(cold_start(TENSORFLOW_SETUP.format(directory=directory)),
+                                     beats_per_second=beats / seconds)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and run network_model without tensorflow")
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser('export', help="Export the weights of the latest checkpoint")
+    export.add_argument('path')
+    export.add_argument('--int8', action='store_true', help="Store the kernels as int8 (smaller file, still computed in float32)")
+    commands.add_parser('check', help="Compare the numpy and tensorflow outputs")
+    bench = commands.add_parser('bench', help="Cold start, memory and beats/sec")
+    bench.add_argument('path')
+    bench.add_argument('--beats', type=int, default=20000)
+    bench.add_argument('--tensorflow', action='store_true', help="Also measure the tensorflow graph")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        import tensorflow as tf
+        from network_model import instantiate_model, restore_model
+
+        instantiate_model()
+        with tf.Session() as sess:
+            utils.log("Restored {}".format(restore_model(sess)))
+            export_weights(sess, args.path, args.int8)
+        utils.log("Wrote {} ({} bytes)".format(args.path, os.path.getsize(args.path)))
+    elif args.command == 'check':
+        utils.log("Largest probability differences: {}".format(parity_errors()))
+    elif args.command == 'bench':
+        utils.log(json.dumps(benchmark(args.path, args.beats, args.tensorflow), indent=2))
+    else:
+        parser.print_help()
@@ -2,69 +2,105 @@
 ecg_realtime_abnormal_detection
 Created 23/07/18 by Matthew Lee
 '''
-import wfdb
 import numpy as np
 import math
+import time
 
 import config
 import utils
 
 
 class ProcessingPipeline:
-    operations = []
 
-    def __init__(self, X, y, batch_size=32):
+    def __init__(self, X, y, batch_size=32, seed=None):
+        '''
+        :param X: The features (signals, length) or (signals, length, channels)
+        :param y: The labels
+        :param batch_size: The number of signals in each batch
+        :param seed: The seed of the random number generator used by random operations (e.g. gaussian_noise)
+        '''
         self.X = X
         self.y = y
         self.batch_size = batch_size
+        self.operations = []
+        self.random_state = np.random.RandomState(seed)
 
     def add_op(self, func, *args, **kwargs):
         '''
         Adds the operation to the operations list in the form
-        of a dictionary object
+        of a dictionary object. If the function has a batched version
+        (see BATCH_OPERATIONS) it is applied to the whole batch at once
         :param func: The function to be called
         :param args: The arguments to pass
         :param kwargs: The keyword arguments to pass
         '''
         self.operations.append({
             'function': func,
+            'batch_function': BATCH_OPERATIONS.get(func),
             'args': args,
-            'kwargs': kwargs
+            'kwargs': kwargs,
+            'out': None,
+            'calls': 0,
+            'seconds': 0.0
         })
 
     def get_batch(self):
         '''
-        Retrieves a batch of data and formats it based on the pipeline operations
+        Retrieves a batch of data and formats it based on the pipeline operations.
+        Batched operations write into buffers that are reused, so a yielded batch is
+        only valid until the next one is requested
         :yield: batch_X, batch_y
         '''
         for i in range(int(math.ceil(len(self.X)/self.batch_size))):
-            try:
-                batch_X = self.X[i*self.batch_size:i*self.batch_size+self.batch_size]
-                batch_y = self.y[i*self.batch_size:i*self.batch_size+self.batch_size]
-            except IndexError:
-                batch_X = self.X[i*self.batch_size:]
-                batch_y = self.y[i*self.batch_size:]
+            batch_X = np.asarray(self.X[i*self.batch_size:i*self.batch_size+self.batch_size])
+            batch_y = self.y[i*self.batch_size:i*self.batch_size+self.batch_size]
             for op in self.operations:
-                temp_batch = []
-                for sig in batch_X:
-                    temp_batch.append(op['function'](sig))
-                batch_X = np.array(temp_batch)
+                start = time.perf_counter()
+                batch_X = self._apply(op, batch_X)
+                op['calls'] += 1
+                op['seconds'] += time.perf_counter() - start
             yield batch_X, batch_y
 
+    def _apply(self, op, batch_X):
+        if op['batch_function'] is None:
+            return np.array([op['function'](sig, *op['args'], **op['kwargs']) for sig in batch_X])
+        # float32 batches (see config.data['compact']) stay float32
+        dtype = np.result_type(batch_X.dtype, np.float32)
+        if op['out'] is None or op['out'].shape[1:] != batch_X.shape[1:] or len(op['out']) < len(batch_X) \
+                or op['out'].dtype != dtype:
+            op['out'] = np.empty((self.batch_size,) + batch_X.shape[1:], dtype=dtype)
+        kwargs = dict(op['kwargs'])
+        if op['function'] is gaussian_noise:
+            kwargs['random_state'] = self.random_state
+        return op['batch_function'](batch_X, *op['args'], out=op['out'][:len(batch_X)], **kwargs)
+
+    def timing_report(self):
+        '''
+        :return: list of dicts {operation, calls, seconds, mean_seconds}, one per operation
+        '''
+        return [{
+            'operation': op['function'].__name__,
+            'calls': op['calls'],
+            'seconds': op['seconds'],
+            'mean_seconds': op['seconds'] / op['calls'] if op['calls'] else 0.0
+        } for op in self.operations]
+
 
 @utils.timer(verbose_only=True)
 def resample_signal(signal, current_hz=360, output_hz=config.data['hz']):
     '''
-    Resamples the signals/annotations from current hz to output hz.
-    This is useful for training models at different hz for different distributions of data
-    :param signals: The original array of signals to resample
-    :param annotations: The original array of annotations to resample
+    Resamples the signal from current hz to output hz.
+    This is useful for training models at different hz for different distributions of data.
+    Uses the cached polyphase filters of resample_data, see resample_data.resample_record
+    to also remap the annotations
+    :param signal: The original signal array (or stack of signals) to resample
     :param current_hz: The current hz that the data represents
     :param output_hz: The hz that you'd like the data to represent
-    :return: resampled_sig: The new signal array. resampled_ann: The new annotation array
+    :return: resampled_sig: The new signal array
     '''
-    sig, loc = wfdb.processing.resample_sig(signal, current_hz, output_hz)
-    return sig
+    import resample_data
+
+    return resample_data.resample(signal, current_hz, output_hz)
 
 
 @utils.timer(verbose_only=True)
@@ -91,6 +127,54 @@ def expand_dims(signal):
     return np.expand_dims(signal, axis=2)
 
 
+def vertically_center_batch(batch, out=None):
+    '''
+    Batched vertically_center_signal. Each signal (and channel) is centred along the length axis
+    :param batch: array (signals, length) or (signals, length, channels)
+    :param out: optional array to write into
+    '''
+    return np.subtract(batch, np.mean(batch, axis=1, keepdims=True), out=out)
+
+
+def normalize_batch(batch, out=None):
+    '''
+    Batched normalize_signal. Each signal (and channel) is scaled to [0, 1] along the length axis
+    :param batch: array (signals, length) or (signals, length, channels)
+    :param out: optional array to write into
+    '''
+    min_val = np.min(batch, axis=1, keepdims=True)
+    max_val = np.max(batch, axis=1, keepdims=True)
+    out = np.subtract(batch, min_val, out=out)
+    return np.divide(out, max_val - min_val, out=out)
+
+
+def gaussian_noise_batch(batch, out=None, random_state=np.random):
+    '''
+    Batched gaussian_noise
+    :param batch: array (signals, length) or (signals, length, channels)
+    :param out: optional array to write into
+    :param random_state: the numpy RandomState to draw the noise from
+    '''
+    noise = random_state.normal(0, 0.01, batch.shape)
+    return np.add(batch, noise, out=out)
+
+
+def expand_dims_batch(batch, out=None):
+    '''
+    Batched expand_dims, adds a trailing axis to every signal (returns a view, out is unused)
+    '''
+    return batch[..., np.newaxis]
+
+
+# Per signal operations and the equivalent operation over a whole batch (see ProcessingPipeline)
+BATCH_OPERATIONS = {
+    vertically_center_signal: vertically_center_batch,
+    normalize_signal: normalize_batch,
+    gaussian_noise: gaussian_noise_batch,
+    expand_dims: expand_dims_batch
+}
+
+
 @utils.timer(verbose_only=True)
 def difference_signal(signal):
     return [n - signal[i-1] for i, n in enumerate(signal) if i > 0]
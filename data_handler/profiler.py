@@ -0,0 +1,189 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+In memory instrumentation used by utils.timer. Each span keeps a call count,
+total time and a log spaced latency histogram (for p50/p95/p99). Spans nest,
+so a call is recorded under its full path, e.g. setup_data/read_all_data/read_data.
+Profiling is switched off at import time with config.code['profile'] = False,
+in which case utils.timer returns functions undecorated.
+'''
+import atexit
+import csv
+import json
+import math
+import threading
+import time
+
+import config
+
+# Histogram buckets: BUCKETS_PER_DECADE per power of ten from 10^MIN_EXPONENT seconds
+BUCKETS_PER_DECADE = 20
+MIN_EXPONENT = -7
+BUCKETS = BUCKETS_PER_DECADE * 10
+
+
+class SpanStats:
+    '''
+    Call count, total/min/max time and latency histogram of one span
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.histogram = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int((math.log10(seconds) - MIN_EXPONENT) * BUCKETS_PER_DECADE) if seconds > 0 else 0
+        self.histogram[min(max(bucket, 0), BUCKETS - 1)] += 1
+
+    def percentile(self, q):
+        '''
+        :param q: percentile between 0 and 100
+        :return: The upper edge of the histogram bucket holding the percentile (capped at the max seen)
+        '''
+        if self.calls == 0:
+            return 0.0
+        target = q / 100.0 * self.calls
+        cumulative = 0
+        for bucket, count in enumerate(self.histogram):
+            cumulative += count
+            if cumulative >= target and count:
+                return min(10 ** (MIN_EXPONENT + (bucket + 1) / BUCKETS_PER_DECADE), self.max)
+        return self.max
+
+
+class Span:
+    '''
+    Context manager timing one call of a span. elapsed holds the time once it exits
+    '''
+    __slots__ = ['profiler', 'name', 'path', 'start', 'elapsed']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.elapsed = None
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        self.path = stack[-1] + '/' + self.name if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.profiler.stack().pop()
+        self.profiler.record(self.path, self.elapsed)
+        return False
+
+
+class Profiler:
+    '''
+    Collects span statistics for every thread into one table
+    '''
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stack(self):
+        '''
+        :return: The list of open span paths of the current thread
+        '''
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def span(self, name):
+        '''
+        :param name: The name of the span, nested under any span already open in this thread
+        :return: context manager timing the span
+        '''
+        return Span(self, name)
+
+    def record(self, path, seconds):
+        with self.lock:
+            stats = self.stats.get(path)
+            if stats is None:
+                stats = self.stats[path] = SpanStats()
+            stats.add(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def snapshot(self):
+        '''
+        :return: list of dicts {span, calls, total_seconds, mean_seconds, min_seconds, max_seconds,
+            p50_seconds, p95_seconds, p99_seconds} ordered by span path
+        '''
+        with self.lock:
+            return [{
+                'span': path,
+                'calls': stats.calls,
+                'total_seconds': stats.total,
+                'mean_seconds': stats.total / stats.calls,
+                'min_seconds': stats.min,
+                'max_seconds': stats.max,
+                'p50_seconds': stats.percentile(50),
+                'p95_seconds': stats.percentile(95),
+                'p99_seconds': stats.percentile(99)
+            } for path, stats in sorted(self.stats.items())]
+
+    def dump(self, path):
+        '''
+        Writes a snapshot to a .json or .csv file (chosen by the extension)
+        :param path: The file to write
+        :return: The snapshot written
+        '''
+        snapshot = self.snapshot()
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(SNAPSHOT_FIELDS))
+                writer.writeheader()
+                writer.writerows(snapshot)
+        else:
+            with open(path, 'w') as f:
+                json.dump(snapshot, f, indent=2)
+        return snapshot
+
+
+SNAPSHOT_FIELDS = ['span', 'calls', 'total_seconds', 'mean_seconds', 'min_seconds', 'max_seconds',
+                   'p50_seconds', 'p95_seconds', 'p99_seconds']
+
+PROFILER = Profiler()
+
+
+def span(name):
+    '''
+    Times a block of code, e.g. with profiler.span("slice"): ...
+    '''
+    return PROFILER.span(name)
+
+
+def snapshot():
+    return PROFILER.snapshot()
+
+
+def dump(path):
+    return PROFILER.dump(path)
+
+
+def reset():
+    PROFILER.reset()
+
+
+if config.code['profile'] and config.code['profile_output']:
+    atexit.register(dump, config.code['profile_output'])
@@ -4,18 +4,32 @@ Created 17/07/18 by Matthew Lee
 '''
 import wfdb
 import os
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import config
 import utils
 import process_data
+import extract_features
+import resample_data
 
+# Compact annotation holding just the sample indexes and symbols of a wfdb annotation
+Annotation = namedtuple('Annotation', ['sample', 'symbol'])
 
 
 @utils.timer(verbose_only=True)
-def read_data(filename, directory=config.data['mit-bih']):
+def read_data(filename, directory=config.data['mit-bih'], lead=config.data['lead'], leads=None,
+              compact=config.data['compact']):
     '''
     Gathers all the data for a .dat file
     :param filename: name of the file to load. Should just be base name (no extention)
     :param directory: the location of the data. Defaults to configuration mit-bih
+    :param lead: The lead to keep (defaults to config.data['lead'])
+    :param leads: Optional list of leads to keep instead of lead. The signal is then a
+        (leads, samples) stack of the leads found in the record, named in data['leads']
+    :param compact: Keep the digital int16 samples stored in the .dat file instead of physical float64 values.
+        fields then also holds the adc_gain and baseline of the kept lead(s) (see extract_features.physical_signal)
+        (defaults to config.data['compact'])
     :return: dictionary object containing the following elements
         record: Information regarding the signal type
         annotation: The annotation of the signal
@@ -30,37 +44,195 @@ def read_data(filename, directory=config.data['mit-bih']):
             units -> unknown
             signame -> the name of the lead used. Corresponds to signal axis 1
             comments -> general comments made by annotator
+        lead: the name of the lead kept in signal (only when leads is not given)
     '''
     utils.v_log("Reading data files related to {}.".format(filename))
     full_path = "{}/{}".format(directory, filename)
     annotation = wfdb.rdann(full_path, 'atr')
-    sig, fields = wfdb.rdsamp(full_path)
+    if compact:
+        sig, fields = read_digital(full_path)
+    else:
+        sig, fields = wfdb.rdsamp(full_path)
     data = {
         'annotation': annotation,
         'signal': sig,
         'fields': fields
     }
-    data['signal'] = get_lead(data, lead=config.data['lead'])
+    if leads is None:
+        data['signal'] = get_lead(data, lead=lead)
+        data['lead'] = lead
+    else:
+        data['leads'], data['signal'] = get_leads(data, leads)
+    if compact:
+        # The gain and baseline of the rows kept, in the order of data['leads']
+        kept = [lead] if leads is None else data['leads']
+        rows = [list(fields['sig_name']).index(name) for name in kept]
+        for name in ['adc_gain', 'baseline']:
+            values = [fields[name][row] for row in rows]
+            fields[name] = values[0] if leads is None else values
     return data
 
 
+def read_digital(full_path):
+    '''
+    Reads the digital samples of a record as stored in its .dat file
+    :param full_path: path of the record without extension
+    :return: int16 signal array (samples, signals), fields dict like wfdb.rdsamp's with adc_gain and baseline added
+    '''
+    record = wfdb.rdrecord(full_path, physical=False, return_res=16)
+    fields = {
+        'fs': record.fs,
+        'sig_len': record.sig_len,
+        'n_sig': record.n_sig,
+        'units': record.units,
+        'sig_name': record.sig_name,
+        'comments': record.comments,
+        'adc_gain': [float(gain) for gain in record.adc_gain],
+        'baseline': [int(baseline) for baseline in record.baseline]
+    }
+    return record.d_signal.astype(np.int16, copy=False), fields
+
+
+def read_record(filename, directory=config.data['mit-bih'], lead=config.data['lead'],
+                processing=config.processing, kernal_size=config.data['kernal_size'], leads=None,
+                hz=config.data['hz'], compact=config.data['compact']):
+    '''
+    Reads and preprocesses a single record, keeping only compact numpy arrays.
+    This is the worker used by read_all_data when it runs in parallel, so every setting
+    is passed in rather than read from config (spawned workers do not share config changes)
+    :param filename: name of the file to load. Should just be base name (no extention)
+    :param directory: the location of the data. Defaults to configuration mit-bih
+    :param lead: The lead to keep (defaults to config.data['lead'])
+    :param processing: the processing flags used for the derived channels (defaults to config.processing)
+    :param kernal_size: the averaging window size (defaults to config.data['kernal_size'])
+    :param leads: Optional list of leads to read in the same pass instead of lead (see read_data)
+    :param hz: the sampling rate the record is resampled to when processing['resample'] is set
+        (defaults to config.data['hz']). The annotation is remapped to match (see resample_data)
+    :param compact: Keep the int16 digital signal and compute the derived channels in float32
+        (defaults to config.data['compact'])
+    :return: dictionary object containing
+        signal: numpy array of the lead, or (leads, samples) when leads is given
+        leads: the names of the signal rows (only when leads is given)
+        lead: the name of the lead in signal (only when leads is not given)
+        annotation: Annotation(sample, symbol) numpy arrays
+        fields: dict object {fs, sig_name, units}
+        difference/average_difference: numpy arrays of the derived channels enabled in processing,
+            stacked on the same lead axis as signal
+        or None if the lead (or none of the leads) is in the record
+    '''
+    try:
+        data = read_data(filename, directory, lead, leads, compact)
+    except ValueError:
+        return None
+    record = {
+        'signal': np.ascontiguousarray(data['signal']),
+        'annotation': Annotation(np.asarray(data['annotation'].sample),
+                                 np.asarray(data['annotation'].symbol)),
+        'fields': {
+            'fs': data['fields']['fs'],
+            'sig_name': list(data['fields']['sig_name']),
+            'units': list(data['fields']['units'])
+        }
+    }
+    if compact:
+        record['fields']['adc_gain'] = data['fields']['adc_gain']
+        record['fields']['baseline'] = data['fields']['baseline']
+    if leads is not None:
+        record['leads'] = data['leads']
+    else:
+        record['lead'] = data['lead']
+    if processing['resample']:
+        resample_data.resample_record(record, hz)
+    return extract_features.add_derived_channels(record, processing, kernal_size)
+
 
 @utils.timer()
-def read_all_data(directory=config.data['mit-bih']):
+def read_all_data(directory=config.data['mit-bih'], workers=config.data['workers'], cache=None, leads=None):
     '''
     Loads all .dat files in a directory. Defaults to config directory
     :param directory: the location of the data. Defaults to configuration mit-bih
-    :return:
+    :param workers: the number of worker processes (defaults to config.data['workers'], None uses every core).
+        With 1 worker, no cache and no leads the records are read serially and keep their wfdb objects
+        (see read_data). Otherwise each record is read and preprocessed into compact arrays (see read_record),
+        in a worker process when workers is more than 1
+    :param cache: optional cache_data.RecordCache. Records found in the cache are not read again
+    :param leads: Optional list of leads (e.g. config.data['leads']) to read from each record in one pass.
+        Records holding none of them are skipped, the rest keep the leads they have (see read_record)
+    :return: dictionary of record name -> data dictionary, ordered by record name
     '''
+    filenames = sorted(os.path.splitext(file)[0] for file in os.listdir(directory) if file.endswith(".dat"))
     data_files = {}
-    for file in os.listdir(directory):
-        if file.endswith(".dat"):
-            filename = os.path.splitext(file)[0]
+    if cache is None and leads is None and workers is not None and workers <= 1:
+        for filename in filenames:
             try:
-                data_files[filename] = read_data(filename)
+                data_files[filename] = read_data(filename, directory, config.data['lead'],
+                                                 compact=config.data['compact'])
             except ValueError:
                 utils.w_log("Lead {} not found in data file {}".format(config.data['lead'], filename))
-    return data_files
+        return data_files
+
+    return dict(iter_records(directory, workers, cache, leads))
+
+
+def iter_records(directory=config.data['mit-bih'], workers=config.data['workers'], cache=None, leads=None):
+    '''
+    Reads and preprocesses the records of a directory one at a time (see read_record), in record name order.
+    At most a few records per worker are read ahead, so memory stays bounded by the records in flight
+    however many records the directory holds
+    :param directory: the location of the data. Defaults to configuration mit-bih
+    :param workers: the number of worker processes (defaults to config.data['workers'], None uses every core).
+        With 1 worker records are read in this process as they are needed
+    :param cache: optional cache_data.RecordCache. Records found in the cache are not read again
+    :param leads: Optional list of leads to read from each record in one pass (see read_record)
+    :return: generator of (record name, data dictionary)
+    '''
+    filenames = sorted(os.path.splitext(file)[0] for file in os.listdir(directory) if file.endswith(".dat"))
+    wanted = config.data['lead'] if leads is None else ', '.join(leads)
+    settings = None
+    if cache is not None:
+        from cache_data import cache_settings
+        settings = cache_settings(config.data['lead'] if leads is None else list(leads),
+                                  config.processing, config.data['kernal_size'], config.data['hz'],
+                                  config.data['compact'])
+    executor = None if workers is not None and workers <= 1 else ProcessPoolExecutor(workers)
+    read_ahead = 2 * (workers or os.cpu_count() or 1)
+    # (filename, cached record, future, job) in record name order
+    pending = deque()
+    hits = 0
+    try:
+        for filename in filenames:
+            record = cache.get(filename, directory, settings) if cache is not None else None
+            job = (filename, directory, config.data['lead'], config.processing, config.data['kernal_size'], leads,
+                   config.data['hz'], config.data['compact'])
+            future = executor.submit(read_record, *job) if record is None and executor is not None else None
+            hits += record is not None
+            pending.append((filename, record, future, job))
+            while pending and (executor is None or len(pending) > read_ahead or pending[0][2] is None
+                               or pending[0][2].done()):
+                for item in _finish(pending.popleft(), wanted, cache, directory, settings):
+                    yield item
+        while pending:
+            for item in _finish(pending.popleft(), wanted, cache, directory, settings):
+                yield item
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if cache is not None:
+            utils.v_log("{} of {} records found in the cache".format(hits, len(filenames)))
+            cache.save()
+
+
+def _finish(item, wanted, cache, directory, settings):
+    filename, record, future, job = item
+    if record is not None:
+        return [(filename, record)]
+    record = future.result() if future is not None else read_record(*job)
+    if record is None:
+        utils.w_log("Lead {} not found in data file {}".format(wanted, filename))
+        return []
+    if cache is not None:
+        cache.put(filename, directory, settings, record)
+    return [(filename, record)]
 
 
 @utils.timer(verbose_only=True)
@@ -72,7 +244,49 @@ def get_lead(data_dict, lead=config.data['lead']):
     '''
     if lead in data_dict['fields']['sig_name']:
         lead_index = data_dict['fields']['sig_name'].index(lead)
-        return [x[lead_index] for x in data_dict['signal']]
+        return np.asarray(data_dict['signal'])[:, lead_index]
     else:
         raise ValueError("Lead {} not found in data files signal".format(lead))
 
+
+
+def get_leads(data_dict, leads=config.data['leads']):
+    '''
+    :param data_dict: The dictionary of the data (see read data)
+    :param leads: The leads to find (defaults to config.data['leads'])
+    :return: list of the leads found (in the order of leads), signal array (found leads, samples)
+        else a value error if none of the leads are in the record
+    '''
+    names = list(data_dict['fields']['sig_name'])
+    found = [lead for lead in leads if lead in names]
+    if not found:
+        raise ValueError("None of the leads {} found in data files signal".format(leads))
+    signal = np.asarray(data_dict['signal'])
+    return found, np.ascontiguousarray(signal[:, [names.index(lead) for lead in found]].T)
+
+
+def select_lead(data_dict, lead=config.data['lead']):
+    '''
+    Single lead view of a record read with several leads (see read_record), without copying any arrays
+    :param data_dict: The dictionary of the data. Single lead records (see read_data) are returned unchanged
+        if they hold lead
+    :param lead: The lead to select (defaults to config.data['lead'])
+    :return: data dictionary holding just that lead, or None if the record does not have it
+    '''
+    if 'leads' not in data_dict:
+        # fields['sig_name'] names every lead of the file, the kept one is named by 'lead'
+        kept = data_dict.get('lead')
+        if kept is None:
+            return data_dict if lead in data_dict['fields']['sig_name'] else None
+        return data_dict if kept == lead else None
+    if lead not in data_dict['leads']:
+        return None
+    row = data_dict['leads'].index(lead)
+    view = {key: value for key, value in data_dict.items() if key != 'leads'}
+    if 'adc_gain' in data_dict['fields']:
+        view['fields'] = dict(data_dict['fields'], adc_gain=data_dict['fields']['adc_gain'][row],
+                              baseline=data_dict['fields']['baseline'][row])
+    for name in ['signal', 'difference', 'average_difference']:
+        if name in data_dict:
+            view[name] = data_dict[name][row]
+    return view
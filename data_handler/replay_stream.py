@@ -0,0 +1,233 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Real time replay of records through the streaming path (optional online beat detection,
+feature extraction and the model, see classify_stream.StreamingClassifier). Samples are
+released chunk by chunk at speed times the sampling rate of the record (or as fast as
+possible) and the latency of every beat is measured from the time its R-peak arrived to
+the time its label was returned. A paced chunk is due at a fixed time whether or not the
+previous one is finished, so falling behind shows up in the latency of later beats.
+
+    python replay_stream.py --records 100 101 --speed 1 10 0 --weights ../data/model.npz
+
+For every record and speed, {record}_{speed}x.json ({record}_max.json) holds the report, the latency histogram
+and the timeline of deadline misses, and {record}_{speed}x.npz the latency of every beat.
+'''
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+import config
+import utils
+
+
+def replay_record(data, classify, speed=config.replay['speed'], chunk_seconds=config.replay['chunk_seconds'],
+                  budget=config.replay['budget'], detect=False, clock=time.perf_counter, sleep=time.sleep):
+    '''
+    Feeds the signal of a record through a StreamingClassifier at speed times real time
+    :param data: data dictionary (see read_data.read_record)
+    :param classify: function mapping windows (n, feature_size, 2) to probabilities (n, labels)
+    :param speed: Multiple of the sampling rate the samples are released at. 0 or None replays as fast as possible
+    :param chunk_seconds: Seconds of signal released at a time
+    :param budget: The latency allowed from the arrival of an R-peak to its label, in seconds
+    :param detect: Find the beats with detect_peaks.OnlinePeakDetector instead of using the annotation
+    :return: dict {sample, latency, label, miss} of per beat arrays and dict report
+    '''
+    from classify_stream import StreamingClassifier
+    from extract_features import physical_signal
+    import detect_peaks
+
+    fs = data['fields']['fs']
+    detector = detect_peaks.OnlinePeakDetector(fs) if detect else None
+    stream = StreamingClassifier(classify, hz=fs, detector=detector)
+    # The samples a monitor would send, in physical units also for compact records
+    signal = physical_signal(data, stream.dtype)
+    if not detect:
+        stream.add_beats(detect_peaks.beat_annotations(data['annotation'])[0])
+    chunk = max(1, int(round(chunk_seconds * fs)))
+    ends = np.minimum(np.arange(chunk, len(signal) + chunk, chunk), len(signal))
+    # The time each chunk arrived (was due) at, to look up the arrival of every R-peak
+    arrivals = np.zeros(len(ends))
+    samples, latencies, labels = [], [], []
+    busy = 0.0
+    lag = 0.0
+    start = clock()
+    for i, end in enumerate(ends):
+        if speed:
+            due = start + end / (fs * speed)
+            now = clock()
+            if now < due:
+                sleep(due - now)
+            else:
+                lag = max(lag, now - due)
+            arrivals[i] = due
+        else:
+            arrivals[i] = clock()
+        pushed = clock()
+        results = stream.push(signal[i * chunk:end])
+        done = clock()
+        busy += done - pushed
+        if results:
+            beat_samples = np.array([result[0] for result in results], dtype=np.int64)
+            # An R-peak arrived with the first chunk ending after it
+            peak_arrivals = arrivals[np.minimum(np.searchsorted(ends, beat_samples, side='right'), i)]
+            samples.append(beat_samples)
+            latencies.append(done - peak_arrivals)
+            labels.append(np.array([result[1] for result in results], dtype=np.int64))
+
+    beats = {
+        'sample': np.concatenate(samples) if samples else np.empty(0, dtype=np.int64),
+        'latency': np.concatenate(latencies) if latencies else np.empty(0),
+        'label': np.concatenate(labels) if labels else np.empty(0, dtype=np.int64)
+    }
+    beats['miss'] = beats['latency'] > budget
+    seconds = len(signal) / float(fs)
+    latency = beats['latency']
+    report = {
+        'fs': fs,
+        'speed': speed or None,
+        'budget_seconds': budget,
+        'signal_seconds': seconds,
+        'wall_seconds': clock() - start,
+        'busy_seconds': busy,
+        # Seconds of signal processed per second of computing, the fastest replay the box could keep up with
+        'max_realtime_factor': seconds / busy if busy else float('inf'),
+        'max_lag_seconds': lag,
+        'lookahead_seconds': stream.lookahead / float(fs * speed) if speed else 0.0,
+        'beats': len(latency),
+        'dropped': stream.dropped,
+        'misses': int(beats['miss'].sum()),
+        'miss_rate': float(beats['miss'].mean()) if len(latency) else 0.0,
+        'latency_mean': float(latency.mean()) if len(latency) else 0.0,
+        'latency_p50': float(np.percentile(latency, 50)) if len(latency) else 0.0,
+        'latency_p99': float(np.percentile(latency, 99)) if len(latency) else 0.0,
+        'latency_max': float(latency.max()) if len(latency) else 0.0
+    }
+    return beats, report
+
+
+def latency_histogram(latency, bins=config.replay['bins'], budget=config.replay['budget']):
+    '''
+    :param latency: array of beat latencies in seconds
+    :param bins: The number of bins
+    :param budget: The deadline, always inside the range of the histogram
+    :return: dict {edges, counts}
+    '''
+    high = max(float(latency.max()) if len(latency) else 0.0, budget) * 1.05
+    counts, edges = np.histogram(latency, bins=bins, range=(0.0, high))
+    return {'edges': edges.tolist(), 'counts': counts.tolist()}
+
+
+def miss_timeline(beats, fs):
+    '''
+    :param beats: per beat arrays (see replay_record)
+    :return: list of {sample, seconds, latency} of every beat that missed its deadline, in stream order
+    '''
+    missed = np.flatnonzero(beats['miss'])
+    return [{'sample': int(beats['sample'][i]), 'seconds': beats['sample'][i] / float(fs),
+             'latency': float(beats['latency'][i])} for i in missed]
+
+
+def write_run(name, beats, report, output=config.replay['output'], bins=config.replay['bins'], plot=False):
+    '''
+    Writes the report, latency histogram and miss timeline of a run to {name}.json, the per beat arrays
+    to {name}.npz and, with plot, both figures to {name}.png
+    :return: the path of the json file
+    '''
+    if not os.path.exists(output):
+        os.makedirs(output)
+    path = os.path.join(output, name)
+    np.savez(path + '.npz', **beats)
+    run = dict(report, histogram=latency_histogram(beats['latency'], bins, report['budget_seconds']),
+               misses_timeline=miss_timeline(beats, report['fs']))
+    with open(path + '.json', 'w') as f:
+        json.dump(run, f, indent=2)
+    if plot:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        figure, (histogram, timeline) = plt.subplots(2, 1, figsize=(10, 6))
+        edges = np.asarray(run['histogram']['edges'])
+        histogram.bar(edges[:-1], run['histogram']['counts'], width=np.diff(edges), align='edge')
+        histogram.axvline(report['budget_seconds'], color='tab:red', label="budget")
+        histogram.set_xlabel("latency (seconds)")
+        histogram.legend()
+        timeline.plot(beats['sample'] / float(report['fs']), beats['latency'], linewidth=0.5)
+        timeline.plot(beats['sample'][beats['miss']] / float(report['fs']), beats['latency'][beats['miss']],
+                      linestyle='', marker='x', color='tab:red', label="miss")
+        timeline.axhline(report['budget_seconds'], color='tab:red', linewidth=0.5)
+        timeline.set_xlabel("record seconds")
+        timeline.set_ylabel("latency (seconds)")
+        timeline.legend()
+        figure.tight_layout()
+        figure.savefig(path + '.png')
+        plt.close(figure)
+    return path + '.json'
+
+
+def replay(records, classify, directory=config.data['mit-bih'], speeds=(config.replay['speed'],),
+           output=config.replay['output'], chunk_seconds=config.replay['chunk_seconds'],
+           budget=config.replay['budget'], detect=False, plot=False):
+    '''
+    Replays each record at each speed and writes the runs (see write_run)
+    :param records: list of record names
+    :param classify: function mapping windows (n, feature_size, 2) to probabilities (n, labels)
+    :param directory: the location of the records. Defaults to configuration mit-bih
+    :param speeds: Multiples of real time, 0 replays as fast as possible
+    :return: dict of run name -> report
+    '''
+    from read_data import read_record
+
+    reports = {}
+    for record in records:
+        data = read_record(record, directory)
+        for speed in speeds:
+            beats, report = replay_record(data, classify, speed, chunk_seconds, budget, detect)
+            name = "{}_{:g}x".format(record, speed) if speed else "{}_max".format(record)
+            write_run(name, beats, report, output, plot=plot)
+            utils.log("{}: {} beats, {} misses, p99 {:.3f}s, max real time factor {:.1f}".format(
+                name, report['beats'], report['misses'], report['latency_p99'], report['max_realtime_factor']))
+            reports[name] = report
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay records through the streaming classifier in real time")
+    parser.add_argument('--records', nargs='+', required=True)
+    parser.add_argument('--source', default=config.data['mit-bih'], help="The directory of the records")
+    parser.add_argument('--output', default=config.replay['output'])
+    parser.add_argument('--speed', type=float, nargs='+', default=[config.replay['speed']],
+                        help="Multiples of real time, 0 for as fast as possible")
+    parser.add_argument('--chunk-seconds', type=float, default=config.replay['chunk_seconds'])
+    parser.add_argument('--budget', type=float, default=config.replay['budget'],
+                        help="Seconds allowed from R-peak arrival to label")
+    parser.add_argument('--detect', action='store_true', help="Detect the beats instead of using the annotation")
+    parser.add_argument('--plot', action='store_true', help="Also write the histogram and timeline as a png")
+    parser.add_argument('--weights', default=None, help="Classify with weights exported by numpy_model (no tensorflow)")
+    args = parser.parse_args(argv)
+
+    def run(classify):
+        return replay(args.records, classify, args.source, args.speed, args.output, args.chunk_seconds, args.budget,
+                      args.detect, args.plot)
+
+    if args.weights is not None:
+        from numpy_model import NumpyModel
+
+        return run(NumpyModel(args.weights).predict)
+
+    import tensorflow as tf
+    from network_model import instantiate_model, restore_model
+    from classify_stream import session_classifier
+
+    X_placeholder, _, _, output_soft = instantiate_model()
+    with tf.Session() as sess:
+        utils.log("Restored {}".format(restore_model(sess)))
+        return run(session_classifier(sess, X_placeholder, output_soft))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Polyphase resampling of records to config.data['hz']. The rate change is reduced
+to a rational up/down ratio and the anti-aliasing filter of each (current_hz, output_hz)
+pair is designed once and reused for every record. Annotation sample indexes are
+mapped onto the new rate so beat windows stay centred on the same beats.
+'''
+from fractions import Fraction
+from functools import lru_cache
+import numpy as np
+from scipy import signal as sp_signal
+
+import config
+import utils
+import read_data
+
+# Half length of the filter in input samples per unit of the larger rate change (the resample_poly default)
+HALF_LENGTH = 10
+MAX_DENOMINATOR = 1000
+
+
+def resample_ratio(current_hz, output_hz=config.data['hz']):
+    '''
+    :param current_hz: The current sampling rate
+    :param output_hz: The sampling rate wanted (defaults to config.data['hz'])
+    :return: (up, down) the smallest integers with up / down == output_hz / current_hz
+    '''
+    ratio = (Fraction(output_hz) / Fraction(current_hz)).limit_denominator(MAX_DENOMINATOR)
+    return ratio.numerator, ratio.denominator
+
+
+@lru_cache(maxsize=None)
+def resample_filter(current_hz, output_hz=config.data['hz']):
+    '''
+    Designs the low pass FIR filter of a rate change. Cached, so a filter is only designed once per pair
+    :param current_hz: The current sampling rate
+    :param output_hz: The sampling rate wanted (defaults to config.data['hz'])
+    :return: read only float array of filter coefficients (the same design as scipy.signal.resample_poly,
+        which scales them by up when they are applied)
+    '''
+    up, down = resample_ratio(current_hz, output_hz)
+    max_rate = max(up, down)
+    taps = sp_signal.firwin(2 * HALF_LENGTH * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+    taps.flags.writeable = False
+    return taps
+
+
+@utils.timer(verbose_only=True)
+def resample(signal, current_hz, output_hz=config.data['hz']):
+    '''
+    Resamples along the last axis, so a single signal (n,) or a stack of leads (..., n) is done in one call
+    :param signal: array of shape (..., n)
+    :param current_hz: The current sampling rate
+    :param output_hz: The sampling rate wanted (defaults to config.data['hz'])
+    :return: float array of shape (..., ceil(n * output_hz / current_hz))
+    '''
+    signal = np.asarray(signal, dtype=float)
+    up, down = resample_ratio(current_hz, output_hz)
+    if up == down:
+        return signal.copy()
+    return sp_signal.resample_poly(signal, up, down, axis=-1, window=resample_filter(current_hz, output_hz))
+
+
+def resample_samples(samples, current_hz, output_hz=config.data['hz'], length=None):
+    '''
+    Maps sample indexes onto the new rate (output sample j sits at input sample j * down / up)
+    :param samples: int array of sample indexes
+    :param current_hz: The current sampling rate
+    :param output_hz: The sampling rate wanted (defaults to config.data['hz'])
+    :param length: The length of the resampled signal. Indexes are clipped to it when given
+    :return: int array of the nearest sample indexes at the new rate
+    '''
+    up, down = resample_ratio(current_hz, output_hz)
+    samples = (np.asarray(samples, dtype=np.int64) * up + down // 2) // down
+    if length is not None:
+        samples = np.minimum(samples, length - 1)
+    return samples
+
+
+@utils.timer(verbose_only=True)
+def resample_record(data, output_hz=config.data['hz']):
+    '''
+    Resamples the signal of a data dictionary (see read_data) and remaps its annotation.
+    Must be called before the derived channels are added (see extract_features.add_derived_channels)
+    :param data: dictionary object with 'signal', 'annotation' and 'fields' elements. Integer (digital)
+        signals are rounded back to their type
+    :param output_hz: The sampling rate wanted (defaults to config.data['hz'])
+    :return: the same dictionary object at output_hz, fields['fs'] updated
+    '''
+    current_hz = data['fields']['fs']
+    if current_hz == output_hz:
+        return data
+    signal = np.asarray(data['signal'])
+    if np.issubdtype(signal.dtype, np.integer):
+        # Digital samples of a compact record (see read_data.read_data) stay integers at the new rate.
+        # The baseline is taken off first so the zero padding at the ends matches the physical signal
+        baseline = np.reshape(data['fields'].get('baseline', 0), (-1,) + (1,) * (signal.ndim - 1)) \
+            if signal.ndim > 1 else data['fields'].get('baseline', 0)
+        limits = np.iinfo(signal.dtype)
+        resampled = np.round(resample(signal - np.asarray(baseline), current_hz, output_hz)) + baseline
+        data['signal'] = np.clip(resampled, limits.min, limits.max).astype(signal.dtype)
+    else:
+        data['signal'] = resample(signal, current_hz, output_hz)
+    annotation = data['annotation']
+    data['annotation'] = read_data.Annotation(resample_samples(annotation.sample, current_hz, output_hz,
+                                                               np.shape(data['signal'])[-1]),
+                                              np.asarray(annotation.symbol))
+    data['fields'] = dict(data['fields'], fs=output_hz)
+    return data
+
@@ -0,0 +1,377 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Offline scoring of full length recordings (e.g. 24 hour Holter records). Each record is
+split into chunks that are read with enough margin for the feature transforms and the
+beat window, so every chunk can be prepared on its own in a worker process. The windows
+of many chunks are classified together in large batches and the results are written, in
+order, to one {record}.npz per record holding the sample, label and probabilities of
+every beat. Finished chunks are kept until their record is complete, so an interrupted
+run carries on where it stopped:
+
+    python score_records.py --source /data/holter --output ../data/scores
+'''
+import argparse
+import math
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import wfdb
+
+import config
+import utils
+import extract_features
+import resample_data
+import detect_peaks
+from format_data import feature_channels, in_signal_range, extract_windows
+
+# Seconds of signal read before a chunk so the R-peak detector has learnt its thresholds by the chunk start
+DETECT_WARMUP = 3.0
+
+
+def score_settings():
+    '''
+    :return: dict of every setting the chunk workers need (spawned workers do not share config changes)
+    '''
+    return {
+        'lead': config.data['lead'],
+        'processing': dict(config.processing),
+        'kernal_size': config.data['kernal_size'],
+        'hz': config.data['hz'],
+        'before': config.data['slice_before'],
+        'after': config.data['slice_after'],
+        'detect_beats': config.data['detect_beats'],
+        'chunk_seconds': config.score['chunk_seconds']
+    }
+
+
+def record_settings(filename, directory, settings):
+    '''
+    :param filename: name of the record. Should just be base name (no extention)
+    :param directory: the location of the record
+    :param settings: see score_settings
+    :return: settings for the chunks of one record. detect_beats is also set for records without an
+        annotation file, so the margin of their chunks leaves the R-peak detector time to learn (see chunk_margin)
+    '''
+    return dict(settings, detect_beats=settings['detect_beats'] or
+                not os.path.exists(os.path.join(directory, filename + '.atr')))
+
+
+def rate_change(fs, settings):
+    '''
+    :return: (up, down) from the record rate to the scoring rate, (1, 1) when resampling is off
+    '''
+    if settings['processing']['resample']:
+        return resample_data.resample_ratio(fs, settings['hz'])
+    return 1, 1
+
+
+def plan_chunks(filename, directory, settings):
+    '''
+    :param filename: name of the record. Should just be base name (no extention)
+    :param directory: the location of the record
+    :param settings: see score_settings
+    :return: list of (start, stop) sample ranges of the record (at the record rate) covering every sample.
+        Chunk starts are multiples of the resampling down factor so chunks resample onto the same sample grid
+    '''
+    header = wfdb.rdheader(os.path.join(directory, filename))
+    _, down = rate_change(header.fs, settings)
+    size = max(down, int(settings['chunk_seconds'] * header.fs) // down * down)
+    return [(start, min(start + size, header.sig_len)) for start in range(0, header.sig_len, size)]
+
+
+def chunk_margin(fs, settings):
+    '''
+    :return: The number of samples (at the record rate) read either side of a chunk so the features of
+        every beat in the chunk match those built from the whole record
+    '''
+    up, down = rate_change(fs, settings)
+    # The average_difference channel looks kernal_size + 2 samples around each point
+    margin = int(math.ceil((max(settings['before'], settings['after']) + 2 * settings['kernal_size'] + 2)
+                           * down / float(up)))
+    if settings['processing']['resample']:
+        margin += int(math.ceil(resample_data.HALF_LENGTH * max(up, down) / float(up))) + 1
+    if settings['detect_beats']:
+        margin += int(DETECT_WARMUP * fs)
+    return margin
+
+
+def prepare_chunk(filename, directory, start, stop, settings):
+    '''
+    Reads one chunk of a record (with margin, see chunk_margin), builds the feature channels and gathers
+    the window of every beat the chunk owns. This is the worker run in the process pool
+    :param filename: name of the record. Should just be base name (no extention)
+    :param directory: the location of the record
+    :param start: The first sample of the chunk (at the record rate)
+    :param stop: The sample after the last sample of the chunk (at the record rate)
+    :param settings: see record_settings
+    :return: (samples, symbols, windows). samples are the beat indexes at the scoring rate, symbols the
+        reference annotation of each beat ('' for detected beats) and windows (beats, window, channels) float32
+    '''
+    path = os.path.join(directory, filename)
+    header = wfdb.rdheader(path)
+    fs = header.fs
+    up, down = rate_change(fs, settings)
+    margin = chunk_margin(fs, settings)
+    read_start = max(0, start - margin) // down * down
+    read_stop = min(header.sig_len, stop + margin)
+    signal, _ = wfdb.rdsamp(path, sampfrom=read_start, sampto=read_stop,
+                            channels=[header.sig_name.index(settings['lead'])])
+    data = {'signal': signal[:, 0]}
+    if settings['processing']['resample']:
+        data['signal'] = resample_data.resample(data['signal'], fs, settings['hz'])
+    rate = fs * up / float(down)
+    # Index at the scoring rate of the first sample read, and the range of samples owned by this chunk
+    offset = read_start * up // down
+    first, last = start * up // down, -(-stop * up // down)
+
+    if settings['detect_beats']:
+        samples = detect_peaks.detect_peaks(data['signal'], rate) + offset
+        owned = (samples >= first) & (samples < last)
+        samples, symbols = samples[owned], np.full(owned.sum(), '', dtype=object)
+    else:
+        annotation = wfdb.rdann(path, 'atr', sampfrom=start, sampto=stop)
+        samples, symbols = detect_peaks.beat_annotations(annotation)
+        owned = (samples >= start) & (samples < stop)
+        samples = resample_data.resample_samples(samples[owned], fs, settings['hz'],
+                                                 -(-header.sig_len * up // down)) if up != down else samples[owned]
+        symbols = symbols[owned]
+
+    extract_features.add_derived_channels(data, settings['processing'], settings['kernal_size'])
+    channels = feature_channels(settings['processing'])
+    local = np.asarray(samples, dtype=np.int64) - offset
+    in_range = in_signal_range(data, local, channels, settings['before'], settings['after'])
+    windows = np.empty((in_range.sum(), settings['before'] + settings['after'] + 1, len(channels)),
+                       dtype=np.float32)
+    extract_windows(data, local[in_range], channels, windows, settings['before'], settings['after'])
+    return np.asarray(samples, dtype=np.int64)[in_range], np.asarray(symbols, dtype=str)[in_range], windows
+
+
+class RecordWriter:
+    '''
+    Keeps the scored chunks of one record on disk until every chunk is done, then joins them into {record}.npz
+    '''
+
+    def __init__(self, filename, output, chunks, fs, settings_hash, overwrite=False):
+        '''
+        :param filename: name of the record
+        :param output: The directory the results are written to
+        :param chunks: The number of chunks of the record
+        :param fs: The sampling rate of the scored beats
+        :param settings_hash: hash of the scoring settings (see score_settings)
+        :param overwrite: Remove the chunks saved by earlier runs instead of keeping the ones with the same settings
+        '''
+        self.filename = filename
+        self.path = os.path.join(output, filename + '.npz')
+        self.parts = os.path.join(output, filename + '.parts')
+        self.chunks = chunks
+        self.fs = fs
+        self.settings_hash = settings_hash
+        if not os.path.exists(self.parts):
+            os.makedirs(self.parts)
+        # Chunks left by a run with other settings would be joined with the new ones, so they are scored again
+        kept = set()
+        for part in os.listdir(self.parts):
+            path = os.path.join(self.parts, part)
+            if overwrite or part.endswith('.tmp.npz') or not _saved_with(path, settings_hash):
+                os.remove(path)
+            else:
+                kept.add(path)
+        # The chunks saved so far, counted here instead of opening every part file again
+        self.written = set(index for index in range(chunks) if self.part_path(index) in kept)
+
+    def part_path(self, index):
+        return os.path.join(self.parts, 'chunk_{:05d}.npz'.format(index))
+
+    def done(self, index):
+        '''
+        :return: True if chunk index was scored with the current settings, by this run or an earlier one
+        '''
+        return index in self.written
+
+    def write(self, index, samples, symbols, probabilities):
+        _save(self.part_path(index), sample=samples, symbol=symbols,
+              label=np.argmax(probabilities, axis=1).astype(np.int16) if len(probabilities) else
+              np.empty(0, dtype=np.int16),
+              probabilities=probabilities.astype(np.float32), config_hash=self.settings_hash)
+        self.written.add(index)
+
+    def complete(self):
+        '''
+        :return: True once every chunk has been written with the current settings
+        '''
+        return len(self.written) == self.chunks
+
+    def close(self):
+        '''
+        Joins the chunks into {record}.npz and removes them
+        :return: The number of beats in the record
+        '''
+        parts = [np.load(self.part_path(index)) for index in range(self.chunks)]
+        joined = {name: np.concatenate([part[name] for part in parts])
+                  for name in ['sample', 'symbol', 'label', 'probabilities']}
+        _save(self.path, fs=self.fs, config_hash=self.settings_hash, **joined)
+        for part in parts:
+            part.close()
+        shutil.rmtree(self.parts)
+        return len(joined['sample'])
+
+
+def _save(path, **arrays):
+    # Written next to the final file and renamed, so an interrupted run never leaves half a file
+    temporary = path[:-len('.npz')] + '.tmp.npz'
+    np.savez(temporary, **arrays)
+    os.replace(temporary, path)
+
+
+def _saved_with(path, settings_hash):
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as saved:
+        return str(saved['config_hash']) == settings_hash
+
+
+@utils.timer()
+def score_records(predict, source=config.data['mit-bih'], output=config.score['output'],
+                  workers=config.score['workers'], batch=config.score['batch'], overwrite=False):
+    '''
+    Scores every beat of every record in a directory
+    :param predict: function mapping windows (n, window, channels) to probabilities (n, labels),
+        e.g. classify_stream.session_classifier
+    :param source: The directory of the records (defaults to config.data['mit-bih'])
+    :param output: The directory the {record}.npz results are written to (defaults to config.score['output'])
+    :param workers: The number of worker processes preparing chunks (defaults to config.score['workers'],
+        None uses every core, 1 prepares them in this process)
+    :param batch: The number of windows classified at a time (defaults to config.score['batch'])
+    :param overwrite: Score records again even if an earlier run finished them
+    :return: dict {records, beats, seconds, records_per_hour, beats_per_second}
+    '''
+    if not os.path.exists(output):
+        os.makedirs(output)
+    settings = score_settings()
+    settings_hash = utils.config_hash(settings)
+    filenames = sorted(os.path.splitext(file)[0] for file in os.listdir(source) if file.endswith(".dat"))
+    writers = []
+    jobs = []
+    for filename in filenames:
+        if not overwrite and _saved_with(os.path.join(output, filename + '.npz'), settings_hash):
+            utils.v_log("{} was already scored".format(filename))
+            continue
+        header = wfdb.rdheader(os.path.join(source, filename))
+        if settings['lead'] not in header.sig_name:
+            utils.w_log("Lead {} not found in data file {}".format(settings['lead'], filename))
+            continue
+        chunks = plan_chunks(filename, source, settings)
+        chunk_settings = record_settings(filename, source, settings)
+        up, down = rate_change(header.fs, settings)
+        writer = RecordWriter(filename, output, len(chunks), header.fs * up / float(down), settings_hash, overwrite)
+        writers.append(writer)
+        jobs.extend((writer, index, (filename, source, start, stop, chunk_settings))
+                    for index, (start, stop) in enumerate(chunks)
+                    if not writer.done(index))
+    utils.log("Scoring {} records ({} chunks)".format(len(writers), len(jobs)))
+
+    start_time = time.perf_counter()
+    totals = {'records': 0, 'beats': 0}
+    finished = set()
+
+    def classify(prepared):
+        rows = np.concatenate([windows for _, _, (_, _, windows) in prepared]) if prepared else []
+        probabilities = np.concatenate([predict(rows[i:i + batch]) for i in range(0, len(rows), batch)]) \
+            if len(rows) else np.empty((0, config.network['labels']), dtype=np.float32)
+        offset = 0
+        for writer, index, (samples, symbols, windows) in prepared:
+            writer.write(index, samples, symbols, probabilities[offset:offset + len(windows)])
+            offset += len(windows)
+        for writer in writers:
+            if writer.filename not in finished and writer.complete():
+                finished.add(writer.filename)
+                totals['beats'] += writer.close()
+                totals['records'] += 1
+                hours = (time.perf_counter() - start_time) / 3600.0
+                utils.log("Scored {} ({} of {}, {:.1f} records/hour)".format(
+                    writer.filename, len(finished), len(writers), totals['records'] / hours))
+
+    # Records with every chunk saved by an earlier run only need joining
+    classify([])
+    executor = None if workers is not None and workers <= 1 else ProcessPoolExecutor(workers)
+    read_ahead = 2 * (workers or os.cpu_count() or 1)
+    pending = deque()
+    prepared = []
+    rows = 0
+    try:
+        for writer, index, args in jobs:
+            pending.append((writer, index, executor.submit(prepare_chunk, *args) if executor is not None else args))
+            while pending and (executor is None or len(pending) > read_ahead or pending[0][2].done()):
+                writer, index, job = pending.popleft()
+                result = job.result() if executor is not None else prepare_chunk(*job)
+                prepared.append((writer, index, result))
+                rows += len(result[2])
+                if rows >= batch:
+                    classify(prepared)
+                    prepared, rows = [], 0
+        while pending:
+            writer, index, job = pending.popleft()
+            prepared.append((writer, index, job.result() if executor is not None else prepare_chunk(*job)))
+        classify(prepared)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    seconds = time.perf_counter() - start_time
+    report = {
+        'records': totals['records'],
+        'beats': totals['beats'],
+        'seconds': seconds,
+        'records_per_hour': totals['records'] * 3600.0 / seconds if seconds else 0.0,
+        'beats_per_second': totals['beats'] / seconds if seconds else 0.0
+    }
+    utils.log("Scored {records} records ({beats} beats) in {seconds:.1f} seconds, "
+              "{records_per_hour:.1f} records/hour".format(**report))
+    return report
+
+
+def load_scores(filename, output=config.score['output']):
+    '''
+    :param filename: name of the record
+    :param output: The directory holding the results (defaults to config.score['output'])
+    :return: dict {fs, sample, symbol, label, probabilities} of the scored record
+    '''
+    with np.load(os.path.join(output, filename + '.npz')) as scores:
+        return {name: scores[name] for name in ['fs', 'sample', 'symbol', 'label', 'probabilities']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score every beat of full length recordings")
+    parser.add_argument('--source', default=config.data['mit-bih'], help="The directory of the records")
+    parser.add_argument('--output', default=config.score['output'])
+    parser.add_argument('--workers', type=int, default=config.score['workers'])
+    parser.add_argument('--batch', type=int, default=config.score['batch'])
+    parser.add_argument('--overwrite', action='store_true', help="Score records finished by an earlier run again")
+    parser.add_argument('--weights', default=None, help="Score with weights exported by numpy_model (no tensorflow)")
+    args = parser.parse_args(argv)
+
+    if args.weights is not None:
+        from numpy_model import NumpyModel
+
+        score_records(NumpyModel(args.weights).predict, args.source, args.output, args.workers, args.batch,
+                      args.overwrite)
+        return
+
+    import tensorflow as tf
+    from network_model import instantiate_model, restore_model
+    from classify_stream import session_classifier
+
+    X_placeholder, _, _, output_soft = instantiate_model()
+    with tf.Session() as sess:
+        utils.log("Restored {}".format(restore_model(sess)))
+        score_records(session_classifier(sess, X_placeholder, output_soft), args.source, args.output,
+                      args.workers, args.batch, args.overwrite)
+
+
+if __name__ == "__main__":
+    main()
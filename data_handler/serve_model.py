@@ -0,0 +1,238 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Local inference server. The trained model is loaded once and concurrent requests
+are combined into micro batches (bounded by a maximum batch size and a maximum
+wait) before each session run.
+
+    POST /predict  {"windows": [window, ...]} or {"window": window}
+                   -> {"labels": [...], "probabilities": [[...], ...]}
+    GET  /metrics  -> queue depth, batch size distribution and request latency
+'''
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+import numpy as np
+
+import config
+import utils
+from profiler import SpanStats
+
+
+class MicroBatcher:
+    '''
+    Collects requests from many threads and runs them through predict in shared batches
+    '''
+
+    def __init__(self, predict, max_batch=config.serve['max_batch'], max_wait=config.serve['max_wait']):
+        '''
+        :param predict: function mapping windows (n, feature_size, channels) to probabilities (n, labels)
+        :param max_batch: The largest number of windows in one batch (defaults to config.serve['max_batch'])
+        :param max_wait: The longest time in seconds the first request of a batch waits for others
+            (defaults to config.serve['max_wait'])
+        '''
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = Queue()
+        self.batch_sizes = Counter()
+        self.latency = SpanStats()
+        self.lock = threading.Lock()
+        self.running = True
+        self.carry = None
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, windows):
+        '''
+        :param windows: array (n, feature_size, channels)
+        :return: Future resolving to the probabilities (n, labels)
+        '''
+        future = Future()
+        self.requests.put((np.asarray(windows, dtype=np.float32), future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self.running = False
+        self.worker.join()
+
+    def metrics(self):
+        '''
+        :return: dict {queue_depth, batches, batch_sizes, requests, latency_seconds {mean, p50, p95, p99, max}}
+        '''
+        with self.lock:
+            return {
+                'queue_depth': self.requests.qsize(),
+                'batches': sum(self.batch_sizes.values()),
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'requests': self.latency.calls,
+                'latency_seconds': {
+                    'mean': self.latency.total / self.latency.calls if self.latency.calls else 0.0,
+                    'p50': self.latency.percentile(50),
+                    'p95': self.latency.percentile(95),
+                    'p99': self.latency.percentile(99),
+                    'max': self.latency.max
+                }
+            }
+
+    def _next(self, timeout):
+        if self.carry is not None:
+            request, self.carry = self.carry, None
+            return request
+        return self.requests.get(timeout=timeout)
+
+    def _run(self):
+        while self.running:
+            try:
+                first = self._next(0.1)
+            except Empty:
+                continue
+            batch = [first]
+            rows = len(first[0])
+            deadline = first[2] + self.max_wait
+            while rows < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._next(remaining)
+                except Empty:
+                    break
+                if rows + len(request[0]) > self.max_batch:
+                    # Keep it for the next batch rather than going over the limit
+                    self.carry = request
+                    break
+                batch.append(request)
+                rows += len(request[0])
+            self._run_batch(batch, rows)
+
+    def _run_batch(self, batch, rows):
+        try:
+            probabilities = np.asarray(self.predict(np.concatenate([windows for windows, _, _ in batch])))
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        done = time.perf_counter()
+        offset = 0
+        with self.lock:
+            self.batch_sizes[rows] += 1
+            for windows, future, arrival in batch:
+                future.set_result(probabilities[offset:offset + len(windows)])
+                offset += len(windows)
+                self.latency.add(done - arrival)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    # Many clients connect at once under load, the socketserver default backlog is 5
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(batcher):
+    '''
+    :param batcher: The MicroBatcher requests are sent to
+    :return: BaseHTTPRequestHandler class for the server
+    '''
+    class InferenceHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send(200, batcher.metrics())
+            else:
+                self._send(404, {'error': 'Unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send(404, {'error': 'Unknown path {}'.format(self.path)})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                windows = np.asarray(body['windows'] if 'windows' in body else [body['window']], dtype=np.float32)
+                if windows.shape[1:] != (config.network['feature_size'], config.network['feature_channels']):
+                    raise ValueError("Windows must have the shape (n, {}, {})".format(
+                        config.network['feature_size'], config.network['feature_channels']))
+            except (KeyError, ValueError, TypeError) as e:
+                self._send(400, {'error': str(e)})
+                return
+            try:
+                probabilities = batcher.submit(windows).result()
+            except Exception as e:
+                # The model failed on this batch, the client gets the error instead of a dropped connection
+                utils.w_log("Prediction failed: {}".format(e))
+                self._send(500, {'error': str(e)})
+                return
+            self._send(200, {
+                'labels': [config.data['annotations'][label] for label in np.argmax(probabilities, axis=1)],
+                'probabilities': probabilities.tolist()
+            })
+
+        def log_message(self, format, *args):
+            utils.v_log(format % args)
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return InferenceHandler
+
+
+def serve(host=config.serve['host'], port=config.serve['port'], weights=None):
+    '''
+    Loads the latest checkpoint (see network_model.restore_model) and serves it until interrupted
+    :param host: The address to listen on (defaults to config.serve['host'])
+    :param port: The port to listen on (defaults to config.serve['port'])
+    :param weights: Optional .npz file written by numpy_model.export_weights. The model is then run
+        with numpy_model.NumpyModel and tensorflow is not imported
+    '''
+    if weights is not None:
+        from numpy_model import NumpyModel
+
+        utils.log("Loaded {}".format(weights))
+        run_server(NumpyModel(weights).predict, host, port)
+        return
+
+    import tensorflow as tf
+    from network_model import instantiate_model, restore_model
+    from classify_stream import session_classifier
+
+    X_placeholder, _, _, output_soft = instantiate_model()
+    with tf.Session() as sess:
+        utils.log("Restored {}".format(restore_model(sess)))
+        run_server(session_classifier(sess, X_placeholder, output_soft), host, port)
+
+
+def run_server(predict, host=config.serve['host'], port=config.serve['port']):
+    '''
+    Serves a predict function behind a MicroBatcher until interrupted
+    '''
+    batcher = MicroBatcher(predict)
+    server = InferenceServer((host, port), make_handler(batcher))
+    utils.log("Serving on http://{}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the trained model over http")
+    parser.add_argument('--host', default=config.serve['host'])
+    parser.add_argument('--port', type=int, default=config.serve['port'])
+    parser.add_argument('--weights', default=None, help="Serve weights exported by numpy_model without tensorflow")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.weights)
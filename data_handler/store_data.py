@@ -0,0 +1,247 @@
+'''
+ecg_realtime_abnormal_detection
+Created 18/10/26
+
+Sharded dataset store. A dataset is a directory holding fixed size .npy shards
+of features, the labels, the per-row provenance (record and sample of each beat)
+and a small manifest.json describing them. Shards are written one at a time and
+read back memory mapped, so datasets larger than RAM can be built and read.
+'''
+import json
+import os
+import numpy as np
+
+import config
+import utils
+
+MANIFEST = 'manifest.json'
+
+
+def dataset_settings(leads=None):
+    '''
+    :param leads: The leads of a dataset built from several leads (see format_data.setup_lead_data),
+        used in place of config.data['lead']
+    :return: dict of the config values that change the contents of a dataset
+    '''
+    data = {key: config.data[key] for key in
+            ['hz', 'slice_before', 'slice_after', 'lead', 'annotations', 'kernal_size', 'detect_beats', 'compact']}
+    if leads is not None:
+        data['lead'] = list(leads)
+    return {
+        'data': data,
+        'processing': config.processing
+    }
+
+
+def dataset_path(name=config.data['npy_name'], directory=config.data['npy_loc']):
+    '''
+    :return: The directory of the dataset called name
+    '''
+    return os.path.join(directory, name)
+
+
+def dataset_exists(name=config.data['npy_name'], directory=config.data['npy_loc']):
+    return os.path.exists(os.path.join(dataset_path(name, directory), MANIFEST))
+
+
+class ShardWriter:
+    '''
+    Streams rows of a dataset to disk. At most one shard of features is held in memory
+    '''
+
+    def __init__(self, name=config.data['npy_name'], directory=config.data['npy_loc'],
+                 shard_size=config.data['shard_size'], leads=None):
+        '''
+        :param name: The name of the dataset
+        :param directory: The directory the dataset directory is created in
+        :param shard_size: The number of rows in each shard (defaults to config.data['shard_size'])
+        :param leads: The leads the features were sliced from, when not config.data['lead']
+        '''
+        self.path = dataset_path(name, directory)
+        self.shard_size = shard_size
+        self.leads = None if leads is None else list(leads)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for file in os.listdir(self.path):
+            if file.endswith('.npy') or file == MANIFEST:
+                os.remove(os.path.join(self.path, file))
+
+        self.buffer = None
+        self.buffered = 0
+        self.rows = 0
+        self.shards = []
+        self.labels = []
+        self.record_names = []
+        self.record_index = {}
+        self.provenance = []
+
+    def append(self, X, y, records, samples):
+        '''
+        Adds rows to the dataset
+        :param X: features (rows, ...)
+        :param y: labels (rows, ...)
+        :param records: the record name of each row
+        :param samples: the sample index of the beat in its record for each row
+        '''
+        X = np.asarray(X)
+        if self.buffer is None:
+            self.buffer = np.empty((self.shard_size,) + X.shape[1:], dtype=X.dtype)
+        for i in range(0, len(X), self.shard_size):
+            part = X[i:i + self.shard_size]
+            space = min(len(part), self.shard_size - self.buffered)
+            self.buffer[self.buffered:self.buffered + space] = part[:space]
+            self.buffered += space
+            if self.buffered == self.shard_size:
+                self._write_shard()
+            self.buffer[:len(part) - space] = part[space:]
+            self.buffered += len(part) - space
+
+        self.labels.append(np.asarray(y))
+        record_ids = np.empty(len(records), dtype=np.int32)
+        for i, record in enumerate(records):
+            if record not in self.record_index:
+                self.record_index[record] = len(self.record_names)
+                self.record_names.append(record)
+            record_ids[i] = self.record_index[record]
+        self.provenance.append(np.stack((record_ids, np.asarray(samples, dtype=np.int32)), axis=1))
+        self.rows += len(X)
+
+    def close(self):
+        '''
+        Writes the last shard, the labels, the provenance and the manifest
+        :return: The manifest dict
+        '''
+        if self.buffered:
+            self._write_shard()
+        if self.buffer is None:
+            raise ValueError("Cannot write an empty dataset to {}".format(self.path))
+        y = np.concatenate(self.labels)
+        provenance = np.concatenate(self.provenance)
+        np.save(os.path.join(self.path, 'y.npy'), y)
+        np.save(os.path.join(self.path, 'provenance.npy'), provenance)
+        counts = np.bincount(provenance[:, 0], minlength=len(self.record_names))
+        manifest = {
+            'dtype': str(self.buffer.dtype),
+            'shape': [self.rows] + list(self.buffer.shape[1:]),
+            'label_shape': list(y.shape),
+            'shard_size': self.shard_size,
+            'shards': self.shards,
+            'leads': self.leads,
+            'config_hash': utils.config_hash(dataset_settings(self.leads)),
+            'records': [{'name': name, 'rows': int(count)} for name, count in zip(self.record_names, counts)]
+        }
+        with open(os.path.join(self.path, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+    def _write_shard(self):
+        file = 'X_{:05d}.npy'.format(len(self.shards))
+        np.save(os.path.join(self.path, file), self.buffer[:self.buffered])
+        self.shards.append(file)
+        self.buffered = 0
+
+
+class ShardedArray:
+    '''
+    Read only, array like view of the features of a dataset. Shards are memory mapped
+    the first time they are needed, so only the pages that are indexed are read
+    '''
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.shape = tuple(manifest['shape'])
+        self.dtype = np.dtype(manifest['dtype'])
+        self.ndim = len(self.shape)
+        self.shard_size = manifest['shard_size']
+        self.shards = [None] * len(manifest['shards'])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def shard(self, i):
+        '''
+        :return: The memory mapped array of shard i
+        '''
+        if self.shards[i] is None:
+            self.shards[i] = np.load(os.path.join(self.path, self.manifest['shards'][i]), mmap_mode='r')
+        return self.shards[i]
+
+    def release(self):
+        '''
+        Unmaps every shard, so the pages read so far no longer count against this process
+        '''
+        self.shards = [None] * len(self.shards)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            if np.isscalar(key[0]):
+                return rows[key[1:]]
+            return rows[(slice(None),) + key[1:]]
+        if np.isscalar(key):
+            index = int(key)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("Index {} is out of bounds for a dataset of {} rows".format(key, len(self)))
+            return self.shard(index // self.shard_size)[index % self.shard_size]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return self._read_range(start, stop)
+            key = np.arange(start, stop, step)
+        return self.take(key)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self._read_range(0, len(self))
+        return array if dtype is None else array.astype(dtype)
+
+    def take(self, indices, axis=0):
+        '''
+        Gathers rows from their shards into a new array
+        :param indices: int (or bool mask) array of rows
+        :return: numpy array (len(indices), ...)
+        '''
+        if axis != 0:
+            raise ValueError("ShardedArray can only be indexed along the first axis")
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.nonzero(indices)[0]
+        indices = np.where(indices < 0, indices + len(self), indices)
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        shard_ids = indices // self.shard_size
+        for shard_id in np.unique(shard_ids):
+            rows = shard_ids == shard_id
+            out[rows] = self.shard(shard_id)[indices[rows] % self.shard_size]
+        return out
+
+    def _read_range(self, start, stop):
+        out = np.empty((max(0, stop - start),) + self.shape[1:], dtype=self.dtype)
+        position = start
+        while position < stop:
+            shard_id = position // self.shard_size
+            offset = position % self.shard_size
+            count = min(stop - position, self.shard_size - offset)
+            out[position - start:position - start + count] = self.shard(shard_id)[offset:offset + count]
+            position += count
+        return out
+
+
+def open_dataset(name=config.data['npy_name'], directory=config.data['npy_loc']):
+    '''
+    Opens a dataset written by ShardWriter without reading the features
+    :param name: The name of the dataset
+    :param directory: The directory holding the dataset directory
+    :return: X (ShardedArray), y (memory mapped), provenance (memory mapped (rows, 2) of record id, sample),
+        manifest dict
+    '''
+    path = dataset_path(name, directory)
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest['config_hash'] != utils.config_hash(dataset_settings(manifest.get('leads'))):
+        utils.w_log("Dataset {} was built with different settings to the current config".format(name))
+    X = ShardedArray(path, manifest)
+    y = np.load(os.path.join(path, 'y.npy'), mmap_mode='r')
+    provenance = np.load(os.path.join(path, 'provenance.npy'), mmap_mode='r')
+    return X, y, provenance, manifest
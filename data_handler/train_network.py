@@ -3,15 +3,15 @@ ecg_realtime_abnormal_detection
 Created 1/08/18 by Matthew Lee
 '''
 import tensorflow as tf
-import math
+import os
+import numpy as np
 
 import config
 from utils import log, v_log
-from format_data import get_data, get_train_test
+from format_data import get_data, get_train_test_indices, BalancedSampler
+from feed_data import BatchPrefetcher, chunks
 from network_model import instantiate_model as model
 
-X_placeholder, y_placeholder, output, output_soft = model()
-
 
 def calculate_accuracy(y, y_):
     with tf.name_scope("accuracy"):
@@ -32,54 +32,139 @@ def calculate_backpropagation(loss, lr, global_step_tensor):
     return tf.train.AdamOptimizer(lr).minimize(loss, global_step=global_step_tensor)
 
 
-def train(X, y, epochs=config.train['epochs'], lr=config.train['learning_rate'], batch=config.train['batch']):
-    global_step_tensor = tf.Variable(0, trainable=False, name='global_step')
-
-    loss, loss_summary = calculate_loss(output, y)
-    backprop = calculate_backpropagation(loss, lr, global_step_tensor)
-    accuracy, accuracy_summary = calculate_accuracy(y, output)
-
-    merged = tf.summary.merge_all()
-
-
-    X_train, X_test, y_train, y_test = get_train_test(*get_data())
-
-    with tf.Session() as sess:
-        sess.run(tf.global_variables_initializer())
-
-
-        train_writer = tf.summary.FileWriter(config.train['tensorboard'] + "/" + config.train['name'] + "/train", sess.graph)
-        test_writer = tf.summary.FileWriter(config.train['tensorboard'] + "/" + config.train['name'] + "/test", sess.graph)
-
-        for e in range(epochs):
-            epoch_loss = 0
-            for i in range(int(math.ceil(len(X_train)/batch))):
-                if len(X_train) < i * batch + batch:
-                    X_batch = X_train[i*batch:i*batch+batch]
-                    y_batch = y_train[i*batch:i*batch+batch]
-                else:
-                    X_batch = X_train[i*batch:]
-                    y_batch = y_train[i*batch:]
-                l, _, summary = sess.run([loss, backprop, loss_summary], feed_dict={
-                    X: X_batch,
-                    y: y_batch
-                })
-                train_writer.add_summary(summary, global_step=tf.train.global_step(sess, global_step_tensor))
-                v_log("Batch loss: {}".format(l))
-                epoch_loss += l
-            log("Epoch {} loss: {}".format(e, epoch_loss))
-
-            acc, summary = sess.run([accuracy, accuracy_summary], feed_dict={
-                X: X_test,
-                y: y_test
-            })
-            test_writer.add_summary(summary, global_step=e)
-
-
-            print("Epoch {} accuracy: {}".format(e, acc))
-
-
+def train(epochs=config.train['epochs'], lr=config.train['learning_rate'], batch=config.train['batch']):
+    '''
+    Builds the network_model graph and trains it on the dataset saved by format_data.setup_data,
+    saving a checkpoint every epoch
+    :param epochs: The number of epochs (defaults to config.train['epochs'])
+    :param lr: The learning rate (defaults to config.train['learning_rate'])
+    :param batch: The batch size (defaults to config.train['batch'])
+    :return: metrics of the test rows after the last epoch (see fit)
+    '''
+    X_data, y_data = get_data()
+    train_indices, test_indices = get_train_test_indices(y_data)
+    return fit(X_data, y_data, train_indices, test_indices, epochs, lr, batch)
+
+
+def fit(X_data, y_data, train_indices, test_indices, epochs=config.train['epochs'], lr=config.train['learning_rate'],
+        batch=config.train['batch'], name=config.train['name'], session_config=None, seed=config.train['seed']):
+    '''
+    Trains a new network_model graph on some rows of a dataset and evaluates it on others,
+    writing tensorboard summaries and a checkpoint every epoch under name
+    :param X_data: The features (e.g. the memory mapped dataset returned by format_data.get_data)
+    :param y_data: The one hot labels
+    :param train_indices: The rows to train on
+    :param test_indices: The rows to evaluate on
+    :param epochs: The number of epochs (defaults to config.train['epochs'])
+    :param lr: The learning rate (defaults to config.train['learning_rate'])
+    :param batch: The batch size (defaults to config.train['batch'])
+    :param name: The name of the run, its checkpoints and summaries (defaults to config.train['name'])
+    :param session_config: Optional tf.ConfigProto of the session, e.g. to cap its threads
+    :param seed: The seed of the graph and of the batch order (defaults to config.train['seed'])
+    :return: dict {accuracy, loss, confusion, epochs} of the test rows after the last epoch.
+        confusion[i][j] counts the test beats of label i predicted as label j
+    '''
+    with tf.Graph().as_default():
+        if seed is not None:
+            tf.set_random_seed(seed)
+        X, y, output, output_soft = model()
+        global_step_tensor = tf.Variable(0, trainable=False, name='global_step')
+
+        loss, loss_summary = calculate_loss(output, y)
+        backprop = calculate_backpropagation(loss, lr, global_step_tensor)
+        accuracy, accuracy_summary = calculate_accuracy(y, output)
+
+        merged = tf.summary.merge_all()
+        saver = tf.train.Saver()
+        checkpoint_dir = "{}/{}".format(config.train['checkpoint'], name)
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        prefetcher = BatchPrefetcher(X_data, y_data, batch, indices=train_indices, seed=seed)
+        sampler = BalancedSampler(y_data, train_indices, seed=seed) if config.train['balance_each_epoch'] else None
+
+        with tf.Session(config=session_config) as sess:
+            sess.run(tf.global_variables_initializer())
+
+            train_writer = tf.summary.FileWriter(config.train['tensorboard'] + "/" + name + "/train", sess.graph)
+            test_writer = tf.summary.FileWriter(config.train['tensorboard'] + "/" + name + "/test", sess.graph)
+
+            history = []
+            for e in range(epochs):
+                epoch_loss = 0
+                epoch_indices = sampler.sample() if sampler is not None else None
+                for X_batch, y_batch in prefetcher.epoch(epoch_indices):
+                    l, _, summary = sess.run([loss, backprop, loss_summary], feed_dict={
+                        X: X_batch,
+                        y: y_batch
+                    })
+                    train_writer.add_summary(summary, global_step=tf.train.global_step(sess, global_step_tensor))
+                    v_log("Batch loss: {}".format(l))
+                    epoch_loss += l
+                report = prefetcher.report()
+                log("Epoch {} loss: {} ({:.1f} steps/sec, {:.2f} of {:.2f} seconds waiting for input)".format(
+                    e, epoch_loss, report['steps_per_second'], report['input_wait_seconds'], report['seconds']))
+
+                acc, test_loss = evaluate(sess, X, y, accuracy, loss, X_data, y_data, test_indices)
+                test_writer.add_summary(tf.Summary(value=[
+                    tf.Summary.Value(tag="accuracy/Accuracy", simple_value=acc),
+                    tf.Summary.Value(tag="loss/Loss", simple_value=test_loss)
+                ]), global_step=e)
+                saver.save(sess, checkpoint_dir + "/model", global_step=e)
+                history.append({'epoch': e, 'train_loss': float(epoch_loss), 'accuracy': float(acc),
+                                'loss': float(test_loss), 'seconds': report['seconds']})
+
+                print("Epoch {} accuracy: {}".format(e, acc))
+
+            confusion = confusion_matrix(sess, X, output, X_data, y_data, test_indices)
+    return {
+        'accuracy': history[-1]['accuracy'] if history else None,
+        'loss': history[-1]['loss'] if history else None,
+        'confusion': confusion.tolist(),
+        'epochs': history
+    }
+
+
+def confusion_matrix(sess, X, output, X_data, y_data, indices=None, size=config.train['eval_batch']):
+    '''
+    :param sess: The session holding the model
+    :param X: The X placeholder
+    :param output: The output tensor
+    :return: int array (labels, labels), [i][j] counts the rows of label i predicted as label j
+    '''
+    labels = config.network['labels']
+    confusion = np.zeros((labels, labels), dtype=np.int64)
+    for X_chunk, y_chunk in chunks(X_data, y_data, indices, size):
+        predicted = np.argmax(sess.run(output, feed_dict={X: X_chunk}), axis=1)
+        np.add.at(confusion, (np.argmax(y_chunk, axis=1), predicted), 1)
+    return confusion
+
+
+def evaluate(sess, X, y, accuracy, loss, X_data, y_data, indices=None, size=config.train['eval_batch']):
+    '''
+    Evaluates the model in fixed size chunks so memory does not grow with the test set
+    :param sess: The session holding the model
+    :param X: The X placeholder
+    :param y: The y placeholder
+    :param accuracy: The accuracy tensor (see calculate_accuracy)
+    :param loss: The loss tensor (see calculate_loss)
+    :param X_data: The features
+    :param y_data: The labels
+    :param indices: The rows to evaluate. Defaults to every row
+    :param size: The number of rows fed at once (defaults to config.train['eval_batch'])
+    :return: accuracy, loss averaged over every row
+    '''
+    total_accuracy, total_loss, rows = 0.0, 0.0, 0
+    for X_chunk, y_chunk in chunks(X_data, y_data, indices, size):
+        acc, l = sess.run([accuracy, loss], feed_dict={
+            X: X_chunk,
+            y: y_chunk
+        })
+        total_accuracy += acc * len(y_chunk)
+        total_loss += l * len(y_chunk)
+        rows += len(y_chunk)
+    return total_accuracy / rows, total_loss / rows
 
 
 if __name__ == "__main__":
-    train(X_placeholder, y_placeholder)
\ No newline at end of file
+    train()
\ No newline at end of file
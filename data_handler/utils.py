@@ -2,9 +2,12 @@
 ecg_realtime_abnormal_detection
 Created 17/07/18 by Matthew Lee
 '''
-import time
+import json
+import hashlib
+from functools import wraps
 
 import config
+import profiler
 
 
 '''
@@ -12,21 +15,27 @@ import config
 '''
 def timer(timer_flag=config.code['timer'], verbose_only=False):
     '''
-    This is a decorator that prints out the total time that a function takes to run.
-    :param timer_flag: Only print or return time taken to run if flag is True
-    :param verbose_only: Only run this timer if the verbose flag is True
+    This is a decorator that records the time a function takes to run in the profiler (see profiler.py).
+    Calls are recorded as nested spans, e.g. setup_data/read_all_data/read_data.
+    The decision is made when the function is decorated (at import time): if the timer flag or
+    config.code['profile'] is False, or verbose_only is set without config.code['verbose'],
+    the function is returned unchanged so it has no overhead
+    :param timer_flag: Only time the function if flag is True
+    :param verbose_only: Only time the function if the verbose flag is True
     :return: output or tuple (output, time) if in testing mode
     '''
     def decorator(func):
+        if not timer_flag or not config.code['profile'] or (verbose_only and not config.code['verbose']):
+            return func
+
+        @wraps(func)
         def wrapper(*args, **kwargs):
-            start = time.time()
-            output = func(*args, **kwargs)
-            end = time.time()
-            if timer_flag:
-                if verbose_only is False or (verbose_only is True and config.code['verbose']):
-                    print("Function {0.__name__} ran for {1}".format(func, end - start))
-                    if config.code['testing']:
-                        return output, time
+            with profiler.span(func.__name__) as span:
+                output = func(*args, **kwargs)
+            if config.code['verbose']:
+                v_log("Function {0.__name__} ran for {1}".format(func, span.elapsed))
+            if config.code['testing']:
+                return output, span.elapsed
             return output
         return wrapper
     return decorator
@@ -37,6 +46,7 @@ def verbose_only(func):
     Decorator that only runs function if verbose flag is True
     :return: output of func (only if verbose flag is True
     '''
+    @wraps(func)
     def wrapper(*args, **kwargs):
         if config.code['verbose']:
             return func(*args, **kwargs)
@@ -48,6 +58,7 @@ def warning_only(func):
     Decorator that only runs function if warning flag is True
     :return: output of func (only if warning flag is True
     '''
+    @wraps(func)
     def wrapper(*args, **kwargs):
         if config.code['warnings']:
             return func(*args, **kwargs)
@@ -85,4 +96,13 @@ def find_index(haystack, needle):
         index = haystack.index(needle)
     except ValueError:
         index = False
-    return index
\ No newline at end of file
+    return index
+
+
+def config_hash(*values):
+    '''
+    Creates a short, stable hash of json serialisable values (e.g. config dicts).
+    Used to tell whether data built with one set of settings can be reused with another
+    '''
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
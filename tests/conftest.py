@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# The modules of data_handler import each other by name (e.g. import config)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_handler'))
+
+
+@pytest.fixture(scope='session')
+def record_directory(tmp_path_factory):
+    '''
+    A directory of three minute long synthetic records (see generate_data.write_records)
+    '''
+    pytest.importorskip('wfdb')
+    import generate_data
+
+    directory = str(tmp_path_factory.mktemp('records'))
+    generate_data.write_records(directory, count=3, length=360 * 60 * 3)
+    return directory
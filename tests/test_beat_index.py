@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import pytest
+
+import config
+
+pytest.importorskip('wfdb')
+
+from beat_index import get_beat_index
+from format_data import slice_based_on_annotations, preprocess_record
+from read_data import read_all_data
+
+ANNOTATIONS = config.data['annotations']
+
+
+@pytest.fixture(scope='module')
+def records(record_directory):
+    file_dicts = {name: preprocess_record(data) for name, data in read_all_data(record_directory, 1).items()}
+    return file_dicts, slice_based_on_annotations(file_dicts, ANNOTATIONS, provenance=True)
+
+
+@pytest.fixture
+def index(record_directory, tmp_path):
+    return get_beat_index(record_directory, str(tmp_path / 'beat_index.npz'))
+
+
+def test_saved_index_is_reused(record_directory, tmp_path, index):
+    path = str(tmp_path / 'beat_index.npz')
+    assert os.path.exists(path)
+    assert get_beat_index(record_directory, path).key == index.key
+
+
+def test_index_selects_the_sliced_beats(records, index):
+    file_dicts, (X, y, names, _) = records
+    rows = index.select(ANNOTATIONS, leads=[config.data['lead']])
+    assert np.array_equal(index.beats(rows)[0], names)
+    assert np.array_equal(index.labels(rows, ANNOTATIONS), y)
+    assert np.array_equal(index.windows(rows, file_dicts), X)
+    # Rows out of order come back in the order asked for
+    assert np.array_equal(index.windows(rows[::-1], file_dicts), X[::-1])
+
+
+def test_label_counts(records, index):
+    _, (_, y, _, _) = records
+    assert index.label_counts(ANNOTATIONS) == dict(zip(ANNOTATIONS, np.bincount(y, minlength=len(ANNOTATIONS)).tolist()))
+
+
+def test_unknown_lead_selects_nothing(index):
+    assert len(index.select(leads=['no such lead'])) == 0
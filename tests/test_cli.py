@@ -0,0 +1,15 @@
+import pytest
+
+import cli
+
+
+@pytest.mark.parametrize('statement, forbidden', cli.IMPORT_BUDGET)
+def test_import_budget(statement, forbidden):
+    seconds, pulled = cli.import_budget([(statement, forbidden)])[statement]
+    assert not pulled, "'{}' imports {}".format(statement, ', '.join(pulled))
+    assert seconds >= 0
+
+
+def test_import_budget_finds_forbidden_packages():
+    _, pulled = cli.import_budget([("import json", ['json', 'tensorflow'])])["import json"]
+    assert pulled == ['json']
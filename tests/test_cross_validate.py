@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+
+from cross_validate import fold_records, set_thread_environment
+from format_data import get_record_folds
+
+RECORDS = 40
+FOLDS = 5
+SEED = 0
+
+
+@pytest.fixture(scope='module')
+def rows():
+    '''
+    The record of every row, for records of very different sizes
+    '''
+    random_state = np.random.RandomState(SEED)
+    sizes = random_state.randint(50, 3000, RECORDS)
+    return random_state.permutation(np.repeat(np.arange(RECORDS), sizes)), sizes
+
+
+def test_every_row_is_tested_once(rows):
+    rows, _ = rows
+    splits = get_record_folds(rows, FOLDS, SEED)
+    assert len(splits) == FOLDS
+    tested = np.concatenate([test for _, test in splits])
+    assert np.array_equal(np.sort(tested), np.arange(len(rows)))
+    for train_indices, test_indices in splits:
+        assert len(train_indices) + len(test_indices) == len(rows)
+
+
+def test_no_record_is_on_both_sides_of_a_fold(rows):
+    rows, _ = rows
+    for train_indices, test_indices in get_record_folds(rows, FOLDS, SEED):
+        assert not np.intersect1d(rows[train_indices], rows[test_indices]).size
+
+
+def test_folds_hold_about_the_same_rows(rows):
+    rows, sizes = rows
+    fold_sizes = np.array([len(test) for _, test in get_record_folds(rows, FOLDS, SEED)])
+    assert fold_sizes.max() - fold_sizes.min() <= sizes.max()
+
+
+def test_fold_records_names_every_record_once(rows):
+    rows, _ = rows
+    names = ["{}".format(100 + record) for record in range(RECORDS)]
+    tested = fold_records(get_record_folds(rows, FOLDS, SEED), rows, names)
+    assert sorted(sum(tested, [])) == names
+
+
+def test_fewer_records_than_folds_do_not_split(rows):
+    rows, _ = rows
+    with pytest.raises(ValueError):
+        get_record_folds(rows[rows < 2], FOLDS)
+
+
+def test_thread_environment_is_restored(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '3')
+    monkeypatch.delenv('MKL_NUM_THREADS', raising=False)
+    previous = set_thread_environment(2)
+    assert os.environ['OMP_NUM_THREADS'] == os.environ['MKL_NUM_THREADS'] == '2'
+    set_thread_environment(previous)
+    assert os.environ['OMP_NUM_THREADS'] == '3' and 'MKL_NUM_THREADS' not in os.environ
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+pytest.importorskip('wfdb')
+
+import read_data
+from display_data import MinMaxPyramid, RecordViewer, LiveMonitor, record_chunks
+
+FS = 360
+LENGTH = FS * 60 * 30
+
+
+@pytest.fixture(scope='module')
+def signal():
+    return np.cumsum(np.random.RandomState(0).normal(0, 1, LENGTH))
+
+
+def test_pyramid_envelope_holds_the_extremes(signal):
+    random_state = np.random.RandomState(1)
+    pyramid = MinMaxPyramid(signal, points=1000)
+    for _ in range(50):
+        start = random_state.randint(0, LENGTH - 10)
+        stop = random_state.randint(start + 1, LENGTH + 1)
+        _, y = pyramid.view(start, stop)
+        # Every bucket covers the range, so the envelope contains the extremes of the range
+        assert y.max() >= signal[start:stop].max() and y.min() <= signal[start:stop].min()
+        assert len(y) <= 2 * pyramid.factor * pyramid.points
+    # Short ranges are drawn sample by sample
+    assert np.array_equal(pyramid.view(10, 500)[1], signal[10:500])
+
+
+def test_viewer_draws_a_bounded_number_of_points(signal):
+    samples = np.arange(FS, LENGTH - FS, FS)
+    data = {'signal': signal, 'difference': np.diff(signal), 'fields': {'fs': FS, 'sig_name': ['MLII']},
+            'annotation': read_data.Annotation(samples, np.where(samples % 7 == 0, 'A', 'N'))}
+    viewer = RecordViewer(data, predictions={'sample': samples, 'label': samples % 2})
+    viewer.refresh()
+    for i in range(20):
+        viewer.scroll(5.0 if i % 2 else 600.0)
+    viewer.zoom(64.0)
+    for _ in range(20):
+        viewer.scroll(60.0)
+    assert all(len(line.get_xdata()) <= 2 * 4 * 600 for line in viewer.lines)
+    assert viewer.report()['redraws'] >= 40
+
+
+def test_live_monitor_keeps_the_last_seconds(signal):
+    monitor = LiveMonitor(FS, seconds=10.0, points=1000)
+    for chunk in record_chunks(signal[:FS * 25], FS):
+        monitor.push(chunk)
+    _, y = monitor.frame()
+    assert monitor.buffer.count == FS * 25
+    assert y.max() == signal[FS * 15:FS * 25].max()
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import extract_features
+import process_data
+
+LENGTHS = [0, 1, 5, 10, 11, 12, 100, 1001]
+KERNAL_SIZES = [1, 2, 5, 9]
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+def test_difference_signal_matches_process_data(length):
+    signal = np.random.RandomState(length).normal(0, 1, length)
+    expected = np.array(process_data.difference_signal(list(signal)), dtype=float)
+    assert np.array_equal(extract_features.difference_signal(signal), expected)
+
+
+@pytest.mark.parametrize('kernal_size', KERNAL_SIZES)
+@pytest.mark.parametrize('length', LENGTHS)
+def test_average_signal_matches_process_data(length, kernal_size):
+    signal = np.random.RandomState(length).normal(0, 1, length)
+    expected = np.array(process_data.average_signal(list(signal), kernal_size), dtype=float)
+    assert np.array_equal(extract_features.average_signal(signal, kernal_size), expected)
+    # Every row of a stack is transformed on its own
+    stack = np.stack((signal, signal[::-1]))
+    assert np.array_equal(extract_features.average_signal(stack, kernal_size)[0], expected)
+
+
+def test_moving_average_writes_to_out():
+    signal = np.random.RandomState(0).normal(0, 1, 50).astype(np.float32)
+    out = np.full(46, np.nan, dtype=np.float32)
+    result = extract_features.moving_average(signal, 5, np.float32, out)
+    assert result is out
+    assert np.array_equal(out, extract_features.moving_average(signal, 5, np.float32))
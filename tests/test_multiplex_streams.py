@@ -0,0 +1,44 @@
+import asyncio
+
+import numpy as np
+
+from classify_stream import StreamingClassifier
+from multiplex_streams import StreamMultiplexer, feed_patient, read_results, chunks, run
+
+PATIENTS = 8
+SECONDS = 30
+FS = 360
+
+
+def predict(windows):
+    # The label depends on the window only, so a beat routed to the wrong patient would show
+    score = windows[:, :, 0].sum(axis=1)
+    return np.stack((score, -score), axis=1)
+
+
+def test_every_patient_gets_its_own_labels():
+    random_state = np.random.RandomState(0)
+    signals = [random_state.normal(0, 0.1, SECONDS * FS) for _ in range(PATIENTS)]
+    beats = [np.arange(FS + i, SECONDS * FS - FS, FS // 2 + i) for i in range(PATIENTS)]
+
+    async def stream_all():
+        multiplexer = StreamMultiplexer(predict, max_batch=32, max_wait=0.002)
+        readers = []
+        for i in range(PATIENTS):
+            patient = multiplexer.add_patient(i, FS, beats[i])
+            asyncio.ensure_future(feed_patient(multiplexer, i, chunks(signals[i], 97)))
+            readers.append(read_results(patient))
+        results = await asyncio.gather(*readers)
+        await multiplexer.close()
+        return results, multiplexer.metrics()
+
+    results, metrics = run(stream_all())
+    for i in range(PATIENTS):
+        # The same results, in the same order, as a classifier of the patient's own
+        alone = StreamingClassifier(predict, hz=FS)
+        alone.add_beats(beats[i])
+        expected = alone.push(signals[i])
+        assert [result[0] for result in results[i]] == [result[0] for result in expected]
+        assert [result[1] for result in results[i]] == [result[1] for result in expected]
+        assert np.allclose([result[2] for result in results[i]], [result[2] for result in expected], rtol=1e-5)
+    assert metrics['mean_batch'] > 1
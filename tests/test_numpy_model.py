@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+import numpy_model
+
+
+def test_quantize_kernel_rounds_to_the_nearest_step():
+    kernel = np.random.RandomState(0).normal(0, 0.1, (21, 2, 8)).astype(np.float32)
+    kernel[..., 3] = 0
+    quantized, scale = numpy_model.quantize_kernel(kernel)
+    assert quantized.dtype == np.int8 and quantized.shape == kernel.shape
+    assert np.all(np.abs(quantized.astype(np.float32) * scale - kernel) <= scale / 2 + 1e-7)
+    assert scale[3] == 1.0
+
+
+def test_numpy_model_matches_tensorflow(tmp_path):
+    pytest.importorskip('tensorflow')
+    errors = numpy_model.parity_errors(windows=64, seed=0, path=str(tmp_path))
+    assert errors['float32'] < 1e-5, errors
+    assert errors['int8'] < 1e-1, errors
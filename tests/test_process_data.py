@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from process_data import (ProcessingPipeline, vertically_center_signal, normalize_signal, expand_dims,
+                          gaussian_noise_batch)
+
+SIGNALS = 16
+SEED = 0
+
+
+def pipeline_output(X, functions, batched):
+    pipeline = ProcessingPipeline(X, np.zeros(len(X)), batch_size=5, seed=SEED)
+    for func in functions:
+        pipeline.add_op(func)
+        if not batched:
+            pipeline.operations[-1]['batch_function'] = None
+    return np.concatenate([np.array(batch_X) for batch_X, _ in pipeline.get_batch()])
+
+
+# The per signal centring and normalizing reduce over the whole signal, so single channel
+# signals are used for those. expand_dims expects (length, channels) signals
+@pytest.mark.parametrize('shape, functions', [
+    ((SIGNALS, 701), [vertically_center_signal, normalize_signal]),
+    ((SIGNALS, 701, 2), [expand_dims])
+])
+def test_batched_operations_match_per_signal(shape, functions):
+    X = np.random.RandomState(SEED).normal(0, 1, shape)
+    expected = pipeline_output(X, functions, batched=False)
+    output = pipeline_output(X, functions, batched=True)
+    assert output.shape == expected.shape
+    assert np.allclose(output, expected)
+
+
+def test_gaussian_noise_batch_is_seeded():
+    X = np.random.RandomState(SEED).normal(0, 1, (SIGNALS, 701))
+    noise = [gaussian_noise_batch(X, random_state=np.random.RandomState(SEED)) for _ in range(2)]
+    assert np.array_equal(noise[0], noise[1])
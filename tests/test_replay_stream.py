@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import config
+
+pytest.importorskip('wfdb')
+
+from read_data import Annotation
+from replay_stream import replay_record, miss_timeline
+
+FS = 360
+SECONDS = 60
+SPEED = 20.0
+BUDGET = 0.5
+
+
+class FakeClock:
+    '''
+    Time that only moves when the replay sleeps or the classifier works
+    '''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+    def classifier(self, delay=0.0):
+        def classify(windows):
+            self.now += delay
+            return np.tile([0.9, 0.1], (len(windows), 1))
+        return classify
+
+
+@pytest.fixture
+def record():
+    samples = np.arange(FS, SECONDS * FS - FS, FS)
+    return {'signal': np.random.RandomState(0).normal(0, 0.1, SECONDS * FS), 'fields': {'fs': FS},
+            'annotation': Annotation(samples, np.array(['N'] * len(samples)))}
+
+
+def test_instant_classifier_meets_every_deadline(record):
+    fake = FakeClock()
+    beats, report = replay_record(record, fake.classifier(), SPEED, budget=BUDGET, clock=fake.clock,
+                                  sleep=fake.sleep)
+    samples = record['annotation'].sample
+    complete = (samples >= config.data['slice_before']) & \
+        (samples + config.data['slice_after'] + 1 <= SECONDS * FS - config.data['kernal_size'])
+    # Every beat with a complete window is classified once
+    assert np.array_equal(beats['sample'], samples[complete])
+    # A beat waits only for the rest of its window to arrive
+    lookahead = (config.data['slice_after'] + config.data['kernal_size'] + 1) / float(FS * SPEED)
+    assert np.all(beats['latency'] <= lookahead + config.replay['chunk_seconds'] / SPEED + 1e-9)
+    assert report['misses'] == 0 and report['max_realtime_factor'] == float('inf')
+
+
+def test_slow_classifier_misses_every_deadline(record):
+    fake = FakeClock()
+    beats, report = replay_record(record, fake.classifier(1.0), SPEED, budget=BUDGET, clock=fake.clock,
+                                  sleep=fake.sleep)
+    assert report['misses'] == report['beats'] > 0 and report['max_lag_seconds'] > 0
+    assert len(miss_timeline(beats, FS)) == report['misses']
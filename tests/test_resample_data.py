@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+sp_signal = pytest.importorskip('scipy.signal')
+pytest.importorskip('wfdb')
+
+import read_data
+from resample_data import resample, resample_filter, resample_ratio, resample_record
+
+CURRENT_HZ = 360
+OUTPUT_HZ = 900
+LENGTH = 3600
+
+
+@pytest.fixture
+def sine():
+    t = np.arange(LENGTH) / float(CURRENT_HZ)
+    return np.sin(2 * np.pi * 1.3 * t)
+
+
+def test_resample_matches_resample_poly(sine):
+    up, down = resample_ratio(CURRENT_HZ, OUTPUT_HZ)
+    expected = sp_signal.resample_poly(sine, up, down)
+    assert np.allclose(resample(sine, CURRENT_HZ, OUTPUT_HZ), expected)
+    # Leads are resampled along the last axis
+    assert np.allclose(resample(np.stack((sine, -sine)), CURRENT_HZ, OUTPUT_HZ)[1], -expected)
+
+
+def test_resample_filter_is_cached():
+    assert resample_filter(CURRENT_HZ, OUTPUT_HZ) is resample_filter(CURRENT_HZ, OUTPUT_HZ)
+
+
+def test_annotations_stay_on_their_beats():
+    spikes = np.zeros(LENGTH)
+    samples = np.arange(50, LENGTH - 50, 317)
+    spikes[samples] = 1
+    data = resample_record({'signal': spikes, 'annotation': read_data.Annotation(samples, ['N'] * len(samples)),
+                            'fields': {'fs': CURRENT_HZ}}, OUTPUT_HZ)
+    # Within the half sample rounding of the new rate
+    peaks = [np.argmax(data['signal'][max(0, s - 5):s + 6]) + max(0, s - 5) for s in data['annotation'].sample]
+    assert np.all(np.abs(np.asarray(peaks) - data['annotation'].sample) <= 1)
+    assert data['fields']['fs'] == OUTPUT_HZ